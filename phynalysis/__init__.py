@@ -1,11 +1,13 @@
 """Phynalysis module."""
 
 from .beast import *
+from .cache import *
 from .cli import *
 from .configs import *
 from .export import *
 from .haplotypes import *
 from .mutations import *
 from .parsers import *
+from .reference import *
 from .remote import *
 from .transform import *
@@ -0,0 +1,309 @@
+"""Sidecar cache of all changes in an alignment.
+
+Parsing an alignment is by far the most expensive step of the haplotypes and
+consensus subcommands. The cache stores every change of every read together with its
+quality and the read lengths, so that later runs only re-apply the length and
+quality thresholds.
+
+The cache is stored next to the alignment as `<alignment>.changes.npz` and is keyed
+by the size, modification time and a checksum of the alignment, and a hash of the
+reference sequence.
+
+## Example:
+
+```python
+cache = load_change_cache("sample.aligned.bam", reference)
+for batch in cache.iter_change_batches(quality_threshold=47):
+    ...
+```
+"""
+
+import json
+import logging
+import os
+from collections import Counter
+from hashlib import blake2b, sha1
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pysam
+
+from .parsers import (
+    DEFAULT_BATCH_SIZE,
+    ChangeBatch,
+    MutationCodes,
+    _block_id,
+    _changes_frame,
+    _ranges,
+    changes_arrays_from_read,
+    encode_sequence,
+)
+
+__all__ = ["ChangeCache", "change_cache_path", "load_change_cache"]
+
+_CHECKSUM_BYTES = 1 << 20
+
+
+def change_cache_path(alignment_path: str | Path) -> Path:
+    """Get the path of the change cache of an alignment."""
+    alignment_path = Path(alignment_path)
+    return alignment_path.with_name(alignment_path.name + ".changes.npz")
+
+
+def _cache_key(alignment_path: str | Path, reference: str) -> dict:
+    """Key of an alignment and reference.
+
+    The checksum covers the first and last MiB of the alignment, which include the
+    header and the end of the last BGZF block.
+    """
+    stat = os.stat(alignment_path)
+    checksum = blake2b(digest_size=16)
+    with open(alignment_path, "rb") as file_descriptor:
+        checksum.update(file_descriptor.read(_CHECKSUM_BYTES))
+        file_descriptor.seek(max(stat.st_size - _CHECKSUM_BYTES, 0))
+        checksum.update(file_descriptor.read(_CHECKSUM_BYTES))
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "checksum": checksum.hexdigest(),
+        "reference": sha1(reference.encode("ascii")).hexdigest(),
+    }
+
+
+class ChangeCache:
+    """All changes of an alignment in CSR layout.
+
+    Attributes
+    ----------
+    key : dict
+        Key of the alignment and reference the cache was built from.
+    offsets : np.ndarray
+        Offsets of the changes of each read, the changes of read `i` are
+        `offsets[i]:offsets[i + 1]`.
+    reference_lengths, query_lengths : np.ndarray
+        Lengths of each read.
+    read_block_ids : np.ndarray
+        Index into `block_ids` for each read, or -1.
+    positions, codes, qualities : np.ndarray
+        Position, index into `mutations` and quality of each change.
+    mutations, block_ids : np.ndarray
+        String tables of the mutations and block ids.
+    """
+
+    def __init__(
+        self,
+        key: dict,
+        offsets: np.ndarray,
+        reference_lengths: np.ndarray,
+        query_lengths: np.ndarray,
+        read_block_ids: np.ndarray,
+        positions: np.ndarray,
+        codes: np.ndarray,
+        qualities: np.ndarray,
+        mutations: np.ndarray,
+        block_ids: np.ndarray,
+    ):
+        self.key = key
+        self.offsets = offsets
+        self.reference_lengths = reference_lengths
+        self.query_lengths = query_lengths
+        self.read_block_ids = read_block_ids
+        self.positions = positions
+        self.codes = codes
+        self.qualities = qualities
+        self.mutations = mutations
+        self.block_ids = block_ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls, alignment_path: str | Path, reference: str):
+        """Parse all changes of an alignment without any thresholds."""
+        encoded_reference = encode_sequence(reference)
+        codes = MutationCodes()
+        block_ids = {}
+        n_changes = []
+        reference_lengths = []
+        query_lengths = []
+        read_block_ids = []
+        positions = []
+        mutation_codes = []
+        qualities = []
+        with pysam.AlignmentFile(alignment_path, "rb", check_sq=False) as alignment:
+            for read in alignment:
+                read_positions, read_codes, read_qualities = changes_arrays_from_read(
+                    encoded_reference, read, codes
+                )
+                block_id = _block_id(read)
+                n_changes.append(len(read_positions))
+                reference_lengths.append(read.reference_length or 0)
+                query_lengths.append(read.query_length)
+                read_block_ids.append(
+                    block_ids.setdefault(block_id, len(block_ids))
+                    if block_id is not None
+                    else -1
+                )
+                positions.append(read_positions)
+                mutation_codes.append(read_codes)
+                qualities.append(read_qualities)
+
+        def _concatenate(arrays, dtype):
+            return (
+                np.concatenate(arrays).astype(dtype) if arrays else np.empty(0, dtype)
+            )
+
+        return cls(
+            key=_cache_key(alignment_path, reference),
+            offsets=np.concatenate([[0], np.cumsum(n_changes, dtype=np.int64)]),
+            reference_lengths=np.array(reference_lengths, dtype=np.int32),
+            query_lengths=np.array(query_lengths, dtype=np.int32),
+            read_block_ids=np.array(read_block_ids, dtype=np.int32),
+            positions=_concatenate(positions, np.int32),
+            codes=_concatenate(mutation_codes, np.int32),
+            qualities=_concatenate(qualities, np.uint8),
+            mutations=np.array(codes.mutations, dtype=str),
+            block_ids=np.array(list(block_ids), dtype=str),
+        )
+
+    @classmethod
+    def load(cls, path: str | Path):
+        """Load a cache from a file."""
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        arrays["key"] = json.loads(str(arrays["key"]))
+        return cls(**arrays)
+
+    def save(self, path: str | Path):
+        """Save the cache to a file."""
+        # write through a file object, so that numpy does not change the suffix
+        with open(path, "wb") as file_descriptor:
+            np.savez(
+                file_descriptor,
+                key=np.array(json.dumps(self.key)),
+                offsets=self.offsets,
+                reference_lengths=self.reference_lengths,
+                query_lengths=self.query_lengths,
+                read_block_ids=self.read_block_ids,
+                positions=self.positions,
+                codes=self.codes,
+                qualities=self.qualities,
+                mutations=self.mutations,
+                block_ids=self.block_ids,
+            )
+
+    def matches(self, alignment_path: str | Path, reference: str) -> bool:
+        """Check whether the cache was built from an alignment and reference."""
+        return self.key == _cache_key(alignment_path, reference)
+
+    def iter_change_batches(
+        self,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        codes: MutationCodes | None = None,
+        length_threshold: int = 0,
+        quality_threshold: int = 0,
+        stats: Counter | None = None,
+    ) -> Iterator[ChangeBatch]:
+        """Iterate over the cached changes in batches of reads.
+
+        The batches hold the same changes and statistics as those of
+        `parsers.iter_change_batches` on the alignment with the same arguments. Only
+        the order in which mutations are added to `codes` differs.
+        """
+        if codes is None:
+            codes = MutationCodes()
+
+        if stats is None:
+            stats = Counter()
+
+        recode = np.array(
+            [codes.encode(mutation) for mutation in self.mutations.tolist()],
+            dtype=np.int32,
+        )
+        n_changes = np.diff(self.offsets)
+
+        accepted = np.ones(len(self), dtype=bool)
+        if length_threshold:
+            accepted = (
+                np.abs(self.reference_lengths - self.query_lengths) < length_threshold
+            )
+        stats["reads"] += len(self)
+        stats["reads_rejected_length"] += len(self) - np.count_nonzero(accepted)
+
+        read_index = np.flatnonzero(accepted)
+        for start in range(0, len(read_index), batch_size):
+            batch_reads = read_index[start : start + batch_size]
+            batch_n_changes = n_changes[batch_reads]
+            change_index = _ranges(self.offsets[batch_reads], batch_n_changes)
+            seq_ids = np.repeat(
+                np.arange(start, start + len(batch_reads)), batch_n_changes
+            )
+            read_block_ids = np.repeat(
+                self.read_block_ids[batch_reads], batch_n_changes
+            )
+
+            stats["changes"] += len(change_index)
+            if quality_threshold > 0:
+                keep = self.qualities[change_index] >= quality_threshold
+                stats["changes_rejected_quality"] += len(keep) - np.count_nonzero(keep)
+                change_index = change_index[keep]
+                seq_ids = seq_ids[keep]
+                read_block_ids = read_block_ids[keep]
+
+            # compact the block ids to those of the changes in this batch in order of
+            # appearance
+            batch_block_ids = pd.unique(read_block_ids[read_block_ids >= 0])
+            compact = np.full(len(self.block_ids) + 1, -1, dtype=np.int32)
+            compact[batch_block_ids] = np.arange(len(batch_block_ids))
+            read_block_ids = compact[read_block_ids]
+
+            yield ChangeBatch(
+                len(batch_reads),
+                _changes_frame(
+                    codes.mutations,
+                    self.block_ids[batch_block_ids].tolist(),
+                    [seq_ids],
+                    [read_block_ids],
+                    [self.positions[change_index]],
+                    [recode[self.codes[change_index]]],
+                    [self.qualities[change_index]],
+                ),
+            )
+
+
+def load_change_cache(
+    alignment_path: str | Path, reference: str, build: bool = True
+) -> ChangeCache | None:
+    """Load the change cache of an alignment.
+
+    Parameters
+    ----------
+    alignment_path : str | Path
+        Path to the alignment.
+    reference : str
+        Reference sequence.
+    build : bool
+        Build and save the cache if it is missing or outdated.
+
+    Returns
+    -------
+    ChangeCache | None
+        The cache, or None if no valid cache exists and `build` is False.
+    """
+    path = change_cache_path(alignment_path)
+    if path.exists():
+        cache = ChangeCache.load(path)
+        if cache.matches(alignment_path, reference):
+            logging.info("Using change cache %s.", path)
+            return cache
+        logging.info("Change cache %s is outdated.", path)
+
+    if not build:
+        return None
+
+    logging.info("Building change cache %s...", path)
+    cache = ChangeCache.build(alignment_path, reference)
+    cache.save(path)
+    return cache
@@ -1,36 +1,68 @@
 """Ancestors subcommand."""
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
-from ..transform import haplotype_to_set, haplotype_to_string
+from ..mutations import MutationVocabulary
+from ..transform import parse_haplotypes
 
 
-def _haplotype_distance(haplotype1, haplotype2):
-    """Calculate distance between two haplotypes."""
-    return len(haplotype1 ^ haplotype2)
+def _find_ancestors(haplotypes, is_ancestor, is_descendant) -> np.ndarray:
+    """Find the closest ancestor of each descendant.
 
+    The distance between two haplotypes is the number of changes in only one of
+    them, `|a| + |d| - 2 |a & d|`. The shared changes of a descendant with all
+    ancestors are counted at once from the ancestors of each of its changes,
+    which are looked up by their id in a `MutationVocabulary`.
 
-def _find_ancestor(descendant, ancestors):
-    """Find ancestor of descendants"""
-    distances = ancestors.apply(
-        lambda haplotype: _haplotype_distance(haplotype, descendant)
+    Returns
+    -------
+    np.ndarray
+        Index of the closest ancestor of each descendant, the first one on ties.
+    """
+    vocabulary = MutationVocabulary()
+    change_ids = vocabulary.encode_haplotypes(haplotypes)
+    n_changes = haplotypes.n_changes
+    haplotype_ids = np.repeat(np.arange(len(n_changes)), n_changes)
+    ancestor_index = np.flatnonzero(is_ancestor)
+    ancestor_number = np.full(len(n_changes), -1)
+    ancestor_number[ancestor_index] = np.arange(len(ancestor_index))
+
+    # ancestors of each change in CSR layout
+    ancestor_changes = ancestor_number[haplotype_ids] >= 0
+    order = np.argsort(change_ids[ancestor_changes], kind="stable")
+    change_ancestors = ancestor_number[haplotype_ids[ancestor_changes]][order]
+    change_offsets = np.searchsorted(
+        change_ids[ancestor_changes][order], np.arange(len(vocabulary) + 1)
     )
-    return ancestors.iloc[distances.idxmin()]
+
+    closest = []
+    offsets = haplotypes.offsets
+    for descendant in tqdm(np.flatnonzero(is_descendant)):
+        ids = change_ids[offsets[descendant] : offsets[descendant + 1]]
+        shared = np.bincount(
+            np.concatenate(
+                [
+                    change_ancestors[change_offsets[i] : change_offsets[i + 1]]
+                    for i in ids
+                ]
+                or [np.empty(0, dtype=np.int64)]
+            ),
+            minlength=len(ancestor_index),
+        )
+        distances = n_changes[ancestor_index] + n_changes[descendant] - 2 * shared
+        closest.append(ancestor_index[np.argmin(distances)])
+    return np.array(closest, dtype=np.int64)
 
 
 def ancestors(args):
     """Ancestor command main function."""
     data = pd.read_csv(args.input)
-    ancestors = data[data.time == 0]
-    descendants = data[data.time > 0]
+    haplotypes = parse_haplotypes(data.haplotype)
+    is_descendant = (data.time > 0).to_numpy()
 
-    ancestor_haplotypes = ancestors.haplotype.apply(haplotype_to_set)
-    descendant_haplotypes = descendants.haplotype.apply(haplotype_to_set)
-
-    tqdm.pandas()
-    descendant_ancestors = descendant_haplotypes.progress_apply(
-        lambda h: haplotype_to_string(_find_ancestor(h, ancestor_haplotypes))
-    )
-    data["closest_ancestor"] = descendant_ancestors
+    closest = _find_ancestors(haplotypes, (data.time == 0).to_numpy(), is_descendant)
+    strings = np.array(haplotypes.to_strings(), dtype=object)
+    data.loc[is_descendant, "closest_ancestor"] = strings[closest]
     data.to_csv(args.output, index=False)
@@ -8,14 +8,14 @@ import pandas as pd
 from lxml import etree
 
 from ...transform import haplotypes_to_sequences
-from ..utils import write
+from ..utils import read_reference, write
 
 
 def insert_data(args):
     """Insert data into beast xml file."""
 
     data = pd.read_csv(args.input)
-    reference = "".join(open(args.reference).readlines())
+    reference = read_reference(args.reference)
 
     xml = etree.parse(args.template)
     root = xml.getroot()
@@ -5,56 +5,261 @@ target file.
 
 Additionally, print summary statistics of the alignment to log file.
 
+By default the majority changes are found by counting all changes of the reads. With
+`--pileup` the bases aligned to each reference position are counted instead, which
+takes memory proportional to the reference length only and also calls mismatches in
+`M` blocks. Insertions and deletions are ignored in this mode.
+
+With `--confidence` the pileup is built from reads in random order, and reading
+stops as soon as the majority call of every site is decided at that confidence, or
+after `--read-budget` reads. The random order takes an extra pass over the
+alignment to collect the offsets of all reads.
+
+With `--region contig:start-end` only the reads overlapping the region are fetched
+from the indexed alignment and the consensus of the region is written. A reference
+with several contigs requires `--region`.
+
 Original Author: Eva Bons
 """
+
 import logging
+import sys
+from collections import Counter
+from pathlib import Path
+from statistics import NormalDist
 
 import numpy as np
 import pysam
 
-from ..parsers import changes_from_alignment
-from .utils import write
+from ..cache import load_change_cache
+from ..parsers import (
+    PILEUP_BASES,
+    MutationCodes,
+    iter_change_batches,
+    pileup_from_reads,
+)
+from .utils import parse_region, read_alignment_reference, write
 
+CONFIDENCE_BATCH_SIZE = 1_000
 
-def consensus(args):
-    """Consensus command main function."""
-    alignment = pysam.AlignmentFile(args.input, "rb", check_sq=False)
-    with open(args.reference, "r", encoding="utf8") as file_descriptor:
-        reference = "".join(file_descriptor.read().splitlines()[1:])
-    alignment = list(alignment)
-
-    n_seq = len(alignment)
-    changes = changes_from_alignment(reference, alignment)
 
-    logging.info(f"Found {len(changes)} mutations in {n_seq} sequences.")
+def _region_reads(alignment: pysam.AlignmentFile, region: str | None, reference: str):
+    """Get the reads overlapping a region and its window on the reference."""
+    if region is None:
+        return alignment, None
+    contig, start, end = parse_region(region)
+    window = (start, end or len(reference))
+    return alignment.fetch(contig, *window), window
 
-    # Apply quality control
-    mistakes_allowed_per_genome = 0.1
-    p = mistakes_allowed_per_genome / len(reference)
-    quality_threshold = -10 * np.log10(p)
 
-    changes_qc = changes[changes["quality"] > quality_threshold]
-    logging.info(
-        f"Found {len(changes_qc)} mutations with quality > {quality_threshold}."
+def _changes_consensus(args, reference: str, quality_threshold: float) -> str:
+    """Compute the consensus from the majority changes of the reads."""
+    # Stream the alignment and count changes that pass quality control, qualities
+    # are integers and only those above the threshold are extracted
+    n_seq = 0
+    per_mut = Counter()
+    codes = MutationCodes()
+    stats = Counter()
+    batch_options = dict(
+        codes=codes,
+        quality_threshold=int(np.floor(quality_threshold)) + 1,
+        stats=stats,
     )
+    if args.change_cache:
+        cache = load_change_cache(args.input, reference)
+        batches = cache.iter_change_batches(**batch_options)
+    else:
+        alignment = pysam.AlignmentFile(args.input, "rb", check_sq=False)
+        reads, window = _region_reads(alignment, args.region, reference)
+        batches = iter_change_batches(
+            reference, reads, window=window, collapse_identical=True, **batch_options
+        )
+    for batch in batches:
+        changes = batch.changes
+        per_mut.update(
+            changes.groupby([changes.position, changes.mutation.cat.codes])
+            .size()
+            .to_dict()
+        )
+        n_seq += batch.n_reads
+
+    n_changes = stats["changes"]
+    n_changes_qc = n_changes - stats["changes_rejected_quality"]
+    logging.info(f"Found {n_changes} mutations in {n_seq} sequences.")
+    logging.info(f"Found {n_changes_qc} mutations with quality > {quality_threshold}.")
 
     # Get the majority changes
-    per_mut = changes_qc.groupby(["position", "mutation"], as_index=False).count()
-    majority_changes = per_mut[per_mut.seq_id / n_seq > 0.5]
+    majority_changes = sorted(
+        (position, codes.mutations[code])
+        for (position, code), count in per_mut.items()
+        if count / n_seq > 0.5
+    )
     logging.info(f"Found {len(majority_changes)} majority changes.")
 
     # Create the consensus sequence
     consensus = [i for i in reference]
-    for _index, mutation in majority_changes.iterrows():
-        if "->" in mutation.mutation:
-            logging.info(f"{mutation.position}: {mutation.mutation}")
-            consensus[mutation.position] = mutation.mutation[-1]
+    for position, mutation in majority_changes:
+        if "->" in mutation:
+            logging.info(f"{position}: {mutation}")
+            consensus[position] = mutation[-1]
         else:
             raise NotImplementedError(
                 "anything else than point-mutations currently not implemented"
             )
 
-    consensus = "".join(consensus)
+    return "".join(consensus)
+
+
+def _log_pileup_stats(stats: Counter, n_seq: int, quality_threshold: float):
+    """Log the number of aligned bases that pass quality control."""
+    n_bases = stats["bases"]
+    n_bases_qc = n_bases - stats["bases_rejected_quality"]
+    logging.info(f"Found {n_bases} aligned bases in {n_seq} sequences.")
+    logging.info(f"Found {n_bases_qc} bases with quality > {quality_threshold}.")
+
+
+def _majority_consensus(reference: str, counts: np.ndarray, n_seq: int) -> str:
+    """Replace each reference base by the base of more than half of the reads."""
+    bases = np.array(list(PILEUP_BASES))
+    majority = counts.argmax(axis=1)
+    is_majority = counts[np.arange(len(reference)), majority] / max(n_seq, 1) > 0.5
+    consensus = np.array(list(reference))
+    changed = np.flatnonzero(is_majority & (bases[majority] != consensus))
+    logging.info(f"Found {len(changed)} majority changes.")
+
+    for position in changed.tolist():
+        logging.info(f"{position}: {reference[position]}->{bases[majority[position]]}")
+    consensus[changed] = bases[majority[changed]]
+
+    return "".join(consensus)
+
+
+def _pileup_consensus(args, reference: str, quality_threshold: float) -> str:
+    """Compute the consensus from the majority bases at each reference position."""
+    stats = Counter()
+    with pysam.AlignmentFile(args.input, "rb", check_sq=False) as alignment:
+        reads, _window = _region_reads(alignment, args.region, reference)
+        counts, n_seq = pileup_from_reads(
+            len(reference),
+            reads,
+            min_quality=int(np.floor(quality_threshold)) + 1,
+            stats=stats,
+        )
+
+    _log_pileup_stats(stats, n_seq, quality_threshold)
+    return _majority_consensus(reference, counts, n_seq)
+
+
+def _read_offsets(alignment: pysam.AlignmentFile) -> np.ndarray:
+    """Get the virtual offsets of all reads of an alignment."""
+    offsets = []
+    offset = alignment.tell()
+    for _read in alignment:
+        offsets.append(offset)
+        offset = alignment.tell()
+    return np.array(offsets, dtype=np.int64)
+
+
+def _undecided_sites(counts: np.ndarray, n_seq: int, confidence: float) -> np.ndarray:
+    """Get the sites whose majority call is not decided at the given confidence.
+
+    The call of a site is decided when the Wilson score interval of the fraction of
+    reads carrying its most frequent base lies entirely above or below one half.
+    """
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    fraction = counts.max(axis=1) / n_seq
+    center = (fraction + z**2 / (2 * n_seq)) / (1 + z**2 / n_seq)
+    margin = (
+        z
+        / (1 + z**2 / n_seq)
+        * np.sqrt(fraction * (1 - fraction) / n_seq + z**2 / (4 * n_seq**2))
+    )
+    return np.flatnonzero((center - margin <= 0.5) & (center + margin >= 0.5))
+
+
+def _confident_consensus(args, reference: str, quality_threshold: float) -> str:
+    """Compute the pileup consensus from a random subset of the reads.
+
+    Reads are added in random order until the call of every site is decided at
+    `args.confidence`, or `args.read_budget` reads have been consumed.
+    """
+    stats = Counter()
+    counts = np.zeros((len(reference), len(PILEUP_BASES)), dtype=np.int64)
+    n_seq = 0
+    undecided = np.arange(len(reference))
+    with pysam.AlignmentFile(args.input, "rb", check_sq=False) as alignment:
+        offsets = _read_offsets(alignment)
+        rng = np.random.default_rng(args.random_state)
+        rng.shuffle(offsets)
+        if args.read_budget is not None:
+            offsets = offsets[: args.read_budget]
+
+        def _reads(batch_offsets):
+            for offset in batch_offsets.tolist():
+                alignment.seek(offset)
+                yield next(alignment)
+
+        for start in range(0, len(offsets), CONFIDENCE_BATCH_SIZE):
+            batch_counts, batch_n_seq = pileup_from_reads(
+                len(reference),
+                _reads(offsets[start : start + CONFIDENCE_BATCH_SIZE]),
+                min_quality=int(np.floor(quality_threshold)) + 1,
+                stats=stats,
+            )
+            counts += batch_counts
+            n_seq += batch_n_seq
+            undecided = _undecided_sites(counts, n_seq, args.confidence)
+            if not len(undecided):
+                break
+
+    logging.info(f"Consumed {n_seq} of {len(offsets)} reads.")
+    logging.info(
+        f"{len(undecided)} sites are undecided at confidence {args.confidence}."
+    )
+    _log_pileup_stats(stats, n_seq, quality_threshold)
+    return _majority_consensus(reference, counts, n_seq)
+
+
+def consensus(args):
+    """Consensus command main function."""
+    reference = read_alignment_reference(args.reference, args.region)
+
+    if (args.pileup or args.confidence is not None) and args.change_cache:
+        logging.error("The change cache cannot be used with a pileup consensus.")
+        sys.exit(1)
+
+    if args.region is not None and (
+        not isinstance(args.input, Path)
+        or args.change_cache
+        or args.confidence is not None
+    ):
+        logging.error("A region requires an alignment file without cache.")
+        sys.exit(1)
+
+    if args.confidence is not None and not 0 < args.confidence < 1:
+        logging.error("The confidence must be between 0 and 1, e.g. 0.95.")
+        sys.exit(1)
+
+    if args.read_budget is not None and args.read_budget < 1:
+        logging.error("The read budget must be at least 1.")
+        sys.exit(1)
+
+    # Apply quality control
+    mistakes_allowed_per_genome = 0.1
+    p = mistakes_allowed_per_genome / len(reference)
+    quality_threshold = -10 * np.log10(p)
+
+    if args.confidence is not None:
+        consensus = _confident_consensus(args, reference, quality_threshold)
+    elif args.pileup:
+        consensus = _pileup_consensus(args, reference, quality_threshold)
+    else:
+        consensus = _changes_consensus(args, reference, quality_threshold)
+
+    if args.region is not None:
+        _contig, start, end = parse_region(args.region)
+        consensus = consensus[start:end]
+
     formatted_data = f">consensus of {args.output}\n{consensus}"
 
     write(args.output, formatted_data)
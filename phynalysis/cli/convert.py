@@ -16,6 +16,8 @@ from phynalysis.export import (
     write_xml,
 )
 
+from .utils import read_reference
+
 _writers = {
     "fasta": write_fasta,
     "nexus": write_nexus,
@@ -136,7 +138,7 @@ def convert_cmd(args):
             sys.exit(1)
 
     haplotypes_data = pd.read_csv(args.input)
-    reference = "".join(open(args.reference).readlines()[1:])
+    reference = read_reference(args.reference)
 
     convert(
         args.output,
@@ -4,6 +4,7 @@ import logging
 import pandas as pd
 
 from ..transform import haplotype_to_dict, haplotypes_to_matrix
+from .utils import read_reference
 
 
 def changes_from_haplotypes(haplotypes):
@@ -37,8 +38,7 @@ def main(args):
     )
 
     haplotypes_data = pd.read_csv(args.input)
-    with open(args.reference, "r", encoding="utf8") as file_descriptor:
-        reference = "".join(file_descriptor.read().splitlines()[1:])
+    reference = read_reference(args.reference)
 
     sample_groups = haplotypes_data.groupby("barcode")
     merged_haplotypes = sample_groups.apply(merge_haplotypes)
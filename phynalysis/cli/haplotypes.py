@@ -5,18 +5,738 @@ sample.
 
 The output is a CSV file with the following columns:
     - haplotype: Haplotype sequence
+    - block_id: Block id of the last read with this haplotype
     - count: Number of sequences with this haplotype
 
+With `--mutations-output` the mutations of the same pass are written to a second
+CSV file with the following columns:
+    - position, mutation: Mutation
+    - count: Number of sequences with this mutation
+    - frequencies: Fraction of all sequences with this mutation
+    - coverage: Number of sequences covering the position
+    - coverage_frequencies: Fraction of the covering sequences with this mutation
+    - mean_quality: Mean quality of the mutation
+The coverage columns are only written if the reads of one alignment are parsed,
+not with a change cache, collapsed families or `--output-dir`. With `--output-dir`
+a mutations table is also written for each barcode.
+
+Reads are streamed from the alignment in batches, so memory does not grow with the
+number of reads.
+
+With `--threads N` the alignment is split into shards of consecutive reads at BGZF
+virtual offsets, which are processed in a pool of worker processes. The counts of
+all shards are merged in file order, so the output is identical to a single process
+run.
+
+With `--change-cache` all changes are read from a sidecar file next to the
+alignment, which is created on the first run. Later runs with different thresholds
+skip parsing the alignment.
+
+With `--output-dir` the haplotypes of many barcodes are extracted in one pass, from
+several alignments given with `--alignments` (the barcode is the file name up to
+the first dot) and/or from the `--barcode-tag` of the reads. All shards of all
+alignments share one process pool. A table per barcode is written to the output
+directory, and all tables are aggregated into the output file.
+
+With `--region contig:start-end` only the reads overlapping the region are fetched
+from the indexed alignment, and their changes are clipped to the region so that
+identical sub-haplotypes collapse. A reference with several contigs requires
+`--region`, so that all reads are compared with the same contig.
+
+With `--collapse-families majority|quality` the reads of each block id are
+collapsed into one consensus set of changes before haplotypes are counted, see
+`parsers.iter_family_change_batches`. With `--name-sorted` the families are
+streamed from a name sorted alignment.
+
+With `--checkpoint PATH` the partial counts and the virtual offset of the next read
+are saved every `CHECKPOINT_INTERVAL` reads. After an interrupted run `--resume`
+continues from the checkpoint, and the output is identical to an uninterrupted
+run. The checkpoint is removed once the output is written.
+
+With `--error-profile` the coverage, the mismatch, insertion and deletion counts and
+a histogram of the change qualities of each position are accumulated while the
+reads are parsed. They are written next to the output as `<output>.profile.npz`
+and `<output>.profile.csv`, which helps to choose `--quality-threshold`.
+
+With `--max-reads N` at most N reads are reservoir sampled with `--random-state`
+before any read is parsed. With `--stratify block_id|read_group` the reads of each
+block id or read group are sampled in proportion to their number, which takes an
+extra pass over the alignment to count them.
+
+With `--approximate-top K` only the K most abundant haplotypes are reported, with
+approximate counts from a Space-Saving sketch of `SKETCH_FACTOR * K` haplotypes.
+The output gains a "count_error" column that bounds the error of each count, and a
+"tail" row with the reads of all other haplotypes.
+
 Original author: Eva Bons
 """
 
 import logging
+import os
+import pickle
+import sys
 from collections import Counter
+from hashlib import blake2b, sha1
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import pysam
 
-from ..parsers import changes_from_alignment
+from ..cache import ChangeCache, load_change_cache
+from ..parsers import (
+    ErrorProfile,
+    MutationCodes,
+    count_read_strata,
+    iter_change_batches,
+    iter_family_change_batches,
+    sample_reads,
+)
+from .utils import parse_region, read_alignment_reference
+
+SHARD_SIZE = 10_000
+SKETCH_FACTOR = 10
+CHECKPOINT_INTERVAL = 100_000
+
+
+_HASH_SEEDS = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xD1B54A32D192ED03))
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """Mix bits of 64-bit integers (splitmix64 finalizer)."""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _mutation_hash(mutation: str) -> int:
+    """Hash of a mutation that is stable between processes."""
+    return int.from_bytes(blake2b(mutation.encode(), digest_size=8).digest(), "little")
+
+
+class _HaplotypeCounts:
+    """Haplotype and mutation counts of a set of reads.
+
+    Haplotypes are keyed by a 128-bit hash of their (position, mutation) pairs. The
+    hash of a mutation is derived from its string, so keys agree between processes
+    with different mutation codes. Each haplotype keeps the changes of its first
+    read, which are only rendered to a string for the output.
+
+    Counts of consecutive sets of reads are merged with `merge`, which keeps the
+    order in which haplotypes were first seen.
+    """
+
+    def __init__(self):
+        self.n_seq = 0
+        self.n_consensus = 0
+        self.codes = MutationCodes()
+        self.haplotypes = Counter()
+        self.block_ids = {}
+        self.changes = {}
+        self.mutations = Counter()
+        self.mutation_qualities = Counter()
+        self.stats = Counter()
+        self.profile = None
+        # overestimation of approximate counts, see `_TopHaplotypeCounts`
+        self.floor = 0
+        self.errors = {}
+        self._mutation_hashes = np.empty(0, dtype=np.uint64)
+
+    def _hash_changes(self, positions: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Hash each (position, mutation) pair to two 64-bit integers."""
+        if len(self._mutation_hashes) < len(self.codes):
+            self._mutation_hashes = np.array(
+                [_mutation_hash(mutation) for mutation in self.codes.mutations],
+                dtype=np.uint64,
+            )
+        values = _mix(positions.astype(np.uint64) ^ _mix(self._mutation_hashes[codes]))
+        return np.stack([_mix(values + seed) for seed in _HASH_SEEDS], axis=1)
+
+    def add(self, changes: pd.DataFrame, n_seq: int):
+        """Add the changes of `n_seq` reads.
+
+        The mutation codes of `changes` must belong to `self.codes`.
+        """
+        seq_ids = changes.seq_id.to_numpy()
+        positions = changes.position.to_numpy()
+        codes = changes.mutation.cat.codes.to_numpy()
+        block_ids = changes.block_id.to_numpy()
+
+        # the changes of each read are consecutive
+        starts = np.flatnonzero(np.diff(seq_ids, prepend=-1))
+        ends = np.append(starts[1:], len(seq_ids))
+
+        self.n_seq += n_seq
+        self.n_consensus += n_seq - len(starts)
+
+        # count mutations and sum their qualities on integer keys
+        groups = changes.quality.astype(np.int64).groupby(
+            [changes.position, changes.mutation.cat.codes]
+        )
+        sizes, qualities = groups.size(), groups.sum()
+        self.mutations.update(dict(zip(sizes.index.tolist(), sizes.tolist())))
+        self.mutation_qualities.update(
+            dict(zip(qualities.index.tolist(), qualities.tolist()))
+        )
+
+        if not len(starts):
+            return
+
+        # the sum of change hashes does not depend on the order of the changes
+        keys = np.add.reduceat(self._hash_changes(positions, codes), starts, axis=0)
+        unique_keys, first, counts = np.unique(
+            keys, axis=0, return_index=True, return_counts=True
+        )
+        _, last = np.unique(keys[::-1], axis=0, return_index=True)
+        last = len(keys) - 1 - last
+
+        for index in np.argsort(first).tolist():
+            key = tuple(unique_keys[index].tolist())
+            if key not in self.haplotypes:
+                start, end = starts[first[index]], ends[first[index]]
+                # copies, so that the arrays of the batch are not kept alive
+                self.changes[key] = (
+                    positions[start:end].copy(),
+                    codes[start:end].copy(),
+                )
+            self.haplotypes[key] += int(counts[index])
+            self.block_ids[key] = block_ids[starts[last[index]]]
+
+    def merge(self, other: "_HaplotypeCounts"):
+        """Merge the counts of the reads following this set of reads."""
+        recode = np.array(
+            [self.codes.encode(mutation) for mutation in other.codes.mutations],
+            dtype=np.int32,
+        )
+
+        self.n_seq += other.n_seq
+        self.n_consensus += other.n_consensus
+        for (position, code), count in other.mutations.items():
+            self.mutations[(position, recode[code].item())] += count
+        for (position, code), quality in other.mutation_qualities.items():
+            self.mutation_qualities[(position, recode[code].item())] += quality
+        for key, count in other.haplotypes.items():
+            if key not in self.haplotypes:
+                positions, codes = other.changes[key]
+                self.changes[key] = (positions, recode[codes].copy())
+            self.haplotypes[key] += count
+        self.block_ids.update(other.block_ids)
+        self.stats.update(other.stats)
+        if other.profile is not None:
+            if self.profile is None:
+                self.profile = ErrorProfile(len(other.profile))
+            self.profile.merge(other.profile)
+
+    def _render(self, key: tuple[int, int]) -> str:
+        """Render a haplotype as string."""
+        positions, codes = self.changes[key]
+        return ";".join(
+            sorted(
+                f"{position}:{self.codes.mutations[code]}"
+                for position, code in zip(positions.tolist(), codes.tolist())
+            )
+        )
+
+    def mutations_frame(self) -> pd.DataFrame:
+        """Get the mutation frequencies.
+
+        The frequencies are relative to all reads. If an error profile was
+        accumulated, the "coverage" of each position and the
+        "coverage_frequencies" relative to the reads covering the position are
+        added. Insertions after the last position use the coverage of that
+        position.
+        """
+        mutations = pd.DataFrame(
+            sorted(
+                (
+                    position,
+                    self.codes.mutations[code],
+                    count,
+                    self.mutation_qualities[(position, code)] / count,
+                )
+                for (position, code), count in self.mutations.items()
+            ),
+            columns=["position", "mutation", "count", "mean_quality"],
+        )
+        mutations.insert(3, "frequencies", mutations["count"] / self.n_seq)
+        if self.profile is not None and len(self.profile):
+            positions = np.minimum(mutations.position, len(self.profile) - 1)
+            coverage = self.profile.coverage[positions]
+            mutations.insert(4, "coverage", coverage)
+            mutations.insert(
+                5, "coverage_frequencies", mutations["count"] / np.maximum(coverage, 1)
+            )
+        mutations.sort_values("frequencies", inplace=True, ascending=False)
+        return mutations
+
+    def haplotypes_frame(self) -> pd.DataFrame:
+        """Get the haplotype counts."""
+        logging.info("Found %s haplotypes.", len(self.haplotypes) + 1)
+
+        # create the haplotype dataframe, strings are only rendered for the unique
+        # haplotypes
+        haplotypes = pd.DataFrame(
+            (
+                (self._render(key), self.block_ids[key], count)
+                for key, count in self.haplotypes.items()
+            ),
+            columns=["haplotype", "block_id", "count"],
+        )
+
+        # add consensus haplotype because it does not contain any changes
+        haplotypes.loc[len(haplotypes)] = ["consensus", None, self.n_consensus]
+        haplotypes.sort_values("count", inplace=True, ascending=False)
+
+        # filter haplotypes with zero count
+        return haplotypes.query("count > 0")
+
+
+class _TopHaplotypeCounts(_HaplotypeCounts):
+    """Approximate counts of the most abundant haplotypes in bounded memory.
+
+    A Space-Saving sketch keeps at most `SKETCH_FACTOR * top` haplotypes. When the
+    sketch overflows, the haplotypes with the lowest counts are evicted and
+    `floor` is raised to the highest evicted count. A haplotype that enters the
+    sketch starts at `floor`, so each count overestimates the true count by at
+    most its entry in `errors`. Mutation counts stay exact.
+    """
+
+    def __init__(self, top: int):
+        super().__init__()
+        self.top = top
+        self.capacity = SKETCH_FACTOR * top
+
+    def add(self, changes: pd.DataFrame, n_seq: int):
+        n_known = len(self.haplotypes)
+        super().add(changes, n_seq)
+        # new haplotypes are appended to the counter
+        for key in list(islice(self.haplotypes, n_known, None)):
+            self.haplotypes[key] += self.floor
+            self.errors[key] = self.floor
+        self._evict()
+
+    def merge(self, other: _HaplotypeCounts):
+        known = set(self.haplotypes)
+        super().merge(other)
+        for key in self.haplotypes:
+            if key not in known:
+                self.haplotypes[key] += self.floor
+                self.errors[key] = self.floor + other.errors.get(key, 0)
+            elif key in other.haplotypes:
+                self.errors[key] += other.errors.get(key, 0)
+            else:
+                # the haplotype may have been evicted from the other counts
+                self.haplotypes[key] += other.floor
+                self.errors[key] += other.floor
+        self.floor += other.floor
+        self._evict()
+
+    def _evict(self):
+        """Evict the haplotypes with the lowest counts beyond the capacity."""
+        if len(self.haplotypes) <= self.capacity:
+            return
+        counts = np.fromiter(self.haplotypes.values(), dtype=np.int64)
+        order = np.argsort(-counts, kind="stable")
+        self.floor = max(self.floor, counts[order[self.capacity]].item())
+        keys = list(self.haplotypes)
+        for index in order[self.capacity :].tolist():
+            key = keys[index]
+            del self.haplotypes[key], self.changes[key], self.block_ids[key]
+            del self.errors[key]
+
+    def haplotypes_frame(self) -> pd.DataFrame:
+        """Get the approximate counts of the top haplotypes.
+
+        The "count_error" column bounds the error of each count. The reads of all
+        other haplotypes are counted in a "tail" row, so the counts add up to the
+        number of reads. The tail is underestimated by at most the summed errors
+        of the top haplotypes.
+        """
+        logging.info(
+            "Kept %s haplotypes, counts are overestimated by at most %s.",
+            len(self.haplotypes),
+            self.floor,
+        )
+        top = self.haplotypes.most_common(self.top)
+        haplotypes = pd.DataFrame(
+            (
+                (self._render(key), self.block_ids[key], count, self.errors[key])
+                for key, count in top
+            ),
+            columns=["haplotype", "block_id", "count", "count_error"],
+        )
+        n_tail = self.n_seq - self.n_consensus - sum(count for _key, count in top)
+        haplotypes.loc[len(haplotypes)] = ["consensus", None, self.n_consensus, 0]
+        tail_error = sum(self.errors[key] for key, _count in top)
+        haplotypes.loc[len(haplotypes)] = ["tail", None, max(n_tail, 0), tail_error]
+        haplotypes.sort_values("count", inplace=True, ascending=False)
+        return haplotypes.query("count > 0")
+
+
+def _new_counts(top: int | None) -> _HaplotypeCounts:
+    """Create exact counts, or approximate counts of the `top` haplotypes."""
+    return _HaplotypeCounts() if top is None else _TopHaplotypeCounts(top)
+
+
+def _count_reads(
+    reference: str,
+    reads,
+    length_threshold: int,
+    quality_threshold: int,
+    window: tuple[int, int] | None = None,
+    family_vote: str | None = None,
+    name_sorted: bool = False,
+    error_profile: bool = False,
+    top: int | None = None,
+) -> _HaplotypeCounts:
+    """Count haplotypes and mutations in reads.
+
+    Both thresholds are pushed down into the extraction of the changes, and
+    identical reads are only decoded once. With `family_vote` the read families
+    are collapsed before they are counted. With `error_profile` the error profile
+    of the reads is accumulated in `profile`. With `top` only the most abundant
+    haplotypes are counted approximately.
+    """
+    counts = _new_counts(top)
+    if error_profile:
+        counts.profile = ErrorProfile(len(reference))
+    if family_vote is not None:
+        batches = iter_family_change_batches(
+            reference,
+            reads,
+            vote=family_vote,
+            name_sorted=name_sorted,
+            codes=counts.codes,
+            length_threshold=length_threshold,
+            quality_threshold=quality_threshold,
+            stats=counts.stats,
+        )
+    else:
+        batches = iter_change_batches(
+            reference,
+            reads,
+            codes=counts.codes,
+            length_threshold=length_threshold,
+            quality_threshold=quality_threshold,
+            stats=counts.stats,
+            window=window,
+            collapse_identical=True,
+            profile=counts.profile,
+        )
+    for batch in batches:
+        counts.add(batch.changes, batch.n_reads)
+    return counts
+
+
+def _count_cache(
+    cache: ChangeCache,
+    length_threshold: int,
+    quality_threshold: int,
+    top: int | None = None,
+) -> _HaplotypeCounts:
+    """Count haplotypes and mutations in a change cache."""
+    counts = _new_counts(top)
+    batches = cache.iter_change_batches(
+        codes=counts.codes,
+        length_threshold=length_threshold,
+        quality_threshold=quality_threshold,
+        stats=counts.stats,
+    )
+    for batch in batches:
+        counts.add(batch.changes, batch.n_reads)
+    return counts
+
+
+def _shard_alignment(path: Path, shard_size: int) -> list[tuple[int, int]]:
+    """Split alignment into shards of consecutive reads.
+
+    Returns
+    -------
+    list[tuple[int, int]]
+        Virtual offset of the first read and number of reads for each shard.
+    """
+    shards = []
+    with pysam.AlignmentFile(path, "rb", check_sq=False) as alignment:
+        offset = alignment.tell()
+        n_reads = 0
+        for _read in alignment:
+            n_reads += 1
+            if n_reads == shard_size:
+                shards.append((offset, n_reads))
+                offset = alignment.tell()
+                n_reads = 0
+    if n_reads:
+        shards.append((offset, n_reads))
+    return shards
+
+
+def _count_shard(
+    path: Path,
+    reference: str,
+    length_threshold: int,
+    quality_threshold: int,
+    error_profile: bool,
+    shard: tuple[int, int],
+) -> _HaplotypeCounts:
+    """Count haplotypes and mutations in a shard of the alignment."""
+    offset, n_reads = shard
+    with pysam.AlignmentFile(path, "rb", check_sq=False) as alignment:
+        alignment.seek(offset)
+        reads = islice(alignment, n_reads)
+        return _count_reads(
+            reference,
+            reads,
+            length_threshold,
+            quality_threshold,
+            error_profile=error_profile,
+        )
+
+
+def _parses_reads(args) -> bool:
+    """Whether the changes are parsed from single reads of one alignment."""
+    return not (
+        args.change_cache
+        or args.output_dir is not None
+        or args.collapse_families is not None
+    )
+
+
+def _needs_error_profile(args) -> bool:
+    """Whether an error profile is accumulated.
+
+    The mutations output takes the coverage of each position from the profile if
+    the reads are parsed, see `_parses_reads`.
+    """
+    return args.error_profile or (
+        args.mutations_output is not None and _parses_reads(args)
+    )
+
+
+def _checkpoint_key(args, reference: str) -> dict:
+    """Key of the input and options of a checkpoint."""
+    stat = args.input.stat()
+    return {
+        "input": str(args.input.resolve()),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "reference": sha1(reference.encode("ascii")).hexdigest(),
+        "length_threshold": args.length_threshold,
+        "quality_threshold": args.quality_threshold,
+        "error_profile": _needs_error_profile(args),
+        "approximate_top": args.approximate_top,
+    }
+
+
+def _save_checkpoint(path: Path, key: dict, counts: _HaplotypeCounts, offset: int):
+    """Save the counts and the offset of the next read, replacing the checkpoint."""
+    partial_path = path.with_name(path.name + ".partial")
+    with open(partial_path, "wb") as file_descriptor:
+        pickle.dump({"key": key, "counts": counts, "offset": offset}, file_descriptor)
+    os.replace(partial_path, path)
+
+
+def _count_with_checkpoints(args, reference: str) -> _HaplotypeCounts:
+    """Count haplotypes and mutations, saving a checkpoint after every segment.
+
+    The alignment is counted in segments of `CHECKPOINT_INTERVAL` reads, which are
+    merged in file order like shards, so the output does not depend on where a run
+    was resumed.
+    """
+    key = _checkpoint_key(args, reference)
+    counts, offset = _new_counts(args.approximate_top), None
+    if args.resume and args.checkpoint.exists():
+        with open(args.checkpoint, "rb") as file_descriptor:
+            checkpoint = pickle.load(file_descriptor)
+        if checkpoint["key"] != key:
+            logging.error("Checkpoint %s does not match the input.", args.checkpoint)
+            sys.exit(1)
+        counts, offset = checkpoint["counts"], checkpoint["offset"]
+        logging.info(
+            "Resuming from checkpoint %s after %s reads.",
+            args.checkpoint,
+            counts.stats["reads"],
+        )
+
+    with pysam.AlignmentFile(args.input, "rb", check_sq=False) as alignment:
+        if offset is not None:
+            alignment.seek(offset)
+        while True:
+            segment = _count_reads(
+                reference,
+                islice(alignment, CHECKPOINT_INTERVAL),
+                args.length_threshold,
+                args.quality_threshold,
+                error_profile=_needs_error_profile(args),
+                top=args.approximate_top,
+            )
+            if not segment.stats["reads"]:
+                break
+            counts.merge(segment)
+            _save_checkpoint(args.checkpoint, key, counts, alignment.tell())
+
+    return counts
+
+
+def _barcode_from_path(path: Path) -> str:
+    """Get the barcode of an alignment from its file name."""
+    return path.name.split(".")[0]
+
+
+def _count_shard_barcodes(
+    reference: str,
+    length_threshold: int,
+    quality_threshold: int,
+    barcode_tag: str | None,
+    task: tuple[Path, str, tuple[int, int]],
+) -> tuple[dict[str, _HaplotypeCounts], int]:
+    """Count haplotypes and mutations of each barcode in a shard of an alignment.
+
+    Returns
+    -------
+    tuple[dict[str, _HaplotypeCounts], int]
+        Counts of each barcode and the number of reads without barcode tag.
+    """
+    path, barcode, (offset, n_reads) = task
+    with pysam.AlignmentFile(path, "rb", check_sq=False) as alignment:
+        alignment.seek(offset)
+        reads = islice(alignment, n_reads)
+        if barcode_tag is None:
+            counts = _count_reads(reference, reads, length_threshold, quality_threshold)
+            return {barcode: counts}, 0
+
+        # route the reads of the shard by their tag
+        barcode_reads = {}
+        n_untagged = 0
+        for read in reads:
+            if read.has_tag(barcode_tag):
+                barcode_reads.setdefault(str(read.get_tag(barcode_tag)), []).append(
+                    read
+                )
+            else:
+                n_untagged += 1
+
+    return {
+        barcode: _count_reads(reference, reads, length_threshold, quality_threshold)
+        for barcode, reads in barcode_reads.items()
+    }, n_untagged
+
+
+def _demultiplex(args, reference: str):
+    """Count and write the haplotypes of each barcode in one pass."""
+    inputs = [args.input, *args.alignments]
+    tasks = [
+        (path, _barcode_from_path(path), shard)
+        for path in inputs
+        for shard in _shard_alignment(path, SHARD_SIZE)
+    ]
+    count_shard = partial(
+        _count_shard_barcodes,
+        reference,
+        args.length_threshold,
+        args.quality_threshold,
+        args.barcode_tag,
+    )
+
+    logging.info(
+        "Computing mutations of %s alignments in %s shards with %s threads...",
+        len(inputs),
+        len(tasks),
+        args.threads,
+    )
+    counts = {}
+    n_untagged = 0
+    with ProcessPoolExecutor(args.threads) as executor:
+        # shards are merged in file order to keep the output deterministic
+        pool_map = executor.map if args.threads > 1 else map
+        for shard_counts, shard_untagged in pool_map(count_shard, tasks):
+            for barcode, barcode_counts in shard_counts.items():
+                counts.setdefault(barcode, _new_counts(args.approximate_top)).merge(
+                    barcode_counts
+                )
+            n_untagged += shard_untagged
+
+    if args.barcode_tag is not None:
+        logging.info("Skipped %s reads without %s tag.", n_untagged, args.barcode_tag)
+    if not counts:
+        logging.error("No reads with a barcode were found.")
+        sys.exit(1)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    tables = []
+    mutation_tables = []
+    for barcode, barcode_counts in counts.items():
+        if args.mutations_output is not None:
+            mutations = barcode_counts.mutations_frame()
+            output = args.output_dir / f"{barcode}.mutations.csv"
+            logging.info("Writing file %s...", output)
+            mutations.to_csv(output, index=False)
+            mutation_tables.append(mutations.reset_index(drop=True))
+
+        logging.info("Computing haplotypes of barcode %s...", barcode)
+        haplotypes = barcode_counts.haplotypes_frame()
+        output = args.output_dir / f"{barcode}.haplotypes.csv"
+        logging.info("Writing file %s...", output)
+        haplotypes.to_csv(output, index=False)
+        tables.append(haplotypes.reset_index(drop=True))
+
+    # same layout as the aggregate subcommand without the barcode annotations
+    aggregated = pd.concat(tables, keys=list(counts))
+    aggregated.index.names = ["barcode", "local_id"]
+    logging.info("Writing file %s...", args.output)
+    aggregated.reset_index().to_csv(args.output, index=False)
+
+    if args.mutations_output is not None:
+        aggregated = pd.concat(mutation_tables, keys=list(counts))
+        aggregated.index.names = ["barcode", "local_id"]
+        logging.info("Writing file %s...", args.mutations_output)
+        aggregated.reset_index().to_csv(args.mutations_output, index=False)
+
+
+def _region_reads(args, alignment: pysam.AlignmentFile, reference: str):
+    """Get the reads of the alignment, or only those overlapping the region.
+
+    Returns
+    -------
+    tuple
+        Reads and the window of the region, or None.
+    """
+    if args.region is None:
+        return alignment, None
+
+    contig, start, end = parse_region(args.region)
+    window = (start, end or len(reference))
+    return alignment.fetch(contig, *window), window
+
+
+def _sample_reads(args, reference: str, reads) -> list[pysam.AlignedSegment]:
+    """Sample at most `max_reads` reads, optionally stratified.
+
+    Stratified sampling takes a first pass over the reads to count the strata.
+    """
+    strata = None
+    if args.stratify is not None:
+        logging.info("Counting reads by %s...", args.stratify)
+        with pysam.AlignmentFile(args.input, "rb", check_sq=False) as alignment:
+            strata = count_read_strata(
+                _region_reads(args, alignment, reference)[0], args.stratify
+            )
+        logging.info("Found %s strata.", len(strata))
+
+    logging.info("Sampling at most %s reads...", args.max_reads)
+    stats = Counter()
+    reads = sample_reads(
+        reads,
+        args.max_reads,
+        random_state=args.random_state,
+        stratify=args.stratify,
+        strata=strata,
+        stats=stats,
+    )
+    logging.info("Sampled %s of %s reads.", len(reads), stats["reads_before_sampling"])
+    return reads
 
 
 def haplotypes(args):
@@ -27,71 +747,188 @@ def haplotypes(args):
         args.length_threshold,
     )
     logging.info("Reading reference...")
-    with open(args.reference, "r", encoding="utf8") as file_descriptor:
-        reference = "".join(file_descriptor.read().splitlines()[1:])
+    reference = read_alignment_reference(args.reference, args.region)
+
+    if args.threads < 1:
+        logging.error("The number of threads must be at least 1.")
+        sys.exit(1)
 
-    logging.info("Reading alignment...")
-    alignment = pysam.AlignmentFile(args.input, "rb", check_sq=False)
+    if args.change_cache and not isinstance(args.input, Path):
+        logging.error("The change cache requires an alignment file as input.")
+        sys.exit(1)
 
-    if args.length_threshold:
-        logging.info("Filtering reads by length...")
-        alignment = filter(
-            lambda read: abs(read.reference_length - read.query_length)
-            < args.length_threshold,
-            alignment,
+    if args.region is not None and (
+        not isinstance(args.input, Path)
+        or args.threads > 1
+        or args.change_cache
+        or args.output_dir is not None
+    ):
+        logging.error("A region requires a single alignment file and process.")
+        sys.exit(1)
+
+    if args.collapse_families is not None and (
+        not isinstance(args.input, Path)
+        or args.threads > 1
+        or args.change_cache
+        or args.output_dir is not None
+        or args.region is not None
+    ):
+        logging.error("Read families can only be collapsed in a single full pass.")
+        sys.exit(1)
+
+    if args.approximate_top is not None and args.approximate_top < 1:
+        logging.error("The number of approximate top haplotypes must be at least 1.")
+        sys.exit(1)
+
+    if args.max_reads is not None and args.max_reads < 1:
+        logging.error("The maximum number of reads must be at least 1.")
+        sys.exit(1)
+
+    if args.max_reads is not None and (
+        args.threads > 1
+        or args.change_cache
+        or args.output_dir is not None
+        or args.checkpoint is not None
+    ):
+        logging.error("Subsampling requires a single alignment and process.")
+        sys.exit(1)
+
+    if args.stratify is not None and (
+        args.max_reads is None or not isinstance(args.input, Path)
+    ):
+        logging.error(
+            "Stratified subsampling requires an alignment file and --max-reads."
         )
+        sys.exit(1)
 
-    alignment = list(alignment)
-    n_seq = len(alignment)
+    if args.resume and args.checkpoint is None:
+        logging.error("Resuming requires a checkpoint.")
+        sys.exit(1)
 
-    logging.info("Computing mutations...")
-    changes = changes_from_alignment(
-        reference,
-        alignment,
-    )
+    if args.checkpoint is not None and (
+        not isinstance(args.input, Path)
+        or args.threads > 1
+        or args.change_cache
+        or args.output_dir is not None
+        or args.region is not None
+        or args.collapse_families is not None
+    ):
+        logging.error("Checkpoints require a single full pass over one alignment.")
+        sys.exit(1)
+
+    if args.error_profile and (
+        not isinstance(args.output, Path) or not _parses_reads(args)
+    ):
+        logging.error("--error-profile requires reads and an output file.")
+        sys.exit(1)
+    error_profile = _needs_error_profile(args)
+
+    if args.output_dir is not None:
+        if not isinstance(args.input, Path) or args.change_cache:
+            logging.error("Demultiplexing requires alignment files without cache.")
+            sys.exit(1)
 
-    if args.quality_threshold > 0:
-        logging.info("Filtering mutations by quality...")
-        changes = changes.query("quality >= @args.quality_threshold")
+        _demultiplex(args, reference)
+        return
+    elif args.alignments or args.barcode_tag is not None:
+        logging.error("Multiple barcodes require an output directory.")
+        sys.exit(1)
+
+    if args.change_cache:
+        cache = load_change_cache(args.input, reference)
+
+        logging.info("Computing mutations from change cache...")
+        counts = _count_cache(
+            cache,
+            args.length_threshold,
+            args.quality_threshold,
+            top=args.approximate_top,
+        )
+    elif args.checkpoint is not None:
+        logging.info("Computing mutations with checkpoints in %s...", args.checkpoint)
+        counts = _count_with_checkpoints(args, reference)
+    elif args.threads > 1:
+        if not isinstance(args.input, Path):
+            logging.error("Multiple threads require an alignment file as input.")
+            sys.exit(1)
+
+        logging.info("Sharding alignment...")
+        shards = _shard_alignment(args.input, SHARD_SIZE)
+
+        logging.info(
+            "Computing mutations in %s shards with %s threads...",
+            len(shards),
+            args.threads,
+        )
+        counts = _new_counts(args.approximate_top)
+        count_shard = partial(
+            _count_shard,
+            args.input,
+            reference,
+            args.length_threshold,
+            args.quality_threshold,
+            error_profile,
+        )
+        with ProcessPoolExecutor(args.threads) as executor:
+            # shards are merged in file order to keep the output deterministic
+            for shard_counts in executor.map(count_shard, shards):
+                counts.merge(shard_counts)
+    else:
+        logging.info("Reading alignment...")
+        with pysam.AlignmentFile(args.input, "rb", check_sq=False) as alignment:
+            reads, window = _region_reads(args, alignment, reference)
+            if args.max_reads is not None:
+                reads = _sample_reads(args, reference, reads)
+
+            logging.info("Computing mutations...")
+            counts = _count_reads(
+                reference,
+                reads,
+                args.length_threshold,
+                args.quality_threshold,
+                window=window,
+                family_vote=args.collapse_families,
+                name_sorted=args.name_sorted,
+                error_profile=error_profile,
+                top=args.approximate_top,
+            )
+
+    stats = counts.stats
+    if args.collapse_families is not None:
+        logging.info(
+            "Collapsed reads into %s families by %s vote.",
+            stats["families"],
+            args.collapse_families,
+        )
+    logging.info(
+        "Rejected %s of %s reads by length.",
+        stats["reads_rejected_length"],
+        stats["reads"],
+    )
+    logging.info(
+        "Rejected %s of %s mutations by quality.",
+        stats["changes_rejected_quality"],
+        stats["changes"],
+    )
 
     logging.info("Reformatting mutations...")
-    counts = changes.groupby(["position", "mutation"], as_index=False).count()
-    counts["frequencies"] = counts.seq_id / n_seq
-    mutations = counts.drop(["seq_id", "quality"], axis=1)
-    mutations.sort_values("frequencies", inplace=True, ascending=False)
+    mutations = counts.mutations_frame()
     logging.info("Found %s mutations.", len(mutations))
 
-    logging.info("Computing haplotypes...")
-    haplotype_counter = Counter()
-    haplotype_block_ids = {}
-
-    # reconstruct all haplotypes from mutations
-    for group in changes.groupby("seq_id"):
-        haplotype = sorted(
-            list(group[1].position.astype(str) + ":" + group[1].mutation)
-        )
-        haplotype = ";".join(haplotype)
-        haplotype_counter[haplotype] += 1
-        haplotype_block_ids[haplotype] = group[1].block_id.iloc[0]
-
-    # add consensus haplotype because it does not contain any changes
-    haplotype_counter["consensus"] = n_seq - changes.seq_id.unique().size
-    haplotype_block_ids["consensus"] = None
-
-    logging.info("Found %s haplotypes.", len(haplotype_counter))
-
-    # create the haplotype dataframe
-    haplotypes = pd.DataFrame(
-        (
-            (ht, haplotype_block_ids[ht], count)
-            for ht, count in haplotype_counter.items()
-        ),
-        columns=["haplotype", "block_id", "count"],
-    )
-    haplotypes.sort_values("count", inplace=True, ascending=False)
+    if args.mutations_output is not None:
+        logging.info("Writing file %s...", args.mutations_output)
+        mutations.to_csv(args.mutations_output, index=False)
 
-    # filter haplotypes with zero count
-    haplotypes = haplotypes.query("count > 0")
+    logging.info("Computing haplotypes...")
+    haplotypes = counts.haplotypes_frame()
 
     logging.info("Writing file %s...", args.output)
     haplotypes.to_csv(args.output, index=False)
+
+    if args.error_profile:
+        profile_path = args.output.with_suffix(".profile.npz")
+        logging.info("Writing error profile %s...", profile_path)
+        counts.profile.save(profile_path)
+
+    if args.checkpoint is not None:
+        args.checkpoint.unlink(missing_ok=True)
@@ -5,6 +5,7 @@ import sys
 from collections import defaultdict
 from pathlib import Path
 
+from ..parsers import FAMILY_VOTES, READ_STRATA
 from . import beast_xml
 
 from .aggregate import aggregate
@@ -214,6 +215,100 @@ def main():
         default=100,
         help="Length threshold",
     )
+    haplotypes_parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of worker processes.",
+    )
+    haplotypes_parser.add_argument(
+        "--change-cache",
+        action="store_true",
+        help="Read changes from a cache next to the alignment and create it if needed.",
+    )
+    haplotypes_parser.add_argument(
+        "--alignments",
+        nargs="+",
+        type=Path,
+        default=[],
+        help="Additional alignment files, one per barcode.",
+    )
+    haplotypes_parser.add_argument(
+        "--barcode-tag",
+        type=str,
+        default=None,
+        help="Tag of the reads that holds their barcode, e.g. RG.",
+    )
+    haplotypes_parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=None,
+        help="Directory of the haplotype tables of each barcode.",
+    )
+    haplotypes_parser.add_argument(
+        "--region",
+        type=str,
+        default=None,
+        help="Only use reads overlapping a region, e.g. contig:start-end.",
+    )
+    haplotypes_parser.add_argument(
+        "--collapse-families",
+        choices=FAMILY_VOTES,
+        default=None,
+        help="Collapse reads with the same block id by a vote before counting.",
+    )
+    haplotypes_parser.add_argument(
+        "--name-sorted",
+        action="store_true",
+        help="The reads of each block id are consecutive, e.g. sorted by name.",
+    )
+    haplotypes_parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=None,
+        help="File to which the partial counts are saved periodically.",
+    )
+    haplotypes_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue from the checkpoint if it exists.",
+    )
+    haplotypes_parser.add_argument(
+        "--error-profile",
+        action="store_true",
+        help="Write the coverage and error profile of each position next to the output.",
+    )
+    haplotypes_parser.add_argument(
+        "--mutations-output",
+        type=Path,
+        default=None,
+        help="Mutations output file.",
+    )
+    haplotypes_parser.add_argument(
+        "--approximate-top",
+        type=int,
+        default=None,
+        metavar="K",
+        help="Only count the K most abundant haplotypes approximately.",
+    )
+    haplotypes_parser.add_argument(
+        "--max-reads",
+        type=int,
+        default=None,
+        help="Maximum number of reads, sampled uniformly from the alignment.",
+    )
+    haplotypes_parser.add_argument(
+        "--stratify",
+        choices=READ_STRATA,
+        default=None,
+        help="Sample the reads of each block id or read group proportionally.",
+    )
+    haplotypes_parser.add_argument(
+        "--random-state",
+        type=int,
+        default=42,
+        help="Random state of the read sampling.",
+    )
     haplotypes_parser.set_defaults(func=haplotypes)
 
     filter_parser = subparsers.add_parser(
@@ -234,6 +329,43 @@ def main():
         help="Compute a consensus sequence.",
         parents=[common_parser, reference_parser, log_parser],
     )
+    consensus_parser.add_argument(
+        "--change-cache",
+        action="store_true",
+        help="Read changes from a cache next to the alignment and create it if needed.",
+    )
+    consensus_parser.add_argument(
+        "--pileup",
+        action="store_true",
+        help="Call the majority base of each position from a pileup of the reads.",
+    )
+    consensus_parser.add_argument(
+        "--confidence",
+        type=float,
+        default=None,
+        help=(
+            "Stop reading once all pileup calls are decided at this confidence, "
+            "between 0 and 1. Takes an extra pass over the alignment."
+        ),
+    )
+    consensus_parser.add_argument(
+        "--read-budget",
+        type=int,
+        default=None,
+        help="Maximum number of reads used with --confidence.",
+    )
+    consensus_parser.add_argument(
+        "--random-state",
+        type=int,
+        default=42,
+        help="Random state of the read order used with --confidence.",
+    )
+    consensus_parser.add_argument(
+        "--region",
+        type=str,
+        default=None,
+        help="Only use reads overlapping a region, e.g. contig:start-end.",
+    )
     consensus_parser.set_defaults(func=consensus)
 
     ancestors_parser = subparsers.add_parser(
@@ -1,7 +1,12 @@
 """Cli utility functions."""
 
+import logging
+import re
+import sys
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable
+
+from ..reference import load_reference
 
 
 def write(file: Any, data: str):
@@ -11,3 +16,96 @@ def write(file: Any, data: str):
             file_descriptor.write(data)
     else:
         file.write(data)
+
+
+def write_chunks(file: Any, chunks: Iterable[str]):
+    """Write file to output chunk by chunk."""
+    if isinstance(file, str | Path):
+        with open(file, "w", encoding="utf8") as file_descriptor:
+            file_descriptor.writelines(chunks)
+    else:
+        file.writelines(chunks)
+
+
+def parse_region(region: str) -> tuple[str, int, int | None]:
+    """Parse a samtools style region.
+
+    Parameters
+    ----------
+    region : str
+        Region as `contig` or `contig:start-end`, with 1-based inclusive
+        coordinates.
+
+    Returns
+    -------
+    tuple[str, int, int | None]
+        Contig and 0-based half-open start and end of the region. The end is None
+        if the region spans the whole contig.
+    """
+    match = re.fullmatch(r"(.+?)(?::([\d,]+)-([\d,]+))?", region)
+    if match is None:
+        raise ValueError(f"Invalid region: {region}")
+    contig, start, end = match.groups()
+    if start is None:
+        return contig, 0, None
+    start, end = int(start.replace(",", "")) - 1, int(end.replace(",", ""))
+    if start < 0 or end <= start:
+        raise ValueError(f"Invalid region: {region}")
+    return contig, start, end
+
+
+def read_reference(path: str | Path, contig: str | None = None) -> str:
+    """Read the sequence of a contig from an indexed FASTA file.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path to the FASTA file.
+    contig : str | None
+        Name of the contig. By default the first contig is used.
+
+    Returns
+    -------
+    str
+        Sequence of the contig.
+    """
+    reference = load_reference(path)
+    if contig is None and len(reference) > 1:
+        logging.warning("Using the first of %s contigs in %s.", len(reference), path)
+    if contig is not None and contig not in reference.lengths:
+        logging.error("Contig %s not found in %s.", contig, path)
+        sys.exit(1)
+    return reference.sequence(contig)
+
+
+def read_alignment_reference(path: str | Path, region: str | None) -> str:
+    """Read the contig of a reference that reads are compared with.
+
+    All reads are compared with a single contig, the contig of the region or the
+    only contig of the reference. A reference with several contigs requires a
+    region, otherwise reads aligned to the other contigs would be compared with
+    the wrong sequence.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path to the FASTA file.
+    region : str | None
+        Region of the reads, see `parse_region`.
+
+    Returns
+    -------
+    str
+        Sequence of the contig.
+    """
+    if region is not None:
+        return read_reference(path, parse_region(region)[0])
+    reference = load_reference(path)
+    if len(reference) > 1:
+        logging.error(
+            "The reference %s has %s contigs, select one with --region.",
+            path,
+            len(reference),
+        )
+        sys.exit(1)
+    return reference.sequence()
@@ -1,5 +1,5 @@
-from .fasta import get_fasta, write_fasta
-from .nexus import get_nexus, write_nexus
+from .fasta import get_fasta, iter_fasta, write_fasta
+from .nexus import get_nexus, iter_nexus, write_nexus
 from .npy import write_npy
-from .phylip import get_phylip, write_phylip
+from .phylip import get_phylip, iter_phylip, write_phylip
 from .xml import get_xml, write_xml
@@ -1,34 +1,41 @@
 """Export fasta format."""
 
-from ..cli.utils import write
-from ..transform import haplotypes_to_sequences
+from ..cli.utils import write_chunks
+from ..transform import DEFAULT_CHUNK_SIZE, iter_sequences, parse_haplotypes
+from .formatter import iter_template
 
 DEFAULT_TEMPLATE = """
 {data}
 """
 
 
-def _format_data(ids, matrix):
-    return "\n".join(f">{name}\n{sequence}" for name, sequence in zip(ids, matrix))
+def _iter_rows(ids, sequences, counts):
+    for index, sequence in sequences:
+        row = f">{ids[index]}\n{sequence}"
+        for _ in range(counts[index]):
+            yield row
 
 
-def get_fasta(data, reference, template=None):
-    """Convert haplotypes to fasta format.
+def iter_fasta(data, reference, template=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Convert haplotypes to fasta format in chunks.
 
     Parameters
     ----------
     data : pandas.DataFrame
-        Dataframe with columns "haplotype" and "id".
+        Dataframe with columns "haplotype", "id" and "count". Each haplotype is
+        written "count" times, haplotypes with a missing count are not written.
     reference : str
         Reference sequence.
     template : str
         Template for fasta file with {data} as placeholder. If None, the default
         template is used.
+    chunk_size : int
+        Number of sequences aligned and rendered at a time.
 
-    Returns
-    -------
+    Yields
+    ------
     str
-        Fasta formatted string
+        Chunks of the fasta formatted string.
     """
     if not "haplotype" in data.columns:
         raise ValueError("Dataframe must contain column 'haplotype'.")
@@ -39,11 +46,37 @@ def get_fasta(data, reference, template=None):
     if template is None:
         template = DEFAULT_TEMPLATE
 
-    sequences_matrix = haplotypes_to_sequences(
-        reference, data["haplotype"], data["count"]
+    # counts are floats after reading a table with missing counts
+    counts = data["count"].fillna(0).astype(int).tolist()
+    sequences = iter_sequences(
+        reference, parse_haplotypes(data["haplotype"]), counts, chunk_size
+    )
+    yield from iter_template(
+        template.strip("\n"),
+        _iter_rows(data["id"].tolist(), sequences, counts),
+        chunk_size,
     )
 
-    return template.format(data=_format_data(data["id"], sequences_matrix)).strip("\n")
+
+def get_fasta(data, reference, template=None):
+    """Convert haplotypes to fasta format.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Dataframe with columns "haplotype", "id" and "count".
+    reference : str
+        Reference sequence.
+    template : str
+        Template for fasta file with {data} as placeholder. If None, the default
+        template is used.
+
+    Returns
+    -------
+    str
+        Fasta formatted string
+    """
+    return "".join(iter_fasta(data, reference, template=template))
 
 
 def write_fasta(path, data, reference, template=None):
@@ -54,7 +87,7 @@ def write_fasta(path, data, reference, template=None):
     path : str or pathlib.Path
         Path to the output file.
     data : pandas.DataFrame
-        Dataframe with columns "haplotype" and "id".
+        Dataframe with columns "haplotype", "id" and "count".
     reference : str
         Reference sequence.
     template : str
@@ -65,4 +98,4 @@ def write_fasta(path, data, reference, template=None):
         with open(template) as f:
             template = f.read()
 
-    write(path, get_fasta(data, reference, template=template))
+    write_chunks(path, iter_fasta(data, reference, template=template))
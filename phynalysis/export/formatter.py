@@ -1,6 +1,7 @@
 """Formatter functions."""
 
 import string
+from typing import Iterable, Iterator
 
 
 class IncrementalFormatter(string.Formatter):
@@ -17,3 +18,31 @@ class IncrementalFormatter(string.Formatter):
             return args[key]
 
         return self.default.format("")
+
+
+def iter_template(
+    template: str, rows: Iterable[str], chunk_size: int, **kwargs
+) -> Iterator[str]:
+    """Render a template with rows as {data}, in chunks of rows.
+
+    The rows are joined by newlines. The parts of the template before and after
+    {data} are rendered with `IncrementalFormatter`, so that the rows are never
+    held in memory all at once.
+    """
+    formatter = IncrementalFormatter()
+    head, placeholder, tail = template.partition("{data}")
+    yield formatter.format(head, **kwargs)
+    if not placeholder:
+        return
+
+    chunk = []
+    separator = ""
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield separator + "\n".join(chunk)
+            separator = "\n"
+            chunk = []
+    if chunk:
+        yield separator + "\n".join(chunk)
+    yield formatter.format(tail, **kwargs)
@@ -1,8 +1,13 @@
 """Export nexus format."""
 
-from ..cli.utils import write
-from ..transform import haplotypes_to_sequences
-from .formatter import IncrementalFormatter
+from ..cli.utils import write_chunks
+from ..transform import (
+    DEFAULT_CHUNK_SIZE,
+    aligned_length,
+    iter_sequences,
+    parse_haplotypes,
+)
+from .formatter import iter_template
 
 DEFAULT_TEMPLATE = """
 #NEXUS
@@ -17,18 +22,18 @@ END;
 """
 
 
-def _format_data(ids, matrix):
+def _iter_rows(ids, sequences):
+    ids = [name.replace(":", "|").replace(";", ".") for name in ids]
     longest_haplotype = max(map(len, ids))
-    return "\n".join(
-        [
-            f"        {name.replace(':', '|').replace(';', '.').ljust(longest_haplotype)} {sequence}"
-            for name, sequence in zip(ids, matrix)
-        ]
-    )
+    for index, sequence in sequences:
+        yield f"        {ids[index].ljust(longest_haplotype)} {sequence}"
 
 
-def get_nexus(data, reference, template=None):
-    """Convert haplotypes to nexus format.
+def iter_nexus(data, reference, template=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Convert haplotypes to nexus format in chunks.
+
+    The dimensions of the matrix are computed before any sequence is aligned, so
+    that the rows can be rendered `chunk_size` at a time.
 
     Parameters
     ----------
@@ -39,11 +44,13 @@ def get_nexus(data, reference, template=None):
     template : str
         Template for nexus file with {n_tax}, {n_char} and {data} as placeholders. If
         None, the default template is used.
+    chunk_size : int
+        Number of sequences aligned and rendered at a time.
 
-    Returns
-    -------
+    Yields
+    ------
     str
-        Nexus formatted string
+        Chunks of the nexus formatted string.
     """
     if not "haplotype" in data.columns:
         raise ValueError("Dataframe must contain column 'haplotype'.")
@@ -54,16 +61,38 @@ def get_nexus(data, reference, template=None):
     if template is None:
         template = DEFAULT_TEMPLATE
 
-    sequences_matrix = haplotypes_to_sequences(reference, data["haplotype"])
-
-    return IncrementalFormatter().format(
+    haplotypes = parse_haplotypes(data["haplotype"])
+    sequences = iter_sequences(reference, haplotypes, chunk_size=chunk_size)
+    yield from iter_template(
         template,
-        n_tax=len(sequences_matrix),
-        n_char=len(sequences_matrix[0]),
-        data=_format_data(data["id"], sequences_matrix),
+        _iter_rows(data["id"], sequences),
+        chunk_size,
+        n_tax=len(haplotypes),
+        n_char=aligned_length(reference, haplotypes),
     )
 
 
+def get_nexus(data, reference, template=None):
+    """Convert haplotypes to nexus format.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Dataframe with columns "haplotype" and "id".
+    reference : str
+        Reference sequence.
+    template : str
+        Template for nexus file with {n_tax}, {n_char} and {data} as placeholders. If
+        None, the default template is used.
+
+    Returns
+    -------
+    str
+        Nexus formatted string
+    """
+    return "".join(iter_nexus(data, reference, template=template))
+
+
 def write_nexus(path, data, reference, template=None):
     """Write nexus file.
 
@@ -82,4 +111,4 @@ def write_nexus(path, data, reference, template=None):
     if template is not None:
         with open(template, "r") as template_file:
             template = template_file.read()
-    write(path, get_nexus(data, reference, template=template))
+    write_chunks(path, iter_nexus(data, reference, template=template))
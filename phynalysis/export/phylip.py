@@ -1,9 +1,14 @@
 """Export phylip format."""
 
-from ..cli.utils import write
-from ..transform import haplotypes_to_sequences
+from ..cli.utils import write_chunks
+from ..transform import (
+    DEFAULT_CHUNK_SIZE,
+    aligned_length,
+    iter_sequences,
+    parse_haplotypes,
+)
 from .nexus import DEFAULT_TEMPLATE
-from .formatter import IncrementalFormatter
+from .formatter import iter_template
 
 DEFAULT_TEMPLATE = """
 {n_tax} {n_char}
@@ -11,18 +16,18 @@ DEFAULT_TEMPLATE = """
 """
 
 
-def _format_data(ids, matrix):
+def _iter_rows(ids, sequences):
+    ids = [name.replace(":", "|").replace(";", ".") for name in ids]
     longest_haplotype = max(map(len, ids))
-    return "\n".join(
-        [
-            f"{name.replace(':', '|').replace(';', '.').ljust(longest_haplotype)} {sequence}"
-            for name, sequence in zip(ids, matrix)
-        ]
-    )
+    for index, sequence in sequences:
+        yield f"{ids[index].ljust(longest_haplotype)} {sequence}"
 
 
-def get_phylip(data, reference, template=None):
-    """Convert haplotypes to phylip format.
+def iter_phylip(data, reference, template=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Convert haplotypes to phylip format in chunks.
+
+    The dimensions of the matrix are computed before any sequence is aligned, so
+    that the rows can be rendered `chunk_size` at a time.
 
     Parameters
     ----------
@@ -33,11 +38,13 @@ def get_phylip(data, reference, template=None):
     template : str
         Template for phylip file with {n_tax}, {n_char} and {data} as placeholders. If
         None, the default template is used.
+    chunk_size : int
+        Number of sequences aligned and rendered at a time.
 
-    Returns
-    -------
+    Yields
+    ------
     str
-        Phylip formatted string
+        Chunks of the phylip formatted string.
     """
     if not "haplotype" in data.columns:
         raise ValueError("Dataframe must contain column 'haplotype'.")
@@ -48,16 +55,38 @@ def get_phylip(data, reference, template=None):
     if template is None:
         template = DEFAULT_TEMPLATE
 
-    sequences_matrix = haplotypes_to_sequences(reference, data["haplotype"])
-
-    return IncrementalFormatter().format(
+    haplotypes = parse_haplotypes(data["haplotype"])
+    sequences = iter_sequences(reference, haplotypes, chunk_size=chunk_size)
+    yield from iter_template(
         template,
-        n_tax=len(sequences_matrix),
-        n_char=len(sequences_matrix[0]),
-        data=_format_data([str(i) for i in data.index], sequences_matrix),
+        _iter_rows([str(i) for i in data.index], sequences),
+        chunk_size,
+        n_tax=len(haplotypes),
+        n_char=aligned_length(reference, haplotypes),
     )
 
 
+def get_phylip(data, reference, template=None):
+    """Convert haplotypes to phylip format.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        Dataframe with columns "haplotype" and "id".
+    reference : str
+        Reference sequence.
+    template : str
+        Template for phylip file with {n_tax}, {n_char} and {data} as placeholders. If
+        None, the default template is used.
+
+    Returns
+    -------
+    str
+        Phylip formatted string
+    """
+    return "".join(iter_phylip(data, reference, template=template))
+
+
 def write_phylip(path, data, reference, template=None):
     """Write phylip formatted data to file.
 
@@ -77,4 +106,4 @@ def write_phylip(path, data, reference, template=None):
         with open(template, "r") as f:
             template = f.read()
 
-    write(path, get_phylip(data, reference, template))
+    write_chunks(path, iter_phylip(data, reference, template=template))
@@ -15,7 +15,7 @@ from typing import Callable
 
 import numpy as np
 
-from .transform import Haplotype
+from .transform import HaplotypeLike
 
 __all__ = ["FitnessFunction", "FitnessTable", "EpistasisMap", "Algebraic"]
 
@@ -31,7 +31,7 @@ class FitnessFunction:
         self.fitness_providers = fitness_providers
         self.utility = utility
 
-    def compute_fitness(self, haplotype: Haplotype) -> float:
+    def compute_fitness(self, haplotype: HaplotypeLike) -> float:
         fitness = np.prod(
             [
                 fitness_provider.compute_fitness(haplotype)
@@ -58,7 +58,7 @@ class FitnessTable:
     def load(cls, path: str):
         return cls(np.load(path))
 
-    def compute_fitness(self, haplotype: Haplotype) -> float:
+    def compute_fitness(self, haplotype: HaplotypeLike) -> float:
         return np.prod([self.table[pos][mut] for pos, (_, mut) in haplotype])
 
 
@@ -81,7 +81,7 @@ class EpistasisMap:
             }
         )
 
-    def compute_fitness(self, haplotype: Haplotype) -> float:
+    def compute_fitness(self, haplotype: HaplotypeLike) -> float:
         iterator = product(haplotype, haplotype)
         return np.prod(
             [
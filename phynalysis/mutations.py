@@ -1,27 +1,241 @@
-from collections import defaultdict
-from typing import Callable, Any
+from pathlib import Path
+from typing import Callable, Any, Iterable
 
+import numpy as np
 import pandas as pd
 
-from .transform import haplotype_to_list
+from .transform import HaplotypeCollection, _parse_mutation, parse_haplotypes
 
-__all__ = ["mutations_from_haplotypes"]
+__all__ = ["MutationVocabulary", "vocabulary_path", "mutations_from_haplotypes"]
+
+
+def vocabulary_path(dataset_path: str | Path) -> Path:
+    """Get the path of the mutation vocabulary of a dataset."""
+    dataset_path = Path(dataset_path)
+    return dataset_path.with_name(dataset_path.name + ".vocabulary.npz")
+
+
+class MutationVocabulary:
+    """Interning table between changes and dense int32 ids.
+
+    A change is a position and a mutation string, e.g. `(10, "G->A")`. Ids are
+    assigned in order of appearance, so a vocabulary that is shared between
+    datasets, or saved and loaded again, keeps all existing ids.
+
+    Attributes
+    ----------
+    positions : np.ndarray
+        Position of each id.
+    mutation_codes : np.ndarray
+        Index into `mutations` of each id.
+    mutations : list[str]
+        Mutation table.
+    """
+
+    def __init__(
+        self,
+        positions: np.ndarray | None = None,
+        mutation_codes: np.ndarray | None = None,
+        mutations: list[str] | None = None,
+    ):
+        self.mutations = [] if mutations is None else list(mutations)
+        self._mutation_index = {
+            mutation: code for code, mutation in enumerate(self.mutations)
+        }
+        self.positions = np.empty(0, dtype=np.int32)
+        self.mutation_codes = np.empty(0, dtype=np.int32)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._key_order = np.empty(0, dtype=np.int64)
+        if positions is not None:
+            self._append(
+                np.asarray(positions, dtype=np.int32),
+                np.asarray(mutation_codes, dtype=np.int32),
+            )
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getstate__(self):
+        # the lookup tables are rebuilt in the receiving process
+        return {
+            "positions": self.positions,
+            "mutation_codes": self.mutation_codes,
+            "mutations": self.mutations,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def _key(positions: np.ndarray, mutation_codes: np.ndarray) -> np.ndarray:
+        """Pack positions and mutation codes into integer keys."""
+        return positions.astype(np.int64) << 32 | mutation_codes.astype(np.int64)
+
+    def _append(self, positions: np.ndarray, mutation_codes: np.ndarray):
+        """Add new changes, which get the next ids."""
+        self.positions = np.concatenate([self.positions, positions])
+        self.mutation_codes = np.concatenate([self.mutation_codes, mutation_codes])
+        self._keys = self._key(self.positions, self.mutation_codes)
+        self._key_order = np.argsort(self._keys, kind="stable")
+
+    def _lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Get the ids of keys, or -1 for unknown keys."""
+        if not len(self):
+            return np.full(len(keys), -1, dtype=np.int32)
+        sorted_keys = self._keys[self._key_order]
+        index = np.minimum(np.searchsorted(sorted_keys, keys), len(self) - 1)
+        return np.where(sorted_keys[index] == keys, self._key_order[index], -1).astype(
+            np.int32
+        )
+
+    def encode_changes(
+        self,
+        positions: np.ndarray,
+        codes: np.ndarray,
+        mutations: list[str],
+        add: bool = True,
+    ) -> np.ndarray:
+        """Get the ids of changes.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            Position of each change.
+        codes : np.ndarray
+            Index into `mutations` of each change.
+        mutations : list[str]
+            Mutation table of the changes.
+        add : bool
+            Add unknown changes to the vocabulary. Otherwise their id is -1.
+
+        Returns
+        -------
+        np.ndarray
+            Id of each change as int32.
+        """
+        if add:
+            for mutation in mutations:
+                if mutation not in self._mutation_index:
+                    self._mutation_index[mutation] = len(self.mutations)
+                    self.mutations.append(mutation)
+        table = np.array(
+            [self._mutation_index.get(mutation, -1) for mutation in mutations],
+            dtype=np.int64,
+        )
+        mutation_codes = table[np.asarray(codes, dtype=np.int64)]
+        keys = self._key(np.asarray(positions), mutation_codes)
+        ids = self._lookup(keys)
+        ids[mutation_codes < 0] = -1
+
+        unknown = ids < 0
+        if add and unknown.any():
+            # number the new changes in order of appearance
+            new_keys, first = np.unique(keys[unknown], return_index=True)
+            first_order = np.argsort(first, kind="stable")
+            new_positions = np.asarray(positions)[unknown][first[first_order]]
+            new_codes = mutation_codes[unknown][first[first_order]]
+            self._append(new_positions.astype(np.int32), new_codes.astype(np.int32))
+            ids[unknown] = self._lookup(keys[unknown])
+        return ids
+
+    def encode_haplotypes(
+        self, haplotypes: HaplotypeCollection, add: bool = True
+    ) -> np.ndarray:
+        """Get the ids of the changes of haplotypes, in their CSR layout."""
+        start, stop = haplotypes.offsets[0], haplotypes.offsets[-1]
+        return self.encode_changes(
+            haplotypes.positions[start:stop],
+            haplotypes.codes[start:stop],
+            haplotypes.mutations,
+            add=add,
+        )
+
+    def encode(self, position: int, mutation: str, add: bool = True) -> int:
+        """Get the id of a single change."""
+        return int(self.encode_changes([position], [0], [mutation], add=add)[0])
+
+    def decode(self, ids: Iterable[int]) -> list[tuple[int, str]]:
+        """Get the position and mutation string of ids."""
+        ids = np.asarray(ids, dtype=np.int64)
+        return [
+            (position, self.mutations[code])
+            for position, code in zip(
+                self.positions[ids].tolist(), self.mutation_codes[ids].tolist()
+            )
+        ]
+
+    def count(self, ids: np.ndarray, weights: np.ndarray | None = None) -> np.ndarray:
+        """Count the occurrences of each id, optionally weighted."""
+        return np.bincount(ids, weights=weights, minlength=len(self))
+
+    @classmethod
+    def load(cls, path: str | Path) -> "MutationVocabulary":
+        """Load a vocabulary from a file."""
+        with np.load(path) as data:
+            return cls(
+                positions=data["positions"],
+                mutation_codes=data["mutation_codes"],
+                mutations=data["mutations"].tolist(),
+            )
+
+    def save(self, path: str | Path):
+        """Save the vocabulary to a file."""
+        # write through a file object, so that numpy does not change the suffix
+        with open(path, "wb") as file_descriptor:
+            np.savez(
+                file_descriptor,
+                positions=self.positions,
+                mutation_codes=self.mutation_codes,
+                mutations=np.array(self.mutations, dtype=str),
+            )
 
 
 def mutations_from_haplotypes(
     data: pd.DataFrame,
     index_map: Callable[[str], Any] = None,
+    vocabulary: MutationVocabulary | None = None,
 ) -> pd.DataFrame:
-    """Compute mutations from haplotypes."""
-    experiments = defaultdict(lambda: defaultdict(int))
-    for idx, row in data.iterrows():
-        sample_name, haplotype = idx
-        if index_map is not None:
-            sample_name = index_map(sample_name)
-        mutations = haplotype_to_list(haplotype)
-        for mutation in mutations:
-            experiments[sample_name][mutation] += int(row["count"])
-
-    df = pd.DataFrame.from_dict(experiments)
-    df.index.names = ["position", "mutation"]
+    """Compute mutations from haplotypes.
+
+    All haplotypes are parsed at once with `parse_haplotypes`, and the counts of
+    their changes are summed per sample by their id in `vocabulary`, to which
+    new changes are added.
+    """
+    if vocabulary is None:
+        vocabulary = MutationVocabulary()
+
+    sample_names = data.index.get_level_values(0)
+    if index_map is not None:
+        sample_names = sample_names.map(index_map)
+
+    haplotypes = parse_haplotypes(data.index.get_level_values(1))
+    rows = np.repeat(np.arange(len(data)), haplotypes.n_changes)
+    changes = pd.DataFrame(
+        {
+            "id": vocabulary.encode_haplotypes(haplotypes),
+            "sample_name": np.asarray(sample_names, dtype=object)[rows],
+            "count": data["count"].to_numpy(dtype=np.int64)[rows],
+        }
+    )
+    df = (
+        changes.groupby(["id", "sample_name"], sort=False)["count"]
+        .sum()
+        .unstack("sample_name", sort=False)
+    )
+    df.columns.name = None
+
+    # substitutions are stored as tuples of encoded bases
+    ids = df.index.to_numpy()
+    mutations = [_parse_mutation(mutation) for mutation in vocabulary.mutations]
+    df.index = pd.MultiIndex.from_arrays(
+        [
+            vocabulary.positions[ids],
+            pd.Index(
+                [mutations[code] for code in vocabulary.mutation_codes[ids]],
+                dtype=object,
+                tupleize_cols=False,
+            ),
+        ],
+        names=["position", "mutation"],
+    )
     return df
@@ -1,121 +1,1079 @@
 """Parsing functions to extract haplotypes from reads."""
 
+import random
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from hashlib import blake2b
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
 import numpy as np
 import pandas as pd
 import pysam
-import re
+from pandas.api.types import union_categoricals
+
+from .reference import Reference
 
 __all__ = [
+    "ChangeBatch",
+    "ErrorProfile",
+    "MutationCodes",
+    "encode_sequence",
+    "changes_arrays_from_read",
     "changes_from_read",
+    "iter_change_batches",
+    "FAMILY_VOTES",
+    "iter_family_change_batches",
     "changes_from_alignment",
+    "PILEUP_BASES",
+    "pileup_from_reads",
+    "READ_STRATA",
+    "count_read_strata",
+    "sample_reads",
 ]
 
+CHANGES_COLUMNS = ["seq_id", "block_id", "position", "mutation", "quality"]
+DEFAULT_BATCH_SIZE = 10_000
+FAMILY_VOTES = ("majority", "quality")
+READ_STRATA = ("block_id", "read_group")
+
+BLOCK_ID_REGEX = re.compile(r"block_id=(\w+);")
+
+# cigar operations
+_MATCH = 0
+_INSERTION = 1
+_DELETION = 2
+_SOFT_CLIP = 4
+_SEQUENCE_MATCH = 7
+_SEQUENCE_MISMATCH = 8
+
+# lookup tables indexed by cigar operation
+_KNOWN_OPERATIONS = np.zeros(10, dtype=bool)
+_KNOWN_OPERATIONS[
+    [_MATCH, _INSERTION, _DELETION, _SOFT_CLIP, _SEQUENCE_MATCH, _SEQUENCE_MISMATCH]
+] = True
+_CONSUMES_READ = np.zeros(10, dtype=np.int64)
+_CONSUMES_READ[
+    [_MATCH, _INSERTION, _SOFT_CLIP, _SEQUENCE_MATCH, _SEQUENCE_MISMATCH]
+] = 1
+_CONSUMES_REFERENCE = np.zeros(10, dtype=np.int64)
+_CONSUMES_REFERENCE[[_MATCH, _DELETION, _SEQUENCE_MATCH, _SEQUENCE_MISMATCH]] = 1
+
+MISSING_QUALITY = 255
+DELETION_QUALITY = 0
+
+# columns of the pileup count array, all other bases are counted as "N"
+PILEUP_BASES = "ACGTN"
+_PILEUP_INDEX = np.full(256, PILEUP_BASES.index("N"), dtype=np.int64)
+for _bases in (PILEUP_BASES, PILEUP_BASES.lower()):
+    _PILEUP_INDEX[np.frombuffer(_bases.encode(), dtype=np.uint8)] = np.arange(5)
+
+
+class MutationCodes:
+    """Interning table between mutation strings and integer codes.
+
+    Substitutions are resolved through a lookup table indexed by the reference and
+    read bytes, so that whole blocks of bases can be encoded at once. All other
+    mutations are interned through a dictionary.
+    """
+
+    def __init__(self):
+        self.mutations = []
+        self._index = {}
+        self._substitutions = np.full(1 << 16, -1, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.mutations)
+
+    def encode(self, mutation: str) -> int:
+        """Get the code of a mutation."""
+        code = self._index.get(mutation)
+        if code is None:
+            code = self._index[mutation] = len(self.mutations)
+            self.mutations.append(mutation)
+        return code
+
+    def encode_substitutions(
+        self, reference: np.ndarray, read: np.ndarray
+    ) -> np.ndarray:
+        """Get the codes of substitutions between two arrays of bases."""
+        keys = reference.astype(np.int32) << 8 | read
+        codes = self._substitutions[keys]
+        missing = codes < 0
+        if missing.any():
+            for key in np.unique(keys[missing]):
+                self._substitutions[key] = self.encode(
+                    chr(key >> 8) + "->" + chr(key & 0xFF)
+                )
+            codes = self._substitutions[keys]
+        return codes
+
+    def decode(self, codes) -> list[str]:
+        """Get the mutation strings of a sequence of codes."""
+        return [self.mutations[code] for code in codes]
+
+
+def encode_sequence(sequence: str) -> np.ndarray:
+    """Encode a sequence as an array of bytes."""
+    return np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)
+
+
+def _reference_lookup(
+    reference: "str | np.ndarray | Reference",
+) -> Callable[[pysam.AlignedSegment], np.ndarray]:
+    """Get a function that returns the encoded reference of a read.
+
+    The contig of a `Reference` is looked up by the `reference_name` of each read,
+    a single sequence is used for all reads.
+    """
+    if isinstance(reference, Reference):
+        return lambda read: reference.encoded(read.reference_name)
+    if isinstance(reference, str):
+        reference = encode_sequence(reference)
+    return lambda read: reference
+
+
+def _ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Concatenate the index ranges `[start, start + length)`."""
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+def _read_qualities(read: pysam.AlignedSegment) -> np.ndarray | None:
+    """Get the qualities of a read as array, or `None` if they are missing."""
+    qualities = read.query_qualities
+    if not qualities:
+        return None
+    qualities = np.frombuffer(qualities, dtype=np.uint8)
+    # keep the orientation of `get_forward_qualities`
+    if read.is_reverse:
+        qualities = qualities[::-1]
+    return qualities
+
+
+def _change_spans(
+    reference: np.ndarray,
+    read: pysam.AlignedSegment,
+    codes: MutationCodes,
+    compare_matches: bool = False,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Decode the changes of a read together with the bases they cover.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+        Positions, mutation codes, and start and length of the read span of the
+        changes in cigar order. Deletions have a span of length zero.
+    """
+    # unmapped reads have no cigar and therefore no changes
+    cigar = np.array(read.cigartuples or [], dtype=np.int64).reshape(-1, 2)
+    operations, lengths = cigar[:, 0], cigar[:, 1]
+
+    known = _KNOWN_OPERATIONS[operations]
+    if not known.all():
+        raise IndexError(f"Unknown cigar operation: {operations[~known][0]}")
+
+    # start of each operation in read and reference coordinates
+    read_lengths = lengths * _CONSUMES_READ[operations]
+    reference_lengths = lengths * _CONSUMES_REFERENCE[operations]
+    read_starts = np.cumsum(read_lengths) - read_lengths
+    reference_starts = (
+        read.reference_start + np.cumsum(reference_lengths) - reference_lengths
+    )
+
+    # substitutions
+    compared = (
+        (operations == _SEQUENCE_MISMATCH) | (operations == _MATCH)
+        if compare_matches
+        else operations == _SEQUENCE_MISMATCH
+    )
+    if compared.any():
+        query = encode_sequence(read.query_sequence)
+        read_index = _ranges(read_starts[compared], lengths[compared])
+        reference_index = _ranges(reference_starts[compared], lengths[compared])
+        substitution_order = np.repeat(np.flatnonzero(compared), lengths[compared])
+        keep = reference[reference_index] != query[read_index]
+        read_index = read_index[keep]
+        reference_index = reference_index[keep]
+        substitution_order = substitution_order[keep]
+        substitution_codes = codes.encode_substitutions(
+            reference[reference_index], query[read_index]
+        )
+    else:
+        read_index = np.empty(0, dtype=np.int64)
+        reference_index = np.empty(0, dtype=np.int64)
+        substitution_order = np.empty(0, dtype=np.int64)
+        substitution_codes = np.empty(0, dtype=np.int32)
+
+    # insertions and deletions
+    is_insertion = operations == _INSERTION
+    indel_order = np.flatnonzero(is_insertion | (operations == _DELETION))
+    indel_codes = np.empty(len(indel_order), dtype=np.int32)
+    if len(indel_order):
+        sequence = read.query_sequence
+        for i, (insertion, start, length) in enumerate(
+            zip(
+                is_insertion[indel_order].tolist(),
+                read_starts[indel_order].tolist(),
+                lengths[indel_order].tolist(),
+            )
+        ):
+            indel_codes[i] = codes.encode(
+                "i" + sequence[start : start + length]
+                if insertion
+                else "del" + str(length)
+            )
+
+    # merge both kinds of changes in cigar order
+    order = np.argsort(np.concatenate([substitution_order, indel_order]), kind="stable")
+    positions = np.concatenate([reference_index, reference_starts[indel_order]])
+    mutation_codes = np.concatenate([substitution_codes, indel_codes])
+    span_starts = np.concatenate([read_index, read_starts[indel_order]])
+    span_lengths = np.concatenate(
+        [
+            np.ones(len(read_index), dtype=np.int64),
+            lengths[indel_order] * is_insertion[indel_order],
+        ]
+    )
+    return (
+        positions[order].astype(np.int32),
+        mutation_codes[order].astype(np.int32),
+        span_starts[order],
+        span_lengths[order],
+    )
+
+
+def _span_qualities(
+    qualities: np.ndarray | None, starts: np.ndarray, lengths: np.ndarray
+) -> np.ndarray:
+    """Get the floored mean quality of read spans.
+
+    Spans of length zero get `DELETION_QUALITY`, spans of reads without qualities
+    `MISSING_QUALITY`.
+    """
+    span_qualities = np.full(len(starts), DELETION_QUALITY, dtype=np.uint8)
+    covered = lengths > 0
+    if not covered.any():
+        return span_qualities
+    if qualities is None:
+        span_qualities[covered] = MISSING_QUALITY
+    else:
+        cumulative = np.concatenate([[0], np.cumsum(qualities, dtype=np.int64)])
+        starts, lengths = starts[covered], lengths[covered]
+        span_qualities[covered] = (
+            cumulative[starts + lengths] - cumulative[starts]
+        ) // lengths
+    return span_qualities
+
+
+def _filter_changes(
+    qualities: np.ndarray | None,
+    positions: np.ndarray,
+    mutation_codes: np.ndarray,
+    span_starts: np.ndarray,
+    span_lengths: np.ndarray,
+    min_quality: int,
+    stats: Counter | None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Attach the qualities of a read to its changes and drop low quality ones."""
+    change_qualities = _span_qualities(qualities, span_starts, span_lengths)
+    n_changes = len(positions)
+    if min_quality > 0:
+        keep = change_qualities >= min_quality
+        positions = positions[keep]
+        mutation_codes = mutation_codes[keep]
+        change_qualities = change_qualities[keep]
+
+    if stats is not None:
+        stats["changes"] += n_changes
+        stats["changes_rejected_quality"] += n_changes - len(positions)
+
+    return positions, mutation_codes, change_qualities
+
+
+def changes_arrays_from_read(
+    reference: np.ndarray,
+    read: pysam.AlignedSegment,
+    codes: MutationCodes,
+    compare_matches: bool = False,
+    min_quality: int = 0,
+    stats: Counter | None = None,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Retrieve typed arrays of changes from single read.
+
+    The read is decoded once and all mismatch blocks are compared against the
+    encoded reference in a single vectorized operation. Changes below
+    `min_quality` are dropped before they are returned.
+
+    Parameters
+    ----------
+    reference : np.ndarray
+        Reference sequence encoded with `encode_sequence`.
+    read : pysam.AlignedSegment
+        Aligned read.
+    codes : MutationCodes
+        Table used to encode the mutations.
+    compare_matches : bool
+        Also compare `M` blocks against the reference. By default they are treated
+        as matches like `=` blocks.
+    min_quality : int
+        Minimum quality of the returned changes.
+    stats : Counter | None
+        Counter to which the number of "changes" and the number of
+        "changes_rejected_quality" are added.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, np.ndarray]
+        Positions (int32), mutation codes (int32) and qualities (uint8) of the
+        changes in cigar order. Insertions carry the floored mean of their base
+        qualities, deletions a quality of zero.
+    """
+    spans = _change_spans(reference, read, codes, compare_matches)
+    return _filter_changes(_read_qualities(read), *spans, min_quality, stats)
+
 
 def changes_from_read(
-    reference: str,
+    reference: str | np.ndarray | Reference,
     read: pysam.AlignedRead,
 ):
     """Retrieve list of changes from single read."""
-    changes = []
-    read_pos = 0
-    ref_pos = read.reference_start
-    for cigar in read.cigar:
-        if cigar[0] == 7 or cigar[0] == 0:  # match
-            # move both read and reference indices
-            read_pos += cigar[1]
-            ref_pos += cigar[1]
-        elif cigar[0] == 8:  # mismatch
-            position = ref_pos
-            # get read and reference bases
-            reference_slice = reference[ref_pos : ref_pos + cigar[1]]
-            read_slice = read.seq[read_pos : read_pos + cigar[1]]
-
-            # get quality scores
-            qualities = read.get_forward_qualities()
-
-            # slice quality array to match cigar offset length
-            if qualities:
-                qualities = qualities[read_pos : read_pos + cigar[1]]
-
-            # record changes
-            changes += [
-                [
-                    position + offset,
-                    reference_slice[offset] + "->" + read_slice[offset],
-                    qualities[offset] if qualities else 255,
-                ]
-                for offset in range(cigar[1])
-                if reference_slice[offset] != read_slice[offset]
-            ]
-
-            # move both read and reference indices
-            read_pos += cigar[1]
-            ref_pos += cigar[1]
-        elif cigar[0] == 2:  # deletion
-            changes.append(
+    codes = MutationCodes()
+    positions, mutation_codes, qualities = changes_arrays_from_read(
+        _reference_lookup(reference)(read), read, codes
+    )
+    return [
+        [position, codes.mutations[code], quality]
+        for position, code, quality in zip(
+            positions.tolist(), mutation_codes.tolist(), qualities.tolist()
+        )
+    ]
+
+
+@dataclass(slots=True, frozen=True)
+class ChangeBatch:
+    """Changes of a batch of consecutive reads.
+
+    Attributes
+    ----------
+    n_reads : int
+        Number of reads in the batch, including reads without changes.
+    changes : pd.DataFrame
+        Changes of the reads with columns "seq_id", "block_id", "position",
+        "mutation" and "quality".
+    """
+
+    n_reads: int
+    changes: pd.DataFrame
+
+
+def _block_id(read: pysam.AlignedSegment) -> str | None:
+    """Get the block id from the name of a read."""
+    block_id_match = BLOCK_ID_REGEX.search(read.query_name)
+    return block_id_match.group(1) if block_id_match else None
+
+
+def _changes_frame(
+    mutations: list[str],
+    block_ids: list[str],
+    seq_ids: list[np.ndarray],
+    block_id_codes: list[np.ndarray],
+    positions: list[np.ndarray],
+    mutation_codes: list[np.ndarray],
+    qualities: list[np.ndarray],
+) -> pd.DataFrame:
+    """Construct the typed changes dataframe from per read arrays."""
+
+    def _concatenate(arrays, dtype):
+        return np.concatenate(arrays).astype(dtype) if arrays else np.empty(0, dtype)
+
+    return pd.DataFrame(
+        {
+            "seq_id": _concatenate(seq_ids, np.int32),
+            "block_id": pd.Categorical.from_codes(
+                _concatenate(block_id_codes, np.int32), categories=block_ids
+            ),
+            "position": _concatenate(positions, np.int32),
+            "mutation": pd.Categorical.from_codes(
+                _concatenate(mutation_codes, np.int32), categories=mutations
+            ),
+            "quality": _concatenate(qualities, np.uint8),
+        }
+    )
+
+
+class ErrorProfile:
+    """Per-position coverage and error profile of an alignment.
+
+    Attributes
+    ----------
+    coverage : np.ndarray
+        Number of reads spanning each position, including deletions.
+    changes : np.ndarray
+        Number of mismatches, insertions and deletions at each position, in the
+        order of `ErrorProfile.KINDS`, before any quality threshold.
+    quality_histogram : np.ndarray
+        Histogram of the change qualities at each position. Qualities are clipped
+        to `MAX_QUALITY`, the last column counts changes without quality.
+    """
+
+    KINDS = ("mismatches", "insertions", "deletions")
+    MAX_QUALITY = 93
+
+    def __init__(self, reference_length: int):
+        self.changes = np.zeros((reference_length, len(self.KINDS)), dtype=np.int64)
+        self.quality_histogram = np.zeros(
+            (reference_length, self.MAX_QUALITY + 2), dtype=np.int64
+        )
+        self._coverage_changes = np.zeros(reference_length + 1, dtype=np.int64)
+        self._kinds = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.changes)
+
+    @property
+    def coverage(self) -> np.ndarray:
+        return np.cumsum(self._coverage_changes[:-1])
+
+    def _kind(self, mutation_codes: np.ndarray, codes: MutationCodes) -> np.ndarray:
+        """Get the index into `KINDS` of mutation codes."""
+        if len(self._kinds) < len(codes):
+            self._kinds = np.array(
                 [
-                    ref_pos,
-                    "del" + str(cigar[1]),
-                    0,
-                ]
+                    0 if "->" in mutation else 1 if mutation.startswith("i") else 2
+                    for mutation in codes.mutations
+                ],
+                dtype=np.int64,
             )
+        return self._kinds[mutation_codes]
 
-            # move reference index
-            ref_pos += cigar[1]
-        elif cigar[0] == 1:  # insertion
-            qualities = read.get_forward_qualities()
+    def add_read(
+        self,
+        read: pysam.AlignedSegment,
+        positions: np.ndarray,
+        mutation_codes: np.ndarray,
+        qualities: np.ndarray,
+        codes: MutationCodes,
+    ):
+        """Add a read and all of its changes."""
+        if read.reference_end is not None:
+            start = min(read.reference_start, len(self))
+            self._coverage_changes[start] += 1
+            self._coverage_changes[min(read.reference_end, len(self))] -= 1
 
-            quality = None
-            if qualities:
-                quality = np.mean(qualities[read_pos : read_pos + cigar[1]])
+        inside = positions < len(self)
+        positions = positions[inside]
+        np.add.at(
+            self.changes, (positions, self._kind(mutation_codes[inside], codes)), 1
+        )
+        bins = np.where(
+            qualities[inside] == MISSING_QUALITY,
+            self.MAX_QUALITY + 1,
+            np.minimum(qualities[inside], self.MAX_QUALITY),
+        )
+        np.add.at(self.quality_histogram, (positions, bins), 1)
 
-            insertion = read.seq[read_pos : read_pos + cigar[1]]
+    def merge(self, other: "ErrorProfile"):
+        """Add the profile of other reads."""
+        self._coverage_changes += other._coverage_changes
+        self.changes += other.changes
+        self.quality_histogram += other.quality_histogram
 
-            # record changes
-            changes.append(
-                [
-                    ref_pos,
-                    "i" + insertion,
-                    quality if quality is not None else 255,
-                ]
+    def to_frame(self) -> pd.DataFrame:
+        """Get the coverage and changes of each position."""
+        profile = pd.DataFrame(self.changes, columns=list(self.KINDS))
+        profile.insert(0, "coverage", self.coverage)
+        profile.insert(0, "position", np.arange(len(self)))
+        profile["error_rate"] = self.changes.sum(axis=1) / np.maximum(
+            profile.coverage, 1
+        )
+        return profile
+
+    def save(self, path: str | Path):
+        """Save the profile as `.npz`, with the columns of `to_frame` next to it."""
+        path = Path(path)
+        self.to_frame().to_csv(path.with_suffix(".csv"), index=False)
+        with open(path, "wb") as file_descriptor:
+            np.savez(
+                file_descriptor,
+                coverage=self.coverage,
+                changes=self.changes,
+                quality_histogram=self.quality_histogram,
             )
 
-            # move read index
-            read_pos += cigar[1]
-        elif cigar[0] == 4:  # soft clipping
-            # move read index
-            read_pos += cigar[1]
+
+class _BatchColumns:
+    """Columns of the changes of a batch of reads."""
+
+    def __init__(self):
+        self.n_reads = 0
+        self.block_ids = {}
+        self.columns = ([], [], [], [], [])
+
+    def add(
+        self,
+        seq_id: int,
+        block_id: str | None,
+        positions: np.ndarray,
+        mutation_codes: np.ndarray,
+        qualities: np.ndarray,
+    ):
+        """Add the changes of a read, block ids are only interned for changes."""
+        self.n_reads += 1
+        if not len(positions):
+            return
+
+        block_id_code = (
+            self.block_ids.setdefault(block_id, len(self.block_ids))
+            if block_id is not None
+            else -1
+        )
+        for column, values in zip(
+            self.columns,
+            (
+                np.full(len(positions), seq_id, dtype=np.int32),
+                np.full(len(positions), block_id_code, dtype=np.int32),
+                positions,
+                mutation_codes,
+                qualities,
+            ),
+        ):
+            column.append(values)
+
+    def batch(self, mutations: list[str]) -> ChangeBatch:
+        """Get the batch of changes."""
+        return ChangeBatch(
+            self.n_reads, _changes_frame(mutations, list(self.block_ids), *self.columns)
+        )
+
+
+def iter_change_batches(
+    reference: str | np.ndarray | Reference,
+    reads: Iterable[pysam.AlignedSegment],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    codes: MutationCodes | None = None,
+    length_threshold: int = 0,
+    quality_threshold: int = 0,
+    stats: Counter | None = None,
+    window: tuple[int, int] | None = None,
+    collapse_identical: bool = False,
+    profile: ErrorProfile | None = None,
+) -> Iterator[ChangeBatch]:
+    """Iterate over the changes in batches of reads.
+
+    Only one batch of changes is held in memory at any time, and the reads are
+    consumed lazily from `reads`. The changes of a read are never split between
+    two batches and `seq_id` enumerates the accepted reads over all batches.
+
+    Both filters are evaluated during extraction: reads that fail the length
+    filter are never decoded and changes below the quality threshold are never
+    materialized.
+
+    The changes are stored in a compact table with int32 "seq_id" and "position",
+    uint8 "quality" and categorical "block_id" and "mutation" columns. Mutation
+    codes are shared by all batches, so that the integer codes of the "mutation"
+    column can be used as keys over the whole alignment.
+
+    Parameters
+    ----------
+    reference : str | np.ndarray | Reference
+        Reference sequence, or reference whose contigs are looked up by the
+        `reference_name` of each read.
+    reads : Iterable[pysam.AlignedSegment]
+        Aligned reads, e.g. a `pysam.AlignmentFile`.
+    batch_size : int
+        Number of reads per batch.
+    codes : MutationCodes | None
+        Table used to encode the mutations. A new table is created if None.
+    length_threshold : int
+        Reject reads whose reference and query lengths differ by at least this
+        value. Disabled if 0.
+    quality_threshold : int
+        Minimum quality of a change. Disabled if 0.
+    stats : Counter | None
+        Counter to which the number of "reads", "reads_rejected_length",
+        "changes" and "changes_rejected_quality" are added.
+    window : tuple[int, int] | None
+        Only keep the changes whose position lies in `[start, end)`, so that reads
+        are clipped to the window.
+    collapse_identical : bool
+        Decode reads with identical start, cigar and sequence only once per batch.
+        The qualities of the changes are still taken from each read, so the
+        batches are the same as without collapsing. The number of collapsed reads
+        is added to "reads_collapsed" of `stats`.
+    profile : ErrorProfile | None
+        Profile to which all accepted reads and their changes are added before
+        the quality threshold and the window are applied.
+
+    Yields
+    ------
+    ChangeBatch
+        Changes of consecutive reads.
+    """
+    reference_of = _reference_lookup(reference)
+
+    if codes is None:
+        codes = MutationCodes()
+
+    if stats is None:
+        stats = Counter()
+
+    seq_id = -1
+    batch = _BatchColumns()
+    read_spans = {}
+    for read in reads:
+        stats["reads"] += 1
+        if (
+            length_threshold
+            and abs(read.reference_length - read.query_length) >= length_threshold
+        ):
+            stats["reads_rejected_length"] += 1
+            continue
+
+        seq_id += 1
+        # the profile needs all changes, so they are only thresholded afterwards
+        min_quality = quality_threshold if profile is None else 0
+        if collapse_identical:
+            sequence = (read.query_sequence or "").encode("ascii")
+            key = (
+                read.reference_id,
+                read.reference_start,
+                read.cigarstring,
+                blake2b(sequence, digest_size=16).digest(),
+            )
+            spans = read_spans.get(key)
+            if spans is None:
+                spans = read_spans[key] = _change_spans(reference_of(read), read, codes)
+            else:
+                stats["reads_collapsed"] += 1
+            read_positions, read_codes, read_qualities = _filter_changes(
+                _read_qualities(read), *spans, min_quality, stats
+            )
         else:
-            raise IndexError(f"Unknown cigar operation: {cigar[0]}")
-    return changes
+            read_positions, read_codes, read_qualities = changes_arrays_from_read(
+                reference_of(read), read, codes, min_quality=min_quality, stats=stats
+            )
+        if profile is not None:
+            profile.add_read(read, read_positions, read_codes, read_qualities, codes)
+            if quality_threshold > 0:
+                keep = read_qualities >= quality_threshold
+                stats["changes_rejected_quality"] += len(keep) - np.count_nonzero(keep)
+                read_positions = read_positions[keep]
+                read_codes = read_codes[keep]
+                read_qualities = read_qualities[keep]
+        if window is not None:
+            inside = (read_positions >= window[0]) & (read_positions < window[1])
+            read_positions = read_positions[inside]
+            read_codes = read_codes[inside]
+            read_qualities = read_qualities[inside]
+        batch.add(seq_id, _block_id(read), read_positions, read_codes, read_qualities)
+
+        if batch.n_reads == batch_size:
+            yield batch.batch(codes.mutations)
+            batch = _BatchColumns()
+            read_spans = {}
+
+    if batch.n_reads:
+        yield batch.batch(codes.mutations)
+
+
+def _vote_family(
+    positions: np.ndarray,
+    mutation_codes: np.ndarray,
+    qualities: np.ndarray,
+    weights: np.ndarray,
+    n_reads: int,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Keep the changes of a family whose summed weight exceeds half of its reads.
+
+    The changes are returned sorted by position and code, with the floored mean
+    quality of the reads that carry them.
+    """
+    keys = positions.astype(np.int64) << 32 | mutation_codes.astype(np.int64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    support = np.bincount(inverse, weights=weights, minlength=len(unique_keys))
+    carriers = np.bincount(inverse, minlength=len(unique_keys))
+    quality_sums = np.bincount(inverse, weights=qualities, minlength=len(unique_keys))
+    keep = support > n_reads / 2
+    return (
+        (unique_keys[keep] >> 32).astype(np.int32),
+        (unique_keys[keep] & 0xFFFFFFFF).astype(np.int32),
+        (quality_sums[keep] // carriers[keep]).astype(np.uint8),
+    )
+
+
+def iter_family_change_batches(
+    reference: str | np.ndarray | Reference,
+    reads: Iterable[pysam.AlignedSegment],
+    vote: str = "majority",
+    name_sorted: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    codes: MutationCodes | None = None,
+    length_threshold: int = 0,
+    quality_threshold: int = 0,
+    stats: Counter | None = None,
+) -> Iterator[ChangeBatch]:
+    """Iterate over the consensus changes of read families in batches.
+
+    Reads with the same block id form a family, which is collapsed into a single
+    set of changes by a vote of its reads. Reads without block id are families of
+    their own. Each family counts as one read of the batches, with "seq_id"
+    enumerating the families.
+
+    With `name_sorted` the reads of a family must be consecutive, and families are
+    streamed. Otherwise all families are held in memory until the reads are
+    exhausted, and are returned in order of their first read.
+
+    Parameters
+    ----------
+    reference : str | np.ndarray | Reference
+        Reference sequence, or reference whose contigs are looked up by the
+        `reference_name` of each read.
+    reads : Iterable[pysam.AlignedSegment]
+        Aligned reads, e.g. a `pysam.AlignmentFile`.
+    vote : str
+        One of `FAMILY_VOTES`. With "majority" a change is kept if it is carried by
+        more than half of the reads of its family. With "quality" each read votes
+        with the probability that its change is correct according to the Phred
+        quality, deletions, which have no quality, vote with one.
+    name_sorted : bool
+        Whether the reads of each family are consecutive.
+    batch_size : int
+        Number of families per batch.
+    codes : MutationCodes | None
+        Table used to encode the mutations. A new table is created if None.
+    length_threshold : int
+        Reject reads whose reference and query lengths differ by at least this
+        value. Disabled if 0.
+    quality_threshold : int
+        Minimum quality of a change before voting. Disabled if 0.
+    stats : Counter | None
+        Counter to which the number of "reads", "reads_rejected_length",
+        "changes", "changes_rejected_quality" and "families" are added.
+
+    Yields
+    ------
+    ChangeBatch
+        Consensus changes of consecutive families.
+    """
+    if vote not in FAMILY_VOTES:
+        raise ValueError(f"Unknown vote: {vote}")
+
+    reference_of = _reference_lookup(reference)
+
+    if codes is None:
+        codes = MutationCodes()
+
+    if stats is None:
+        stats = Counter()
+
+    def _families():
+        """Yield the block id, number of reads and changes of complete families."""
+        families = {}
+        current = None
+        for read in reads:
+            stats["reads"] += 1
+            if (
+                length_threshold
+                and abs(read.reference_length - read.query_length) >= length_threshold
+            ):
+                stats["reads_rejected_length"] += 1
+                continue
+
+            read_changes = changes_arrays_from_read(
+                reference_of(read),
+                read,
+                codes,
+                min_quality=quality_threshold,
+                stats=stats,
+            )
+            block_id = _block_id(read)
+            key = block_id if block_id is not None else object()
+            if name_sorted and key != current:
+                yield from families.values()
+                families.clear()
+            current = key
+            family = families.setdefault(key, [block_id, 0, []])
+            family[1] += 1
+            family[2].append(read_changes)
+        yield from families.values()
+
+    seq_id = -1
+    batch = _BatchColumns()
+    for block_id, n_reads, family_changes in _families():
+        positions, mutation_codes, qualities = (
+            np.concatenate(arrays) for arrays in zip(*family_changes)
+        )
+        if vote == "quality":
+            deletion = np.array(
+                [codes.mutations[code].startswith("del") for code in mutation_codes],
+                dtype=bool,
+            )
+            error = 10 ** (-qualities.astype(float) / 10)
+            weights = np.where(deletion, 1.0, 1 - error)
+        else:
+            weights = np.ones(len(positions))
+
+        seq_id += 1
+        stats["families"] += 1
+        batch.add(
+            seq_id,
+            block_id,
+            *_vote_family(positions, mutation_codes, qualities, weights, n_reads),
+        )
+
+        if batch.n_reads == batch_size:
+            yield batch.batch(codes.mutations)
+            batch = _BatchColumns()
+
+    if batch.n_reads:
+        yield batch.batch(codes.mutations)
 
 
 def changes_from_alignment(
-    reference: str,
+    reference: str | np.ndarray | Reference,
     alignment: pysam.AlignmentFile,
-):
-    """Retrieve all changes in an alignment."""
-    BLOCK_ID_REGEX = re.compile(r"block_id=(\w+);")
-
-    changes = []
-    for seq_id, read in enumerate(alignment):
-        block_id_match = BLOCK_ID_REGEX.search(read.query_name)
-        block_id = block_id_match.group(1) if block_id_match else None
-        read_changes = changes_from_read(reference, read)
-        if read_changes:
-            changes += [(seq_id, block_id, changes_from_read(reference, read))]
-
-    if not changes:
-        return pd.DataFrame(
-            [], columns=["seq_id", "block_id", "position", "mutation", "quality"]
-        )
+) -> pd.DataFrame:
+    """Retrieve all changes in an alignment.
 
-    # construct dataframe
-    changes = pd.DataFrame(changes, columns=["seq_id", "block_id", "changes"])
-    changes = changes.explode("changes").reset_index(drop=True)
+    Returns
+    -------
+    pd.DataFrame
+        Compact table of changes, see `iter_change_batches`.
+    """
+    codes = MutationCodes()
+    batches = [
+        batch.changes
+        for batch in iter_change_batches(reference, alignment, codes=codes)
+    ]
 
-    # inplace modifications
-    changes[["position", "mutation", "quality"]] = [*changes["changes"]]
-    changes.drop("changes", axis=1, inplace=True)
+    if not batches:
+        return _changes_frame(codes.mutations, [], [], [], [], [], [])
 
+    changes = pd.concat(
+        [batch.drop(columns=["block_id", "mutation"]) for batch in batches],
+        ignore_index=True,
+    )
+    changes.insert(
+        1,
+        "block_id",
+        union_categoricals([batch.block_id for batch in batches]),
+    )
+    # all batches share the codes of the mutations
+    changes.insert(
+        3,
+        "mutation",
+        pd.Categorical.from_codes(
+            np.concatenate([batch.mutation.cat.codes for batch in batches]),
+            categories=codes.mutations,
+        ),
+    )
     return changes
+
+
+def _aligned_bases(
+    read: pysam.AlignedSegment, min_quality: int
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """Get the reference positions and base indices of the aligned bases of a read.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray, int]
+        Reference positions and `PILEUP_BASES` indices of the aligned bases with a
+        quality of at least `min_quality`, and the number of rejected bases.
+    """
+    if read.cigartuples is None:
+        # unmapped reads have no aligned bases
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), 0
+
+    cigar = np.array(read.cigartuples, dtype=np.int64).reshape(-1, 2)
+    operations, lengths = cigar[:, 0], cigar[:, 1]
+
+    known = _KNOWN_OPERATIONS[operations]
+    if not known.all():
+        raise IndexError(f"Unknown cigar operation: {operations[~known][0]}")
+
+    read_lengths = lengths * _CONSUMES_READ[operations]
+    reference_lengths = lengths * _CONSUMES_REFERENCE[operations]
+    read_starts = np.cumsum(read_lengths) - read_lengths
+    reference_starts = (
+        read.reference_start + np.cumsum(reference_lengths) - reference_lengths
+    )
+
+    aligned = (_CONSUMES_READ[operations] & _CONSUMES_REFERENCE[operations]) > 0
+    read_index = _ranges(read_starts[aligned], lengths[aligned])
+    reference_index = _ranges(reference_starts[aligned], lengths[aligned])
+
+    # unlike the changes, bases are filtered by the qualities of `query_sequence`
+    qualities = read.query_qualities
+    n_rejected = 0
+    if min_quality > 0 and qualities:
+        keep = np.frombuffer(qualities, dtype=np.uint8)[read_index] >= min_quality
+        n_rejected = len(keep) - np.count_nonzero(keep)
+        read_index = read_index[keep]
+        reference_index = reference_index[keep]
+
+    bases = _PILEUP_INDEX[encode_sequence(read.query_sequence)[read_index]]
+    return reference_index, bases, n_rejected
+
+
+def pileup_from_reads(
+    reference_length: int,
+    reads: Iterable[pysam.AlignedSegment],
+    min_quality: int = 0,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    stats: Counter | None = None,
+) -> tuple[np.ndarray, int]:
+    """Count the bases aligned to each reference position.
+
+    Only aligned bases (`M`, `=` and `X` operations) are counted, insertions and
+    deletions are ignored. Reads are accumulated in batches, so memory only depends
+    on the reference length and `batch_size`.
+
+    Parameters
+    ----------
+    reference_length : int
+        Length of the reference.
+    reads : Iterable[pysam.AlignedSegment]
+        Aligned reads.
+    min_quality : int
+        Minimum quality of the counted bases. Bases of reads without qualities are
+        always counted.
+    batch_size : int
+        Number of reads accumulated before they are added to the counts.
+    stats : Counter | None
+        Counter to which the number of "reads", "bases" and
+        "bases_rejected_quality" are added.
+
+    Returns
+    -------
+    tuple[np.ndarray, int]
+        Counts of shape `(reference_length, len(PILEUP_BASES))` and the number of
+        reads.
+    """
+    if stats is None:
+        stats = Counter()
+
+    n_columns = len(PILEUP_BASES)
+    counts = np.zeros(reference_length * n_columns, dtype=np.int64)
+    n_reads = 0
+    batch = []
+
+    def _add_batch():
+        if batch:
+            counts[:] += np.bincount(np.concatenate(batch), minlength=len(counts))
+            batch.clear()
+
+    for read in reads:
+        n_reads += 1
+        positions, bases, n_rejected = _aligned_bases(read, min_quality)
+        stats["bases"] += len(positions) + n_rejected
+        stats["bases_rejected_quality"] += n_rejected
+        batch.append(positions * n_columns + bases)
+        if len(batch) == batch_size:
+            _add_batch()
+    _add_batch()
+
+    stats["reads"] += n_reads
+    return counts.reshape(reference_length, n_columns), n_reads
+
+
+def _read_stratum(read: pysam.AlignedSegment, stratify: str) -> str | None:
+    """Get the block id or read group of a read."""
+    if stratify == "block_id":
+        return _block_id(read)
+    return read.get_tag("RG") if read.has_tag("RG") else None
+
+
+def count_read_strata(reads: Iterable[pysam.AlignedSegment], stratify: str) -> Counter:
+    """Count the reads of each block id or read group.
+
+    Reads without a block id or read group are counted under None.
+    """
+    return Counter(_read_stratum(read, stratify) for read in reads)
+
+
+def _allocate(strata: Counter, n_samples: int) -> dict:
+    """Allocate samples to strata in proportion to their size.
+
+    The remaining samples after rounding down go to the strata with the largest
+    remainders.
+    """
+    total = sum(strata.values())
+    if total <= n_samples:
+        return dict(strata)
+
+    quotas = {stratum: n_samples * size / total for stratum, size in strata.items()}
+    sizes = {stratum: int(quota) for stratum, quota in quotas.items()}
+    n_remaining = n_samples - sum(sizes.values())
+    by_remainder = sorted(quotas, key=lambda stratum: sizes[stratum] - quotas[stratum])
+    for stratum in by_remainder[:n_remaining]:
+        sizes[stratum] += 1
+    return sizes
+
+
+def sample_reads(
+    reads: Iterable[pysam.AlignedSegment],
+    max_reads: int,
+    random_state: int = 42,
+    stratify: str | None = None,
+    strata: Counter | None = None,
+    stats: Counter | None = None,
+) -> list[pysam.AlignedSegment]:
+    """Sample reads uniformly without replacement in a single pass.
+
+    Reads are sampled by reservoir sampling, so only `max_reads` reads are held in
+    memory and none of them is parsed. The sampled reads are returned in their
+    original order, so that sorted alignments stay sorted.
+
+    Parameters
+    ----------
+    reads : Iterable[pysam.AlignedSegment]
+        Aligned reads.
+    max_reads : int
+        Maximum number of sampled reads.
+    random_state : int
+        Seed of the sampling.
+    stratify : str | None
+        One of `READ_STRATA`. If given, the reads of each block id or read group
+        are sampled separately, in proportion to the number of reads in `strata`.
+    strata : Counter | None
+        Number of reads of each stratum, see `count_read_strata`. Required with
+        `stratify`.
+    stats : Counter | None
+        Counter to which the number of "reads_before_sampling" is added.
+
+    Returns
+    -------
+    list[pysam.AlignedSegment]
+        Sampled reads.
+    """
+    if stratify is not None and strata is None:
+        raise ValueError("Stratified sampling requires the size of each stratum.")
+
+    if stats is None:
+        stats = Counter()
+
+    rng = random.Random(random_state)
+    sizes = None if stratify is None else _allocate(strata, max_reads)
+    n_seen = Counter()
+    reservoirs = defaultdict(list)
+    for index, read in enumerate(reads):
+        stratum = None if stratify is None else _read_stratum(read, stratify)
+        size = max_reads if sizes is None else sizes.get(stratum, 0)
+        n_seen[stratum] += 1
+        reservoir = reservoirs[stratum]
+        if len(reservoir) < size:
+            reservoir.append((index, read))
+        else:
+            replace = rng.randrange(n_seen[stratum])
+            if replace < size:
+                reservoir[replace] = (index, read)
+
+    stats["reads_before_sampling"] += sum(n_seen.values())
+    sampled = sorted(
+        (item for reservoir in reservoirs.values() for item in reservoir),
+        key=lambda item: item[0],
+    )
+    return [read for _index, read in sampled]
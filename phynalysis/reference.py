@@ -0,0 +1,159 @@
+"""Indexed reference sequences.
+
+References are read through a faidx index with `pysam.FastaFile`, which is created
+next to the FASTA file if it is missing. FASTA files that cannot be indexed, e.g.
+with lines of different lengths within a record, are read without an index. The
+sequence and the uint8 encoded array of each contig are cached in the process, and
+the arrays can also be cached as `<fasta>.<contig index>.npy` files next to the
+FASTA file.
+
+References are shared through `load_reference`, so that each FASTA file is only
+opened once per process.
+
+## Example:
+
+```python
+reference = load_reference("reference.fasta")
+encoded = reference.encoded(read.reference_name)
+```
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pysam
+
+__all__ = ["Reference", "load_reference"]
+
+_REFERENCES = {}
+
+
+def _read_fasta(path: Path) -> dict[str, str]:
+    """Read the sequences of a FASTA file, named by the first word of their header."""
+    sequences = {}
+    name = None
+    with open(path, "r", encoding="utf8") as file_descriptor:
+        for line in file_descriptor:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].split(maxsplit=1)[0] if len(line) > 1 else ""
+                sequences[name] = []
+            elif line and name is not None:
+                sequences[name].append(line)
+    return {name: "".join(lines) for name, lines in sequences.items()}
+
+
+class Reference:
+    """Indexed reference with cached sequences of its contigs.
+
+    Attributes
+    ----------
+    path : Path
+        Path to the FASTA file.
+    contigs : tuple[str, ...]
+        Names of the contigs in file order.
+    lengths : dict[str, int]
+        Length of each contig.
+    cache_arrays : bool
+        Cache the encoded contigs as `.npy` files next to the FASTA file.
+    """
+
+    def __init__(self, path: str | Path, cache_arrays: bool = False):
+        self.path = Path(path)
+        self.cache_arrays = cache_arrays
+        self._sequences = {}
+        self._encoded = {}
+        try:
+            self._fasta = pysam.FastaFile(str(self.path))
+        except OSError:
+            logging.warning("Cannot index %s, reading it without an index.", path)
+            self._fasta = None
+            self._sequences = _read_fasta(self.path)
+            self.contigs = tuple(self._sequences)
+            self.lengths = {name: len(seq) for name, seq in self._sequences.items()}
+        else:
+            self.contigs = tuple(self._fasta.references)
+            self.lengths = dict(zip(self.contigs, self._fasta.lengths))
+
+    def __len__(self):
+        return len(self.contigs)
+
+    def __getstate__(self):
+        # the FASTA handle cannot be pickled and is reopened instead
+        return {"path": self.path, "cache_arrays": self.cache_arrays}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _contig(self, contig: str | None) -> str:
+        """Get the name of a contig, or of the first contig if None."""
+        if contig is None:
+            return self.contigs[0]
+        if contig not in self.lengths:
+            raise KeyError(f"Unknown contig {contig} in {self.path}")
+        return contig
+
+    def sequence(self, contig: str | None = None) -> str:
+        """Get the sequence of a contig, by default the first one."""
+        contig = self._contig(contig)
+        if contig not in self._sequences:
+            self._sequences[contig] = self._fasta.fetch(contig)
+        return self._sequences[contig]
+
+    def encoded(self, contig: str | None = None) -> np.ndarray:
+        """Get the sequence of a contig as an array of bytes."""
+        contig = self._contig(contig)
+        if contig not in self._encoded:
+            self._encoded[contig] = self._load_encoded(contig)
+        return self._encoded[contig]
+
+    def _array_path(self, contig: str) -> Path:
+        """Get the path of the cached array of a contig."""
+        index = self.contigs.index(contig)
+        return self.path.with_name(f"{self.path.name}.{index}.npy")
+
+    def _load_encoded(self, contig: str) -> np.ndarray:
+        """Encode a contig, or load it from its cached array if it is up to date."""
+        if not self.cache_arrays:
+            return np.frombuffer(self.sequence(contig).encode("ascii"), dtype=np.uint8)
+
+        array_path = self._array_path(contig)
+        if (
+            array_path.exists()
+            and os.stat(array_path).st_mtime_ns >= os.stat(self.path).st_mtime_ns
+        ):
+            encoded = np.load(array_path, mmap_mode="r")
+            if len(encoded) == self.lengths[contig]:
+                return encoded
+
+        encoded = np.frombuffer(self.sequence(contig).encode("ascii"), dtype=np.uint8)
+        # write through a file object, so that numpy does not change the suffix
+        with open(array_path, "wb") as file_descriptor:
+            np.save(file_descriptor, encoded)
+        return encoded
+
+
+def load_reference(path: str | Path, cache_arrays: bool = False) -> Reference:
+    """Load a reference, or get it from the references loaded in this process.
+
+    Parameters
+    ----------
+    path : str | Path
+        Path to the FASTA file.
+    cache_arrays : bool
+        Cache the encoded contigs as `.npy` files next to the FASTA file.
+
+    Returns
+    -------
+    Reference
+        The shared reference.
+    """
+    path = Path(path)
+    # a rewritten FASTA file is loaded again
+    key = (path.resolve(), os.stat(path).st_mtime_ns)
+    reference = _REFERENCES.get(key)
+    if reference is None or reference.cache_arrays != cache_arrays:
+        reference = _REFERENCES[key] = Reference(path, cache_arrays=cache_arrays)
+    return reference
@@ -6,25 +6,35 @@ Glossary:
         - as a list: [(position, mutation), (position, mutation), ...]
         - as a set: {(position, mutation), (position, mutation), ...}
         - as a dictionary: {position: mutation, position: mutation, ...}
+        - as a `Haplotype`: arrays of positions and codes into a mutation table
     - change: A tuple of position and mutation
     - mutation: A string representing a change
         format: "<reference>-><mutation>"
-    - haplotypes: A list of haplotypes
+    - haplotypes: A list of haplotypes, or a `HaplotypeCollection`
 """
 
 __all__ = [
+    "AlignmentView",
+    "Haplotype",
+    "HaplotypeCollection",
+    "parse_haplotypes",
+    "format_haplotypes",
     "haplotype_to_list",
     "haplotype_to_set",
     "haplotype_to_dict",
     "haplotype_to_string",
+    "haplotypes_to_alignment",
     "haplotypes_to_sequences",
+    "aligned_length",
+    "iter_sequences",
     "haplotypes_to_matrix",
     "haplotypes_to_frequencies",
 ]
 
-from typing import Tuple, Union
+from typing import Iterable, Iterator, Tuple, Union
 
 import numpy as np
+import pandas as pd
 
 Substitution = tuple
 Insertion = str
@@ -36,7 +46,20 @@ HaplotypeList = list[Change]
 HaplotypeSet = set[Change]
 HaplotypeDict = dict[int, str]
 
-Haplotype = Union[str, HaplotypeList, HaplotypeSet, HaplotypeDict]
+HaplotypeLike = Union[str, HaplotypeList, HaplotypeSet, HaplotypeDict, "Haplotype"]
+
+_CONSENSUS = ["consensus", "wt", "wildtype"]
+
+# mutations of up to this many bytes are interned through packed integer keys
+_PACKED_LENGTH = 8
+
+# number of haplotypes aligned at a time by `iter_sequences`
+DEFAULT_CHUNK_SIZE = 1024
+
+# kinds of mutations in an alignment
+_SUBSTITUTION = 0
+_INSERTION = 1
+_DELETION = 2
 
 _ENCODING = {
     "A": 0,
@@ -66,6 +89,20 @@ _ENCODE_NT = {
 }
 
 
+# bytes of the bases, with the digits of `_ENCODING` translated to their base
+_BASE_BYTES = np.arange(256, dtype=np.uint8)
+_BASE_BYTES[np.frombuffer(b"0123", dtype=np.uint8)] = np.frombuffer(
+    b"ATCG", dtype=np.uint8
+)
+
+# symbols counted by `AlignmentView.base_counts`, in the order of `_ENCODING`
+_COUNTED_SYMBOLS = b"ATCG-"
+_SYMBOL_INDEX = np.full(256, -1, dtype=np.int64)
+_SYMBOL_INDEX[np.frombuffer(_COUNTED_SYMBOLS, dtype=np.uint8)] = np.arange(
+    len(_COUNTED_SYMBOLS)
+)
+
+
 def _encoder(change: Change) -> Change:
     """Internal encoder."""
     return (change[0], _ENCODING[change[1]])
@@ -114,7 +151,375 @@ def _get_position(change: Change) -> int:
     return change[0]
 
 
-def haplotype_to_list(haplotype: Haplotype) -> HaplotypeList:
+def _code_dtype(n_mutations: int) -> np.dtype:
+    """Get the smallest unsigned dtype of the codes into a mutation table."""
+    return np.min_scalar_type(max(n_mutations - 1, 0))
+
+
+class Haplotype:
+    """Compact haplotype of sorted changes.
+
+    The mutations are stored as codes into a mutation table, which is shared by
+    all haplotypes of a `HaplotypeCollection`.
+
+    Attributes
+    ----------
+    positions : np.ndarray
+        Position of each change as int32.
+    codes : np.ndarray
+        Index into `mutations` of each change, uint8 for up to 256 mutations.
+    mutations : list[str]
+        Mutation table.
+    """
+
+    __slots__ = ("positions", "codes", "mutations")
+
+    def __init__(self, positions: np.ndarray, codes: np.ndarray, mutations: list[str]):
+        self.positions = positions
+        self.codes = codes
+        self.mutations = mutations
+
+    @classmethod
+    def from_string(cls, haplotype: str) -> "Haplotype":
+        """Parse a haplotype from its string representation."""
+        return HaplotypeCollection.from_strings([haplotype])[0]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self) -> Iterator[tuple[int, str]]:
+        """Iterate over the position and mutation string of each change."""
+        mutations = self.mutations
+        for position, code in zip(self.positions.tolist(), self.codes.tolist()):
+            yield position, mutations[code]
+
+    def __eq__(self, other):
+        if not isinstance(other, Haplotype):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return f"Haplotype({self.to_string()!r})"
+
+    def to_string(self) -> str:
+        """Get the string representation of the haplotype."""
+        if not len(self):
+            return "consensus"
+        return ";".join(f"{position}:{mutation}" for position, mutation in self)
+
+    def to_list(self) -> HaplotypeList:
+        """Get the list representation of the haplotype."""
+        return [(position, _parse_mutation(mutation)) for position, mutation in self]
+
+
+class HaplotypeCollection:
+    """Many haplotypes in CSR layout.
+
+    The changes of haplotype `i` are `offsets[i]:offsets[i + 1]` of `positions` and
+    `codes`. Slices share the arrays of the collection, so `offsets` does not
+    need to start at 0.
+
+    Attributes
+    ----------
+    offsets : np.ndarray
+        Offsets of the changes of each haplotype as int64.
+    positions : np.ndarray
+        Position of each change as int32.
+    codes : np.ndarray
+        Index into `mutations` of each change, uint8 for up to 256 mutations.
+    counts : np.ndarray
+        Count of each haplotype as int64.
+    mutations : list[str]
+        Mutation table.
+    """
+
+    def __init__(
+        self,
+        offsets: np.ndarray,
+        positions: np.ndarray,
+        codes: np.ndarray,
+        counts: np.ndarray,
+        mutations: list[str],
+    ):
+        self.offsets = offsets
+        self.positions = positions
+        self.codes = codes
+        self.counts = counts
+        self.mutations = mutations
+
+    @classmethod
+    def from_strings(
+        cls,
+        haplotypes: Iterable[str],
+        counts: Iterable[int] | None = None,
+    ) -> "HaplotypeCollection":
+        """Parse haplotypes from their string representation.
+
+        Parameters
+        ----------
+        haplotypes : Iterable[str]
+            Haplotype strings, "consensus", "wt", "wildtype" and empty strings are
+            haplotypes without changes.
+        counts : Iterable[int] | None
+            Count of each haplotype, by default 1.
+        """
+        return parse_haplotypes(haplotypes, counts)
+
+    def to_strings(self) -> list[str]:
+        """Get the string representation of each haplotype."""
+        return format_haplotypes(self)
+
+    @property
+    def n_changes(self) -> np.ndarray:
+        """Number of changes of each haplotype."""
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[Haplotype]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def take(self, index: np.ndarray) -> "HaplotypeCollection":
+        """Get a copy of the haplotypes at the given indices."""
+        index = np.asarray(index, dtype=np.int64)
+        n_changes = self.n_changes[index]
+        starts = np.repeat(self.offsets[index], n_changes)
+        changes = (
+            starts
+            + np.arange(n_changes.sum())
+            - np.repeat(np.cumsum(n_changes) - n_changes, n_changes)
+        )
+        return HaplotypeCollection(
+            np.concatenate([[0], np.cumsum(n_changes)]),
+            self.positions[changes],
+            self.codes[changes],
+            self.counts[index],
+            self.mutations,
+        )
+
+    def __getitem__(self, key: int | slice):
+        """Get a haplotype, or a collection of consecutive haplotypes.
+
+        Both share the arrays of this collection.
+        """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("Only consecutive haplotypes can be sliced.")
+            stop = max(start, stop)
+            return HaplotypeCollection(
+                self.offsets[start : stop + 1],
+                self.positions,
+                self.codes,
+                self.counts[start:stop],
+                self.mutations,
+            )
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Haplotype index out of range.")
+        start, stop = self.offsets[key], self.offsets[key + 1]
+        return Haplotype(
+            self.positions[start:stop], self.codes[start:stop], self.mutations
+        )
+
+
+def _pack_mutations(
+    buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray
+) -> np.ndarray:
+    """Pack mutations of up to `_PACKED_LENGTH` bytes into integer keys.
+
+    Mutations are ASCII, so the zero padding of shorter mutations is unique.
+    """
+    padded = np.concatenate([buffer, np.zeros(_PACKED_LENGTH, dtype=np.uint8)])
+    keys = np.zeros(len(starts), dtype=np.uint64)
+    for k in range(_PACKED_LENGTH):
+        keys |= padded[starts + k].astype(np.uint64) << np.uint64(8 * k)
+    masks = np.array(
+        [(1 << (8 * length)) - 1 for length in range(_PACKED_LENGTH + 1)],
+        dtype=np.uint64,
+    )
+    return keys & masks[lengths]
+
+
+def parse_haplotypes(
+    haplotypes: Iterable[str],
+    counts: Iterable[int] | None = None,
+) -> HaplotypeCollection:
+    """Parse many haplotype strings at once.
+
+    All haplotypes are joined into one byte buffer, in which the separators of the
+    changes are located and the positions are decoded with vectorized operations.
+    Mutations of up to 8 bytes are interned through packed integer keys, only
+    longer insertions are interned one by one.
+
+    Parameters
+    ----------
+    haplotypes : Iterable[str]
+        Haplotype strings, e.g. a column of a haplotypes table. "consensus", "wt",
+        "wildtype", empty strings and missing values are haplotypes without
+        changes.
+    counts : Iterable[int] | None
+        Count of each haplotype, by default 1.
+
+    Returns
+    -------
+    HaplotypeCollection
+        The parsed haplotypes. The mutation table holds the short mutations in
+        order of appearance, followed by the long ones.
+    """
+    values = pd.Series(haplotypes, dtype=object).fillna("").to_numpy()
+    empty = np.isin(values, ["", *_CONSENSUS])
+    n_changes = np.zeros(len(values), dtype=np.int64)
+    counts = (
+        np.ones(len(values), dtype=np.int64)
+        if counts is None
+        else np.asarray(list(counts), dtype=np.int64)
+    )
+
+    if empty.all():
+        return HaplotypeCollection(
+            offsets=np.zeros(len(values) + 1, dtype=np.int64),
+            positions=np.empty(0, dtype=np.int32),
+            codes=np.empty(0, dtype=np.uint8),
+            counts=counts,
+            mutations=[],
+        )
+
+    # every change ends with ";" or with the newline after its haplotype
+    text = "\n".join(values[~empty].tolist()) + "\n"
+    buffer = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    colons = np.flatnonzero(buffer == ord(":"))
+    is_newline = buffer == ord("\n")
+    ends = np.flatnonzero(is_newline | (buffer == ord(";")))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    if len(colons) != len(ends) or not ((starts < colons) & (colons < ends - 1)).all():
+        raise ValueError("Malformed haplotypes.")
+
+    n_changes[~empty] = np.diff(
+        np.searchsorted(ends, np.flatnonzero(is_newline), side="right"), prepend=0
+    )
+
+    # decode the positions digit by digit from the right
+    n_digits = colons - starts
+    positions = np.zeros(len(colons), dtype=np.int64)
+    for k in range(n_digits.max()):
+        has_digit = n_digits > k
+        digits = buffer[colons[has_digit] - 1 - k].astype(np.int64) - ord("0")
+        if ((digits < 0) | (digits > 9)).any():
+            raise ValueError("Malformed haplotype positions.")
+        positions[has_digit] += digits * 10**k
+
+    # intern the mutations
+    mutation_starts = colons + 1
+    mutation_lengths = ends - mutation_starts
+    is_short = mutation_lengths <= _PACKED_LENGTH
+    short = np.flatnonzero(is_short)
+    short_codes, _keys = pd.factorize(
+        _pack_mutations(buffer, mutation_starts[short], mutation_lengths[short])
+    )
+    # codes are numbered in order of appearance, so each first use raises the max
+    first = np.flatnonzero(
+        short_codes > np.maximum.accumulate(np.concatenate([[-1], short_codes[:-1]]))
+    )
+    mutations = [
+        text[start : start + length]
+        for start, length in zip(
+            mutation_starts[short[first]].tolist(),
+            mutation_lengths[short[first]].tolist(),
+        )
+    ]
+    long = np.flatnonzero(~is_short)
+    long_codes, long_mutations = pd.factorize(
+        np.array(
+            [
+                text[start : start + length]
+                for start, length in zip(
+                    mutation_starts[long].tolist(), mutation_lengths[long].tolist()
+                )
+            ],
+            dtype=object,
+        )
+    )
+    codes = np.empty(len(colons), dtype=np.int64)
+    codes[short] = short_codes
+    codes[long] = long_codes + len(mutations)
+    mutations += list(long_mutations)
+
+    return HaplotypeCollection(
+        offsets=np.concatenate([[0], np.cumsum(n_changes)]),
+        positions=positions.astype(np.int32),
+        codes=codes.astype(_code_dtype(len(mutations))),
+        counts=counts,
+        mutations=mutations,
+    )
+
+
+def format_haplotypes(collection: HaplotypeCollection) -> list[str]:
+    """Format many haplotypes as strings at once.
+
+    The changes of all haplotypes are written into one byte buffer, with the digits
+    of the positions and the bytes of the mutations copied by vectorized
+    operations, which is then split into the haplotypes.
+
+    Returns
+    -------
+    list[str]
+        String representation of each haplotype, "consensus" for haplotypes without
+        changes.
+    """
+    start, stop = collection.offsets[0], collection.offsets[-1]
+    n_changes = collection.n_changes
+    strings = np.full(len(collection), "consensus", dtype=object)
+    if stop == start:
+        return strings.tolist()
+
+    positions = collection.positions[start:stop].astype(np.int64)
+    codes = collection.codes[start:stop]
+    table = [mutation.encode("ascii") for mutation in collection.mutations]
+    table_lengths = np.array([len(mutation) for mutation in table], dtype=np.int64)
+    table_starts = np.cumsum(table_lengths) - table_lengths
+    table_bytes = np.frombuffer(b"".join(table), dtype=np.uint8)
+
+    # each change is written as "<position>:<mutation>;"
+    n_digits = np.ones(len(positions), dtype=np.int64)
+    power = 10
+    while (positions >= power).any():
+        n_digits += positions >= power
+        power *= 10
+    mutation_lengths = table_lengths[codes]
+    change_ends = np.cumsum(n_digits + mutation_lengths + 2)
+    colons = change_ends - mutation_lengths - 2
+    buffer = np.empty(change_ends[-1], dtype=np.uint8)
+
+    remainders = positions.copy()
+    for k in range(n_digits.max()):
+        has_digit = n_digits > k
+        buffer[colons[has_digit] - 1 - k] = ord("0") + remainders[has_digit] % 10
+        remainders //= 10
+    buffer[colons] = ord(":")
+
+    within = np.arange(mutation_lengths.sum()) - np.repeat(
+        np.cumsum(mutation_lengths) - mutation_lengths, mutation_lengths
+    )
+    buffer[np.repeat(colons + 1, mutation_lengths) + within] = table_bytes[
+        np.repeat(table_starts[codes], mutation_lengths) + within
+    ]
+
+    # the last change of each haplotype ends with a newline
+    buffer[change_ends - 1] = ord(";")
+    buffer[change_ends[np.cumsum(n_changes[n_changes > 0]) - 1] - 1] = ord("\n")
+    strings[n_changes > 0] = buffer.tobytes().decode("ascii").split("\n")[:-1]
+    return strings.tolist()
+
+
+def haplotype_to_list(haplotype: HaplotypeLike) -> HaplotypeList:
     """Get the mutations in a haplotype.
 
     Returns
@@ -134,6 +539,10 @@ def haplotype_to_list(haplotype: Haplotype) -> HaplotypeList:
     if isinstance(haplotype, str):
         return list(_parse_haplotype_to_iter(haplotype))
 
+    # use the parsed mutations of a compact haplotype
+    if isinstance(haplotype, Haplotype):
+        return haplotype.to_list()
+
     # convert dict to iterator over items
     if isinstance(haplotype, dict):
         return sorted(list(haplotype.items()), key=_get_position)
@@ -141,7 +550,7 @@ def haplotype_to_list(haplotype: Haplotype) -> HaplotypeList:
     return sorted(list(haplotype), key=_get_position)
 
 
-def haplotype_to_set(haplotype: Haplotype) -> HaplotypeSet:
+def haplotype_to_set(haplotype: HaplotypeLike) -> HaplotypeSet:
     """Convert haplotype to a set.
 
     Returns
@@ -161,6 +570,10 @@ def haplotype_to_set(haplotype: Haplotype) -> HaplotypeSet:
     if isinstance(haplotype, str):
         return set(_parse_haplotype_to_iter(haplotype))
 
+    # use the parsed mutations of a compact haplotype
+    if isinstance(haplotype, Haplotype):
+        return set(haplotype.to_list())
+
     # convert dict to iterator over items
     if isinstance(haplotype, dict):
         return set(haplotype.items())
@@ -168,7 +581,7 @@ def haplotype_to_set(haplotype: Haplotype) -> HaplotypeSet:
     return set(haplotype)
 
 
-def haplotype_to_dict(haplotype: Haplotype) -> HaplotypeDict:
+def haplotype_to_dict(haplotype: HaplotypeLike) -> HaplotypeDict:
     """Convert haplotype to a dict.
 
     Returns
@@ -188,10 +601,14 @@ def haplotype_to_dict(haplotype: Haplotype) -> HaplotypeDict:
     if isinstance(haplotype, str):
         return dict(_parse_haplotype_to_iter(haplotype))
 
+    # use the parsed mutations of a compact haplotype
+    if isinstance(haplotype, Haplotype):
+        return dict(haplotype.to_list())
+
     return dict(haplotype)
 
 
-def haplotype_to_string(haplotype: Haplotype) -> str:
+def haplotype_to_string(haplotype: HaplotypeLike) -> str:
     """Convert a haplotype to a string.
 
     Returns
@@ -207,6 +624,9 @@ def haplotype_to_string(haplotype: Haplotype) -> str:
     if isinstance(haplotype, str):
         return haplotype
 
+    if isinstance(haplotype, Haplotype):
+        return haplotype.to_string()
+
     # change iterator if it is a dictionary
     if isinstance(haplotype, dict):
         haplotype = haplotype.items()
@@ -216,65 +636,548 @@ def haplotype_to_string(haplotype: Haplotype) -> str:
     )
 
 
+def _haplotype_lists(haplotypes: Iterable[HaplotypeLike]) -> list[HaplotypeList]:
+    """Get the list representation of many haplotypes.
+
+    Haplotype strings are parsed at once with `parse_haplotypes`.
+    """
+    haplotypes = list(haplotypes)
+    if not all(isinstance(haplotype, str) for haplotype in haplotypes):
+        return [haplotype_to_list(haplotype) for haplotype in haplotypes]
+
+    collection = parse_haplotypes(haplotypes)
+    mutations = [_parse_mutation(mutation) for mutation in collection.mutations]
+    changes = list(
+        zip(
+            collection.positions.tolist(),
+            [mutations[code] for code in collection.codes.tolist()],
+        )
+    )
+    offsets = collection.offsets.tolist()
+    return [changes[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def _as_collection(haplotypes) -> HaplotypeCollection:
+    """Get haplotypes of any representation as a `HaplotypeCollection`."""
+    if isinstance(haplotypes, HaplotypeCollection):
+        return haplotypes
+    haplotypes = list(haplotypes)
+    if not all(isinstance(haplotype, str) for haplotype in haplotypes):
+        haplotypes = [haplotype_to_string(haplotype) for haplotype in haplotypes]
+    return parse_haplotypes(haplotypes)
+
+
+def _translate_bases(sequence: str) -> np.ndarray:
+    """Encode bases as bytes, with the digit encoding of `_ENCODING` as letters."""
+    return _BASE_BYTES[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+
+def _mutation_table(mutations: list[str]):
+    """Split a mutation table into substitutions, insertions and deletions.
+
+    Returns
+    -------
+    tuple
+        Kind, substituted base and deletion length of each mutation, and the
+        offsets and bytes of the inserted bases.
+    """
+    kinds = np.zeros(len(mutations), dtype=np.int8)
+    bases = np.zeros(len(mutations), dtype=np.uint8)
+    deletion_lengths = np.zeros(len(mutations), dtype=np.int64)
+    insertions = []
+    for code, mutation in enumerate(mutations):
+        insertion = ""
+        if "->" in mutation:
+            kinds[code] = _SUBSTITUTION
+            bases[code] = _translate_bases(mutation[-1])[0]
+        elif mutation.startswith("i"):
+            kinds[code] = _INSERTION
+            insertion = mutation[1:]
+        elif mutation.startswith("del"):
+            kinds[code] = _DELETION
+            deletion_lengths[code] = int(mutation[3:])
+        else:
+            raise NotImplementedError(f"Unknown mutation type {mutation}.")
+        insertions.append(insertion)
+
+    insertion_lengths = np.array([len(bases) for bases in insertions], dtype=np.int64)
+    insertion_bytes = _translate_bases("".join(insertions))
+    return (
+        kinds,
+        bases,
+        deletion_lengths,
+        np.cumsum(insertion_lengths) - insertion_lengths,
+        insertion_lengths,
+        insertion_bytes,
+    )
+
+
+def _expand(starts: np.ndarray, lengths: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Repeat each start `length` times, and get the offset within each range."""
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths), within
+
+
+def _changes(collection: HaplotypeCollection) -> tuple[np.ndarray, ...]:
+    """Get the row, position and code of each change of a collection."""
+    start, stop = collection.offsets[0], collection.offsets[-1]
+    positions = collection.positions[start:stop].astype(np.int64)
+    codes = collection.codes[start:stop]
+    rows = np.repeat(np.arange(len(collection)), collection.n_changes)
+    return rows, positions, codes
+
+
+def _insertions(
+    rows: np.ndarray,
+    positions: np.ndarray,
+    codes: np.ndarray,
+    kinds: np.ndarray,
+    insertion_lengths: np.ndarray,
+    reference_length: int,
+) -> tuple[np.ndarray, ...]:
+    """Get the insertions, and the number of bases inserted before them.
+
+    Insertions at the same position of a haplotype are concatenated.
+    """
+    is_insertion = kinds[codes] == _INSERTION
+    rows, positions, codes = (
+        rows[is_insertion],
+        positions[is_insertion],
+        codes[is_insertion],
+    )
+    lengths = insertion_lengths[codes]
+    keys = rows * reference_length + positions
+    order = np.argsort(keys, kind="stable")
+    group_starts = np.flatnonzero(np.diff(keys[order], prepend=-1) != 0)
+    group_sizes = np.diff(group_starts, append=len(order))
+    cumulative = np.cumsum(lengths[order]) - lengths[order]
+    preceding = np.empty(len(order), dtype=np.int64)
+    preceding[order] = cumulative - np.repeat(cumulative[group_starts], group_sizes)
+    return rows, positions, codes, lengths, preceding
+
+
+def _insertion_widths(
+    reference_length: int, collection: HaplotypeCollection, table: tuple
+) -> np.ndarray:
+    """Get the number of insertion columns after each reference position.
+
+    Each reference position is followed by as many insertion columns as the
+    longest insertion at that position.
+    """
+    kinds, _, _, _, insertion_lengths, _ = table
+    _, positions, _, lengths, preceding = _insertions(
+        *_changes(collection), kinds, insertion_lengths, reference_length
+    )
+    widths = np.zeros(reference_length, dtype=np.int64)
+    np.maximum.at(widths, positions, preceding + lengths)
+    return widths
+
+
+def _alignment_entries(
+    reference_length: int,
+    collection: HaplotypeCollection,
+    widths: np.ndarray,
+    table: tuple,
+) -> tuple[np.ndarray, ...]:
+    """Get the cells of an alignment that differ from their column.
+
+    Each reference column holds the reference base and each insertion column a gap,
+    unless a substitution, deletion or insertion of a haplotype writes to it. A
+    deletion overrides a substitution of the same cell.
+
+    Returns
+    -------
+    tuple[np.ndarray, ...]
+        Row, column and symbol of each written cell, sorted by column and row.
+    """
+    (
+        kinds,
+        bases,
+        deletion_lengths,
+        insertion_starts,
+        insertion_lengths,
+        insertion_bytes,
+    ) = table
+    rows, positions, codes = _changes(collection)
+    change_kinds = kinds[codes]
+    columns = np.arange(reference_length) + np.cumsum(widths) - widths
+
+    is_substitution = change_kinds == _SUBSTITUTION
+    substitution_rows = rows[is_substitution]
+    substitution_columns = columns[positions[is_substitution]]
+    substitution_symbols = bases[codes[is_substitution]]
+
+    is_deletion = change_kinds == _DELETION
+    deletion_rows, within = _expand(
+        rows[is_deletion], deletion_lengths[codes[is_deletion]]
+    )
+    deleted = np.repeat(positions[is_deletion], deletion_lengths[codes[is_deletion]])
+    deleted += within
+    inside = deleted < reference_length
+    deletion_rows = deletion_rows[inside]
+    deletion_columns = columns[deleted[inside]]
+
+    (
+        insertion_rows,
+        insertion_positions,
+        insertion_codes,
+        lengths,
+        preceding,
+    ) = _insertions(rows, positions, codes, kinds, insertion_lengths, reference_length)
+    insertion_columns, within = _expand(
+        columns[insertion_positions] + 1 + preceding, lengths
+    )
+    sources, _ = _expand(insertion_starts[insertion_codes], lengths)
+
+    rows = np.concatenate(
+        [substitution_rows, deletion_rows, np.repeat(insertion_rows, lengths)]
+    )
+    columns = np.concatenate(
+        [substitution_columns, deletion_columns, insertion_columns + within]
+    )
+    symbols = np.concatenate(
+        [
+            substitution_symbols,
+            np.full(len(deletion_rows), ord("-"), dtype=np.uint8),
+            insertion_bytes[sources + within],
+        ]
+    )
+
+    # keep the last write of each cell
+    keys = columns * len(collection) + rows
+    order = np.argsort(keys, kind="stable")
+    last = np.diff(keys[order], append=-1) != 0
+    order = order[last]
+    return rows[order], columns[order], symbols[order]
+
+
+def _column_symbols(reference: str, widths: np.ndarray) -> np.ndarray:
+    """Get the symbol of each column of an alignment without changes."""
+    columns = np.arange(len(reference)) + np.cumsum(widths) - widths
+    symbols = np.full(len(reference) + widths.sum(), ord("-"), dtype=np.uint8)
+    symbols[columns] = _translate_bases(reference)
+    return symbols
+
+
+def _alignment_matrix(
+    reference: str,
+    collection: HaplotypeCollection,
+    widths: np.ndarray | None = None,
+    table: tuple | None = None,
+) -> np.ndarray:
+    """Align each haplotype of a collection once.
+
+    All rows start as a broadcast copy of the reference columns, into which the
+    substitutions, deletions and insertions are written with fancy indexing. The
+    insertion columns are given by `widths`, so that the parts of a collection can
+    be aligned separately, see `_insertion_widths`.
+    """
+    if table is None:
+        table = _mutation_table(collection.mutations)
+    if widths is None:
+        widths = _insertion_widths(len(reference), collection, table)
+    matrix = np.repeat(_column_symbols(reference, widths)[None], len(collection), 0)
+    rows, columns, symbols = _alignment_entries(
+        len(reference), collection, widths, table
+    )
+    matrix[rows, columns] = symbols
+    return matrix
+
+
+def _included(
+    haplotypes, count: list[int] | None
+) -> tuple[HaplotypeCollection, np.ndarray, np.ndarray]:
+    """Get the haplotypes with a positive count, their counts and their indices.
+
+    Haplotypes that are not included do not add insertion columns.
+    """
+    collection = _as_collection(haplotypes)
+    if count is None:
+        count = np.ones(len(collection), dtype=np.int64)
+    count = np.asarray(count).astype(np.int64)
+    included = np.flatnonzero(count > 0)
+    if len(included) < len(collection):
+        collection = collection.take(included)
+    return collection, count[included], included
+
+
+def haplotypes_to_alignment(
+    reference: str,
+    haplotypes: list[HaplotypeLike] | HaplotypeCollection,
+    count: list[int] | None = None,
+) -> np.ndarray:
+    """Convert haplotypes to a matrix of aligned symbols.
+
+    Parameters
+    ----------
+    reference : str
+        Reference sequence.
+    haplotypes : list[HaplotypeLike] | HaplotypeCollection
+        Haplotypes.
+    count : list[int] | None
+        Number of rows of each haplotype, by default 1.
+
+    Returns
+    -------
+    np.ndarray
+        ASCII symbols of shape `(N, L')`, where `N` is the total count and `L'` is
+        the length of the reference plus the insertion columns. Gaps are "-".
+    """
+    collection, count, _ = _included(haplotypes, count)
+    return np.repeat(_alignment_matrix(reference, collection), count, axis=0)
+
+
 def haplotypes_to_sequences(
     reference: str,
-    haplotypes: list[Haplotype],
+    haplotypes: list[HaplotypeLike],
     count: list[int] | None = None,
 ) -> list[str]:
-    """Convert haplotypes to matrix of aligned symbols."""
+    """Convert haplotypes to aligned sequences.
+
+    Each haplotype is aligned once, see `haplotypes_to_alignment`, and only
+    rendered to a string as the last step.
+    """
+    if not len(reference):
+        return []
+
+    collection, count, _ = _included(haplotypes, count)
+    matrix = _alignment_matrix(reference, collection)
+    width = matrix.shape[1]
+    text = matrix.tobytes().decode("ascii")
     sequences = []
-    i = 0
-    if count is None:
-        count = [1] * len(haplotypes)
-    for haplotype, n in zip(haplotypes, count):
-        # create list with characters for each position
-        sequence = list(reference)
-        # transform haplotype to list representation
-        haplotype = haplotype_to_list(haplotype)
-        # add all changes to sequence
-        for position, mutation in haplotype:
-            if isinstance(mutation, Substitution):
-                sequence[position] = _ENCODE_NT[mutation[1]]
-            elif isinstance(mutation, Insertion):
-                assert mutation.startswith("i")
-                for m in mutation[1:]:
-                    sequence[position] += _ENCODE_NT[m]
-            else:
-                NotImplementedError(
-                    f"Unknown mutation type ({type(mutation)}) {mutation}."
-                )
+    for i, n in enumerate(count.tolist()):
+        sequences += [text[i * width : (i + 1) * width]] * n
+    return sequences
 
-        # avoid empty sequences
-        if not sequence:
-            continue
 
-        # add sequence n times
-        for _ in range(int(n)):
-            sequences.append(sequence)
-            i += 1
+def aligned_length(
+    reference: str,
+    haplotypes: list[HaplotypeLike] | HaplotypeCollection,
+    count: list[int] | None = None,
+) -> int:
+    """Get the length of the aligned sequences without aligning them.
+
+    Parameters
+    ----------
+    reference : str
+        Reference sequence.
+    haplotypes : list[HaplotypeLike] | HaplotypeCollection
+        Haplotypes.
+    count : list[int] | None
+        Number of rows of each haplotype, by default 1.
 
-    # determine longest possible sequence for each reference position
-    longest = [max(map(len, [s[i] for s in sequences])) for i in range(len(reference))]
-    # add gaps to sequences
-    sequences_lip = [
-        "".join([s.ljust(l, "-") for s, l in zip(s, longest)]) for s in sequences
-    ]
+    Returns
+    -------
+    int
+        Length of the reference plus the insertion columns.
+    """
+    collection, _, _ = _included(haplotypes, count)
+    table = _mutation_table(collection.mutations)
+    return len(reference) + int(
+        _insertion_widths(len(reference), collection, table).sum()
+    )
 
-    return sequences_lip
 
+def iter_sequences(
+    reference: str,
+    haplotypes: list[HaplotypeLike] | HaplotypeCollection,
+    count: list[int] | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> Iterator[tuple[int, str]]:
+    """Align haplotypes in chunks.
+
+    The insertion columns are computed once for all haplotypes, so that only
+    `chunk_size` haplotypes are aligned at a time.
+
+    Parameters
+    ----------
+    reference : str
+        Reference sequence.
+    haplotypes : list[HaplotypeLike] | HaplotypeCollection
+        Haplotypes.
+    count : list[int] | None
+        Number of rows of each haplotype, by default 1. Haplotypes with a count of
+        0 are skipped and do not add insertion columns.
+    chunk_size : int
+        Number of haplotypes aligned at a time.
+
+    Yields
+    ------
+    tuple[int, str]
+        Index of the haplotype and its aligned sequence, once per haplotype.
+    """
+    if not len(reference):
+        return
+
+    collection, _, included = _included(haplotypes, count)
+    table = _mutation_table(collection.mutations)
+    widths = _insertion_widths(len(reference), collection, table)
+    for start in range(0, len(collection), chunk_size):
+        matrix = _alignment_matrix(
+            reference, collection[start : start + chunk_size], widths, table
+        )
+        width = matrix.shape[1]
+        text = matrix.tobytes().decode("ascii")
+        for i, index in enumerate(included[start : start + chunk_size].tolist()):
+            yield index, text[i * width : (i + 1) * width]
+
+
+class AlignmentView:
+    """Alignment of haplotypes against a reference, computed on demand.
+
+    Only the cells written by the changes of the haplotypes are stored, sorted by
+    column, so that memory grows with the number of changes instead of the size of
+    the alignment. Rows are haplotypes and columns are the reference positions
+    followed by their insertion columns, as in `haplotypes_to_alignment`.
+
+    Attributes
+    ----------
+    haplotypes : HaplotypeCollection
+        Haplotypes of the rows.
+    reference_columns : np.ndarray
+        Column of each reference position.
+    shape : tuple[int, int]
+        Number of rows and columns.
+
+    Example
+    -------
+    ```python
+    view = AlignmentView(reference, data["haplotype"])
+    window = view[:, 100:200]
+    counts = view.base_counts(view.reference_columns)
+    ```
+    """
 
-def haplotypes_to_matrix(reference: str, haplotypes: list[Haplotype]) -> np.ndarray:
+    def __init__(
+        self,
+        reference: str,
+        haplotypes: list[HaplotypeLike] | HaplotypeCollection,
+    ):
+        self.haplotypes = _as_collection(haplotypes)
+        table = _mutation_table(self.haplotypes.mutations)
+        widths = _insertion_widths(len(reference), self.haplotypes, table)
+        self.reference_columns = np.arange(len(reference)) + np.cumsum(widths) - widths
+        self._column_symbols = _column_symbols(reference, widths)
+        self._rows, columns, self._symbols = _alignment_entries(
+            len(reference), self.haplotypes, widths, table
+        )
+        self._column_offsets = np.searchsorted(
+            columns, np.arange(len(self._column_symbols) + 1)
+        )
+        self.shape = (len(self.haplotypes), len(self._column_symbols))
+
+    def __len__(self):
+        return self.shape[0]
+
+    @staticmethod
+    def _index(key, length: int) -> np.ndarray:
+        """Get an int, slice, mask or indices as non-negative indices."""
+        if isinstance(key, slice):
+            return np.arange(length)[key]
+        index = np.asarray(key)
+        if index.dtype == bool:
+            return np.flatnonzero(index)
+        index = index.astype(np.int64)
+        index = np.where(index < 0, index + length, index)
+        if ((index < 0) | (index >= length)).any():
+            raise IndexError("Alignment index out of range.")
+        return index
+
+    def _entries(self, columns: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Get the written cells of some columns, and the column of each."""
+        starts = self._column_offsets[columns]
+        lengths = self._column_offsets[columns + 1] - starts
+        selected, within = _expand(np.arange(len(columns)), lengths)
+        return np.repeat(starts, lengths) + within, selected
+
+    def _block(self, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        """Get the symbols of some rows and columns."""
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        lookup = np.full(self.shape[0], -1, dtype=np.int64)
+        lookup[unique_rows] = np.arange(len(unique_rows))
+
+        block = np.repeat(self._column_symbols[columns][None], len(unique_rows), 0)
+        entries, selected = self._entries(columns)
+        block_rows = lookup[self._rows[entries]]
+        included = block_rows >= 0
+        block[block_rows[included], selected[included]] = self._symbols[
+            entries[included]
+        ]
+        return block[inverse]
+
+    def __getitem__(self, key) -> np.ndarray:
+        """Get the symbols of rows and columns.
+
+        Rows and columns are selected by an int, a slice, a mask or indices, as
+        with `view[rows, columns]` on an array of shape `shape`.
+        """
+        row_key, column_key = key if isinstance(key, tuple) else (key, slice(None))
+        rows = self._index(row_key, self.shape[0])
+        columns = self._index(column_key, self.shape[1])
+        block = self._block(np.atleast_1d(rows), np.atleast_1d(columns))
+        return block[
+            0 if rows.ndim == 0 else slice(None),
+            0 if columns.ndim == 0 else slice(None),
+        ]
+
+    def iter_columns(self, columns=None) -> Iterator[np.ndarray]:
+        """Iterate over the symbols of the columns, all columns by default."""
+        if columns is None:
+            columns = slice(None)
+        for column in self._index(columns, self.shape[1]).tolist():
+            symbols = np.full(self.shape[0], self._column_symbols[column])
+            start, stop = self._column_offsets[column : column + 2]
+            symbols[self._rows[start:stop]] = self._symbols[start:stop]
+            yield symbols
+
+    def base_counts(self, columns=None, weights=None) -> np.ndarray:
+        """Count the symbols of each column.
+
+        Parameters
+        ----------
+        columns : int | slice | np.ndarray | None
+            Columns, all columns by default.
+        weights : np.ndarray | None
+            Weight of each row, by default the counts of the haplotypes.
+
+        Returns
+        -------
+        np.ndarray
+            Weighted counts of shape `(n_columns, 5)` of the bases in the order of
+            their digit encoding, "A", "T", "C" and "G", and of gaps. Other symbols
+            are not counted.
+        """
+        if columns is None:
+            columns = slice(None)
+        columns = np.atleast_1d(self._index(columns, self.shape[1]))
+        weights = self.haplotypes.counts if weights is None else np.asarray(weights)
+        entries, selected = self._entries(columns)
+        entry_weights = weights[self._rows[entries]]
+        counts = np.zeros((len(columns), len(_COUNTED_SYMBOLS)), dtype=weights.dtype)
+
+        # the symbol of a column has the weight of the rows that do not change it
+        written = np.zeros(len(columns), dtype=weights.dtype)
+        np.add.at(written, selected, entry_weights)
+        symbols = _SYMBOL_INDEX[self._column_symbols[columns]]
+        counted = symbols >= 0
+        counts[counted, symbols[counted]] = weights.sum() - written[counted]
+
+        symbols = _SYMBOL_INDEX[self._symbols[entries]]
+        counted = symbols >= 0
+        np.add.at(counts, (selected[counted], symbols[counted]), entry_weights[counted])
+        return counts
+
+
+def haplotypes_to_matrix(reference: str, haplotypes: list[HaplotypeLike]) -> np.ndarray:
     """Convert haplotypes to matrix of aligned encoded symbols.
 
     Note: Can only handle substitutions.
     """
     encoded_reference = [int(_ENCODING[c]) for c in reference]
     sequences = []
-    for haplotype in haplotypes:
+    for haplotype in _haplotype_lists(haplotypes):
         # create list with characters for each position
         sequence = encoded_reference.copy()
-        # transform haplotype to list representation
-        haplotype = haplotype_to_list(haplotype)
         # add all changes to sequence
         for position, mutation in haplotype:
             if "->" in mutation:
@@ -288,15 +1191,13 @@ def haplotypes_to_matrix(reference: str, haplotypes: list[Haplotype]) -> np.ndar
 
 
 def haplotypes_to_frequencies(
-    reference: str, haplotypes: list[Haplotype]
+    reference: str, haplotypes: list[HaplotypeLike]
 ) -> np.ndarray:
     """Convert haplotypes to array of frequencies."""
     counts = np.zeros((len(reference), 4))
 
     # count all changes
-    for haplotype in haplotypes:
-        # transform haplotype to list representation
-        haplotype = haplotype_to_list(haplotype)
+    for haplotype in _haplotype_lists(haplotypes):
         # add all changes to sequence
         for position, mutation in haplotype:
             if "->" in mutation:
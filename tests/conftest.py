@@ -0,0 +1,115 @@
+"""Shared test fixtures."""
+
+import random
+
+import pysam
+import pytest
+
+HAPLOTYPES = [
+    [],
+    [(20, "X")],
+    [(20, "X"), (75, "I")],
+    [(40, "D")],
+    [(110, "X"), (150, "X")],
+]
+
+
+def _random_reads(reference, header, n_reads, seed, haplotypes=HAPLOTYPES):
+    """Generate coordinate sorted reads with a few random changes."""
+    rng = random.Random(seed)
+    reads = []
+    for i in range(n_reads):
+        start = rng.randrange(0, 10)
+        end = len(reference) - rng.randrange(0, 10)
+        changes = list(rng.choice(haplotypes))
+        # sequencing errors
+        if rng.random() < 0.3:
+            changes.append((rng.randrange(start + 1, end - 1), "X"))
+        changes = dict(sorted(changes))
+
+        sequence = []
+        qualities = []
+        cigar = []
+        position = start
+        while position < end:
+            kind = changes.get(position)
+            if kind == "X":
+                sequence.append("T" if reference[position] != "T" else "G")
+                qualities.append(rng.choice([30, 60, 60, 60]))
+                cigar.append((8, 1))
+                position += 1
+            elif kind == "I":
+                sequence += ["A", "C"]
+                qualities += [60, 60]
+                cigar.append((1, 2))
+                kind = None
+                changes.pop(position)
+                continue
+            elif kind == "D":
+                cigar.append((2, 3))
+                position += 3
+            else:
+                sequence.append(reference[position])
+                qualities.append(60)
+                if cigar and cigar[-1][0] == 7:
+                    cigar[-1] = (7, cigar[-1][1] + 1)
+                else:
+                    cigar.append((7, 1))
+                position += 1
+
+        read = pysam.AlignedSegment(header)
+        read.query_name = f"m0/{i}/ccs block_id={rng.choice('abcd')}{i % 7};"
+        read.reference_id = 0
+        read.reference_start = start
+        read.query_sequence = "".join(sequence)
+        read.query_qualities = qualities
+        read.cigartuples = cigar
+        read.set_tag("RG", rng.choice(["bc1", "bc2"]))
+        reads.append(read)
+
+    # duplicate some reads to mimic identical hifi reads
+    reads += [reads[i] for i in rng.sample(range(n_reads), n_reads // 5)]
+    reads.sort(key=lambda read: read.reference_start)
+    return reads
+
+
+@pytest.fixture
+def reference():
+    rng = random.Random(0)
+    return "".join(rng.choice("ACGT") for _ in range(200))
+
+
+@pytest.fixture
+def reference_file(tmp_path, reference):
+    path = tmp_path / "reference.fasta"
+    path.write_text(f">ref\n{reference}\n")
+    return path
+
+
+def _write_alignment(path, reference, **kwargs):
+    header = pysam.AlignmentHeader.from_dict(
+        {
+            "HD": {"VN": "1.6", "SO": "coordinate"},
+            "SQ": [{"SN": "ref", "LN": len(reference)}],
+            "RG": [{"ID": "bc1"}, {"ID": "bc2"}],
+        }
+    )
+    with pysam.AlignmentFile(path, "wb", header=header) as alignment:
+        for read in _random_reads(reference, header, **kwargs):
+            alignment.write(read)
+    pysam.index(str(path))
+    return path
+
+
+@pytest.fixture
+def alignment_file(tmp_path, reference):
+    path = tmp_path / "sample.aligned.bam"
+    return _write_alignment(path, reference, n_reads=300, seed=1)
+
+
+@pytest.fixture
+def majority_alignment_file(tmp_path, reference):
+    """Alignment in which most reads carry a substitution at position 20."""
+    path = tmp_path / "majority.aligned.bam"
+    haplotypes = [[(20, "X")], [(20, "X"), (75, "I")], []]
+    return _write_alignment(path, reference, n_reads=300, seed=2, haplotypes=haplotypes)
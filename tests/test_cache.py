@@ -0,0 +1,60 @@
+"""Test cache module."""
+
+from collections import Counter
+
+import pandas as pd
+import pysam
+
+from phynalysis.cache import ChangeCache, change_cache_path, load_change_cache
+from phynalysis.parsers import MutationCodes, iter_change_batches
+
+
+def _decode(changes):
+    return changes.assign(mutation=changes.mutation.astype(str))
+
+
+def test_cache_batches(alignment_file, reference):
+    cache = load_change_cache(alignment_file, reference)
+    assert change_cache_path(alignment_file).exists()
+
+    for length_threshold, quality_threshold in [(0, 0), (2, 47)]:
+        options = dict(
+            batch_size=64,
+            length_threshold=length_threshold,
+            quality_threshold=quality_threshold,
+        )
+        parsed_stats, cached_stats = Counter(), Counter()
+        with pysam.AlignmentFile(alignment_file, "rb") as alignment:
+            parsed = list(
+                iter_change_batches(
+                    reference,
+                    alignment,
+                    codes=MutationCodes(),
+                    stats=parsed_stats,
+                    **options,
+                )
+            )
+        cached = list(
+            cache.iter_change_batches(
+                codes=MutationCodes(), stats=cached_stats, **options
+            )
+        )
+        assert parsed_stats == cached_stats
+        assert len(parsed) == len(cached)
+        for parsed_batch, cached_batch in zip(parsed, cached):
+            assert parsed_batch.n_reads == cached_batch.n_reads
+            # mutation codes are interned in a different order
+            pd.testing.assert_frame_equal(
+                _decode(parsed_batch.changes), _decode(cached_batch.changes)
+            )
+
+
+def test_cache_invalidation(alignment_file, reference):
+    path = change_cache_path(alignment_file)
+    assert load_change_cache(alignment_file, reference, build=False) is None
+
+    load_change_cache(alignment_file, reference)
+    cache = ChangeCache.load(path)
+    assert cache.matches(alignment_file, reference)
+    assert not cache.matches(alignment_file, reference[::-1])
+    assert load_change_cache(alignment_file, reference[::-1], build=False) is None
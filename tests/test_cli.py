@@ -2,10 +2,19 @@
 
 import argparse
 import io
+import logging
 
+import numpy as np
 import pandas as pd
+import pysam
+import pytest
 
+from phynalysis.cache import change_cache_path
 from phynalysis.cli import aggregate, filter_cmd
+from phynalysis.cli import consensus as consensus_cmd
+from phynalysis.cli import haplotypes as haplotypes_cmd
+from phynalysis.cli.ancestors import ancestors
+from phynalysis.cli.utils import parse_region
 
 
 def test_aggregate():
@@ -39,3 +48,537 @@ def test_filter():
     output = pd.read_csv(output_buffer)
     expected_output = data.query("compartment == 1")
     pd.testing.assert_frame_equal(output, expected_output)
+
+
+def _haplotypes_args(alignment_file, reference_file, output, **kwargs):
+    arguments = dict(
+        input=alignment_file,
+        reference=reference_file,
+        output=output,
+        quality_threshold=47,
+        length_threshold=100,
+        threads=1,
+        change_cache=False,
+        alignments=[],
+        barcode_tag=None,
+        output_dir=None,
+        region=None,
+        collapse_families=None,
+        name_sorted=False,
+        checkpoint=None,
+        resume=False,
+        error_profile=False,
+        mutations_output=None,
+        approximate_top=None,
+        max_reads=None,
+        stratify=None,
+        random_state=42,
+    )
+    arguments.update(kwargs)
+    return argparse.Namespace(**arguments)
+
+
+def test_haplotypes_threads(alignment_file, reference_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(haplotypes_cmd, "SHARD_SIZE", 50)
+    single = tmp_path / "single.csv"
+    threaded = tmp_path / "threaded.csv"
+    haplotypes_cmd.haplotypes(_haplotypes_args(alignment_file, reference_file, single))
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(alignment_file, reference_file, threaded, threads=3)
+    )
+    assert single.read_bytes() == threaded.read_bytes()
+    output = pd.read_csv(single)
+    assert output["count"].sum() == 360
+
+    with pytest.raises(SystemExit):
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(alignment_file, reference_file, single, threads=0)
+        )
+
+
+def test_consensus(majority_alignment_file, reference_file, reference):
+    output_buffer = io.StringIO()
+    args = argparse.Namespace(
+        input=majority_alignment_file,
+        reference=reference_file,
+        output=output_buffer,
+        change_cache=False,
+        pileup=False,
+        confidence=None,
+        read_budget=None,
+        random_state=42,
+        region=None,
+    )
+    consensus_cmd.consensus(args)
+    header, sequence = output_buffer.getvalue().split("\n")
+    assert header.startswith(">consensus of")
+    assert sequence == reference[:20] + "G" + reference[21:]
+
+    pileup_buffer = io.StringIO()
+    args.output, args.pileup = pileup_buffer, True
+    consensus_cmd.consensus(args)
+    assert pileup_buffer.getvalue().split("\n")[1] == sequence
+
+
+def test_consensus_confidence(
+    majority_alignment_file, reference_file, reference, monkeypatch, caplog
+):
+    monkeypatch.setattr(consensus_cmd, "CONFIDENCE_BATCH_SIZE", 50)
+    caplog.set_level(logging.INFO)
+    output_buffer = io.StringIO()
+    args = argparse.Namespace(
+        input=majority_alignment_file,
+        reference=reference_file,
+        output=output_buffer,
+        change_cache=False,
+        pileup=False,
+        confidence=0.9,
+        read_budget=200,
+        random_state=0,
+        region=None,
+    )
+    consensus_cmd.consensus(args)
+    sequence = output_buffer.getvalue().split("\n")[1]
+    assert sequence == reference[:20] + "G" + reference[21:]
+    assert "Consumed 200 of 200 reads." in caplog.messages
+
+    # a majority of 60% in 50 reads is not decided at 99% confidence
+    undecided = consensus_cmd._undecided_sites(
+        np.array([[30, 0, 0, 20, 0], [10, 10, 0, 0, 0], [2, 0, 0, 0, 0]]), 50, 0.99
+    )
+    assert list(undecided) == [0]
+
+    for confidence, read_budget in [(95, 200), (0.0, 200), (0.9, 0)]:
+        args.confidence, args.read_budget = confidence, read_budget
+        with pytest.raises(SystemExit):
+            consensus_cmd.consensus(args)
+
+
+def test_haplotypes_output(alignment_file, reference_file, reference, tmp_path):
+    output = tmp_path / "haplotypes.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(alignment_file, reference_file, output, quality_threshold=0)
+    )
+    output = pd.read_csv(output).set_index("haplotype")
+    assert output["count"].sum() == 360
+    assert f"20:{reference[20]}->G;75:iAC" in output.index
+    assert "40:del3" in output.index
+    assert output.loc["consensus", "count"] > 0
+
+
+def test_haplotypes_change_cache(alignment_file, reference_file, tmp_path):
+    cache_path = change_cache_path(alignment_file)
+    for quality_threshold in (0, 47):
+        parsed = tmp_path / f"parsed_{quality_threshold}.csv"
+        cached = tmp_path / f"cached_{quality_threshold}.csv"
+        options = dict(quality_threshold=quality_threshold, length_threshold=2)
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(alignment_file, reference_file, parsed, **options)
+        )
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(
+                alignment_file, reference_file, cached, change_cache=True, **options
+            )
+        )
+        assert cache_path.exists()
+        assert parsed.read_bytes() == cached.read_bytes()
+
+
+def _split_alignment(path, tmp_path):
+    """Split an alignment into one alignment per read group."""
+    paths = {}
+    with pysam.AlignmentFile(path, "rb") as alignment:
+        outputs = {}
+        for read in alignment:
+            barcode = read.get_tag("RG")
+            if barcode not in outputs:
+                paths[barcode] = tmp_path / f"{barcode}.aligned.bam"
+                outputs[barcode] = pysam.AlignmentFile(
+                    paths[barcode], "wb", template=alignment
+                )
+            outputs[barcode].write(read)
+        for output in outputs.values():
+            output.close()
+    return paths
+
+
+def test_haplotypes_demultiplex(alignment_file, reference_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(haplotypes_cmd, "SHARD_SIZE", 50)
+    paths = _split_alignment(alignment_file, tmp_path)
+
+    tagged = tmp_path / "tagged"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(
+            alignment_file,
+            reference_file,
+            tmp_path / "tagged.csv",
+            barcode_tag="RG",
+            output_dir=tagged,
+            threads=2,
+        )
+    )
+    files = tmp_path / "files"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(
+            paths["bc1"],
+            reference_file,
+            tmp_path / "files.csv",
+            alignments=[paths["bc2"]],
+            output_dir=files,
+        )
+    )
+
+    for barcode, path in paths.items():
+        single = tmp_path / f"{barcode}.csv"
+        haplotypes_cmd.haplotypes(_haplotypes_args(path, reference_file, single))
+        assert (
+            tagged / f"{barcode}.haplotypes.csv"
+        ).read_bytes() == single.read_bytes()
+        assert (files / f"{barcode}.haplotypes.csv").read_bytes() == single.read_bytes()
+
+    aggregated = pd.read_csv(tmp_path / "files.csv")
+    assert list(aggregated.columns[:2]) == ["barcode", "local_id"]
+    assert set(aggregated.barcode) == {"bc1", "bc2"}
+    pd.testing.assert_frame_equal(
+        aggregated.sort_values(["barcode", "local_id"], ignore_index=True),
+        pd.read_csv(tmp_path / "tagged.csv").sort_values(
+            ["barcode", "local_id"], ignore_index=True
+        ),
+    )
+
+
+def test_haplotypes_demultiplex_without_barcodes(
+    alignment_file, reference_file, tmp_path
+):
+    with pytest.raises(SystemExit):
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(
+                alignment_file,
+                reference_file,
+                tmp_path / "output.csv",
+                barcode_tag="XX",
+                output_dir=tmp_path / "barcodes",
+            )
+        )
+    assert not (tmp_path / "output.csv").exists()
+
+
+def test_parse_region():
+    assert parse_region("ref") == ("ref", 0, None)
+    assert parse_region("ref:11-30") == ("ref", 10, 30)
+    assert parse_region("chr1:1,001-2,000") == ("chr1", 1000, 2000)
+
+
+def test_haplotypes_region(alignment_file, reference_file, tmp_path):
+    output = tmp_path / "haplotypes.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(
+            alignment_file,
+            reference_file,
+            output,
+            quality_threshold=0,
+            region="ref:61-160",
+        )
+    )
+    output = pd.read_csv(output).set_index("haplotype")
+    assert output["count"].sum() == 360
+    # changes outside of the region are clipped, so the haplotypes collapse
+    assert "75:iAC" in output.index
+    assert all(
+        60 <= int(change.split(":")[0]) < 160
+        for haplotype in output.index.drop("consensus")
+        for change in haplotype.split(";")
+    )
+
+
+def test_consensus_region(majority_alignment_file, reference_file, reference):
+    for pileup in (False, True):
+        output_buffer = io.StringIO()
+        args = argparse.Namespace(
+            input=majority_alignment_file,
+            reference=reference_file,
+            output=output_buffer,
+            change_cache=False,
+            pileup=pileup,
+            confidence=None,
+            read_budget=None,
+            region="ref:11-30",
+        )
+        consensus_cmd.consensus(args)
+        sequence = output_buffer.getvalue().split("\n")[1]
+        assert sequence == reference[10:20] + "G" + reference[21:30]
+
+
+def test_haplotypes_multiple_contigs(alignment_file, reference, tmp_path):
+    reference_file = tmp_path / "multi.fasta"
+    reference_file.write_text(f">ref\n{reference}\n>other\n{reference[::-1]}\n")
+    output = tmp_path / "output.csv"
+    with pytest.raises(SystemExit):
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(alignment_file, reference_file, output)
+        )
+
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(alignment_file, reference_file, output, region="ref")
+    )
+    assert pd.read_csv(output)["count"].sum() == 360
+
+
+def test_haplotypes_collapse_families(alignment_file, reference_file, tmp_path):
+    output = tmp_path / "families.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(
+            alignment_file,
+            reference_file,
+            output,
+            quality_threshold=0,
+            collapse_families="majority",
+        )
+    )
+    output = pd.read_csv(output)
+    # one family per block id of the form "[abcd][0-6]"
+    assert output["count"].sum() == 28
+
+
+def test_haplotypes_resume(alignment_file, reference_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(haplotypes_cmd, "CHECKPOINT_INTERVAL", 50)
+    expected = tmp_path / "expected.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(alignment_file, reference_file, expected)
+    )
+
+    # interrupt the run after the third checkpoint
+    checkpoint = tmp_path / "haplotypes.checkpoint"
+    save_checkpoint = haplotypes_cmd._save_checkpoint
+    n_saved = []
+
+    def interrupted_save_checkpoint(*args):
+        save_checkpoint(*args)
+        n_saved.append(1)
+        if len(n_saved) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(haplotypes_cmd, "_save_checkpoint", interrupted_save_checkpoint)
+    output = tmp_path / "resumed.csv"
+    args = _haplotypes_args(
+        alignment_file, reference_file, output, checkpoint=checkpoint, resume=True
+    )
+    with pytest.raises(KeyboardInterrupt):
+        haplotypes_cmd.haplotypes(args)
+    assert checkpoint.exists()
+    assert not output.exists()
+
+    monkeypatch.setattr(haplotypes_cmd, "_save_checkpoint", save_checkpoint)
+    haplotypes_cmd.haplotypes(args)
+    assert output.read_bytes() == expected.read_bytes()
+    assert not checkpoint.exists()
+
+
+def test_haplotypes_error_profile(
+    alignment_file, reference_file, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(haplotypes_cmd, "SHARD_SIZE", 50)
+    outputs = []
+    for threads in (1, 2):
+        output = tmp_path / f"threads_{threads}.haplotypes.csv"
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(
+                alignment_file,
+                reference_file,
+                output,
+                threads=threads,
+                error_profile=True,
+            )
+        )
+        outputs.append(output)
+
+    profiles = [np.load(output.with_suffix(".profile.npz")) for output in outputs]
+    for name in ("coverage", "changes", "quality_histogram"):
+        np.testing.assert_array_equal(profiles[0][name], profiles[1][name])
+
+    profile = pd.read_csv(outputs[0].with_suffix(".profile.csv"))
+    assert len(profile) == 200
+    # all reads cover the middle of the reference
+    assert profile.coverage[100] == 360
+    assert profile.insertions[75] > 0
+    assert profile.deletions[40] > 0
+    assert profiles[0]["quality_histogram"].sum() == profiles[0]["changes"].sum()
+
+
+def test_haplotypes_mutations_output(alignment_file, reference_file, tmp_path):
+    output = tmp_path / "sample.haplotypes.csv"
+    mutations_output = tmp_path / "sample.mutations.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(
+            alignment_file,
+            reference_file,
+            output,
+            quality_threshold=0,
+            mutations_output=mutations_output,
+        )
+    )
+    mutations = pd.read_csv(mutations_output)
+    assert list(mutations.columns) == [
+        "position",
+        "mutation",
+        "count",
+        "frequencies",
+        "coverage",
+        "coverage_frequencies",
+        "mean_quality",
+    ]
+    deletion = mutations.set_index(["position", "mutation"]).loc[(40, "del3")]
+    haplotypes = pd.read_csv(output).set_index("haplotype")
+    carriers = haplotypes.index.str.contains("40:del3")
+    assert deletion["count"] == haplotypes["count"][carriers].sum()
+    assert deletion["frequencies"] == pytest.approx(deletion["count"] / 360)
+    assert deletion["coverage"] == 360
+    assert deletion["mean_quality"] == 0
+    assert mutations["frequencies"].is_monotonic_decreasing
+
+
+def test_haplotypes_mutations_output_modes(alignment_file, reference_file, tmp_path):
+    mutations_output = tmp_path / "full.mutations.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(
+            alignment_file,
+            reference_file,
+            io.StringIO(),
+            mutations_output=mutations_output,
+        )
+    )
+    full = pd.read_csv(mutations_output)
+    assert "coverage" in full.columns
+
+    # without parsed reads the table has no coverage columns
+    for mode, kwargs in [
+        ("cache", dict(change_cache=True)),
+        ("families", dict(collapse_families="majority")),
+        ("demultiplex", dict(barcode_tag="RG", output_dir=tmp_path / "barcodes")),
+    ]:
+        mutations_output = tmp_path / f"{mode}.mutations.csv"
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(
+                alignment_file,
+                reference_file,
+                tmp_path / f"{mode}.csv",
+                mutations_output=mutations_output,
+                **kwargs,
+            )
+        )
+        mutations = pd.read_csv(mutations_output)
+        assert "coverage" not in mutations.columns
+        if mode == "cache":
+            pd.testing.assert_frame_equal(
+                mutations, full.drop(columns=["coverage", "coverage_frequencies"])
+            )
+
+    barcode_mutations = pd.read_csv(tmp_path / "barcodes" / "bc1.mutations.csv")
+    aggregated = pd.read_csv(tmp_path / "demultiplex.mutations.csv")
+    assert list(aggregated.columns[:2]) == ["barcode", "local_id"]
+    assert len(barcode_mutations) == (aggregated.barcode == "bc1").sum()
+
+
+def test_haplotypes_approximate_top(
+    alignment_file, reference_file, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(haplotypes_cmd, "SKETCH_FACTOR", 2)
+    monkeypatch.setattr(haplotypes_cmd, "SHARD_SIZE", 50)
+    exact = tmp_path / "exact.csv"
+    haplotypes_cmd.haplotypes(_haplotypes_args(alignment_file, reference_file, exact))
+    exact = pd.read_csv(exact).set_index("haplotype")["count"]
+
+    for threads in (1, 2):
+        output = tmp_path / f"top_{threads}.csv"
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(
+                alignment_file,
+                reference_file,
+                output,
+                threads=threads,
+                approximate_top=3,
+            )
+        )
+        top = pd.read_csv(output).set_index("haplotype")
+        assert top["count"].sum() == exact.sum()
+        assert top.loc["consensus", "count"] == exact["consensus"]
+        changed = top.drop(["consensus", "tail"])
+        assert len(changed) == 3
+        # the sketch only overestimates, by at most the error bound
+        true_counts = exact[changed.index]
+        assert (changed["count"] >= true_counts).all()
+        assert (changed["count"] - changed["count_error"] <= true_counts).all()
+        # the most abundant haplotypes are found
+        assert set(changed.index) == set(exact.drop("consensus").nlargest(3).index)
+
+    with pytest.raises(SystemExit):
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(
+                alignment_file, reference_file, tmp_path / "zero.csv", approximate_top=0
+            )
+        )
+
+
+def test_top_haplotype_counts_copy_changes(alignment_file, reference, monkeypatch):
+    monkeypatch.setattr(haplotypes_cmd, "SKETCH_FACTOR", 2)
+    with pysam.AlignmentFile(alignment_file) as alignment:
+        reads = list(alignment)
+    half = len(reads) // 2
+    counts = haplotypes_cmd._count_reads(reference, reads[:half], 100, 47, top=3)
+    counts.merge(haplotypes_cmd._count_reads(reference, reads[half:], 100, 47, top=3))
+    assert 0 < len(counts.changes) <= 6
+    # the kept haplotypes do not hold on to the arrays of their batches
+    for positions, codes in counts.changes.values():
+        assert positions.base is None
+        assert codes.base is None
+
+
+def test_haplotypes_max_reads(alignment_file, reference_file, tmp_path):
+    for stratify in (None, "read_group"):
+        output = tmp_path / f"sampled_{stratify}.csv"
+        args = _haplotypes_args(
+            alignment_file,
+            reference_file,
+            output,
+            max_reads=100,
+            stratify=stratify,
+            error_profile=True,
+        )
+        haplotypes_cmd.haplotypes(args)
+        assert pd.read_csv(output)["count"].sum() == 100
+        profile = pd.read_csv(output.with_suffix(".profile.csv"))
+        assert profile.coverage.max() <= 100
+
+    output = tmp_path / "all.csv"
+    haplotypes_cmd.haplotypes(
+        _haplotypes_args(alignment_file, reference_file, output, max_reads=1_000)
+    )
+    assert pd.read_csv(output)["count"].sum() == 360
+
+    with pytest.raises(SystemExit):
+        haplotypes_cmd.haplotypes(
+            _haplotypes_args(alignment_file, reference_file, output, max_reads=0)
+        )
+
+
+def test_ancestors(tmp_path):
+    data = pd.DataFrame(
+        {
+            "haplotype": [
+                "consensus",
+                "10:G->A;20:iAT",
+                "30:C->T",
+                "10:G->A",
+                "30:C->T;40:del2",
+                "wt",
+            ],
+            "time": [0, 0, 0, 1, 1, 1],
+        }
+    )
+    data.to_csv(tmp_path / "input.csv", index=False)
+    args = argparse.Namespace(input=tmp_path / "input.csv", output=tmp_path / "out.csv")
+    ancestors(args)
+
+    closest = pd.read_csv(tmp_path / "out.csv").closest_ancestor
+    assert closest.isna().tolist() == [True, True, True, False, False, False]
+    assert closest[3:].tolist() == ["consensus", "30:C->T", "consensus"]
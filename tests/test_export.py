@@ -0,0 +1,63 @@
+"""Test export module."""
+
+import pandas as pd
+
+from phynalysis.export import iter_fasta, iter_nexus, iter_phylip, write_nexus
+
+reference = "ACGTACGT"
+data = pd.DataFrame(
+    {
+        "id": ["a:1", "b;2", "c"],
+        "haplotype": ["1:C->T;3:iGG", "consensus", "2:del3;7:iA"],
+        "count": [2, 0, 1],
+    }
+)
+
+
+def test_iter_fasta():
+    """Test `iter_fasta`."""
+    assert "".join(iter_fasta(data, reference, chunk_size=1)) == (
+        ">a:1\nATGTGGACGT-\n>a:1\nATGTGGACGT-\n>c\nAC-----CGTA"
+    )
+
+
+def test_iter_fasta_float_counts():
+    """Test `iter_fasta` with counts read as floats."""
+    float_data = data.astype({"count": float})
+    assert "".join(iter_fasta(float_data, reference)) == "".join(
+        iter_fasta(data, reference)
+    )
+
+    # haplotypes with a missing count are skipped like those with a count of 0
+    float_data.loc[1, "count"] = None
+    assert "".join(iter_fasta(float_data, reference)) == "".join(
+        iter_fasta(data, reference)
+    )
+    float_data.loc[2, "count"] = None
+    assert "".join(iter_fasta(float_data, reference)) == (
+        ">a:1\nATGTGGACGT\n>a:1\nATGTGGACGT"
+    )
+
+
+def test_iter_nexus(tmp_path):
+    """Test `iter_nexus` and `write_nexus`."""
+    template = "{n_tax} {n_char} {{\n{data}\n}}"
+    chunks = list(iter_nexus(data, reference, template=template, chunk_size=2))
+    assert chunks == [
+        "3 11 {\n",
+        "        a|1 ATGTGGACGT-\n        b.2 ACGT--ACGT-",
+        "\n        c   AC-----CGTA",
+        "\n}",
+    ]
+
+    template_path = tmp_path / "template.nex"
+    template_path.write_text(template)
+    write_nexus(tmp_path / "data.nex", data, reference, template=template_path)
+    assert (tmp_path / "data.nex").read_text() == "".join(chunks)
+
+
+def test_iter_phylip():
+    """Test `iter_phylip`."""
+    assert "".join(iter_phylip(data, reference)) == (
+        "\n3 11\n0 ATGTGGACGT-\n1 ACGT--ACGT-\n2 AC-----CGTA\n"
+    )
@@ -0,0 +1,56 @@
+"""Test mutations module."""
+
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from phynalysis.mutations import (
+    MutationVocabulary,
+    mutations_from_haplotypes,
+    vocabulary_path,
+)
+from phynalysis.transform import parse_haplotypes
+
+
+def test_mutations_from_haplotypes():
+    """Test `mutations_from_haplotypes`."""
+    data = pd.DataFrame(
+        {"count": [3, 2, 5, 1]},
+        index=pd.MultiIndex.from_tuples(
+            [
+                ("s1", "10:G->A;15:iAT"),
+                ("s1", "consensus"),
+                ("s2", "10:G->A"),
+                ("s2", "10:G->A;20:del2"),
+            ],
+            names=["sample_name", "haplotype"],
+        ),
+    )
+    mutations = mutations_from_haplotypes(data, index_map=str.upper)
+    assert mutations.index.names == ["position", "mutation"]
+    assert mutations.index.tolist() == [(10, (3, 0)), (15, "iAT"), (20, "del2")]
+    assert mutations.columns.tolist() == ["S1", "S2"]
+    assert mutations.fillna(0).to_numpy().tolist() == [[3, 6], [3, 0], [0, 1]]
+
+
+def test_mutation_vocabulary(tmp_path):
+    """Test `MutationVocabulary`."""
+    vocabulary = MutationVocabulary()
+    first = parse_haplotypes(["10:G->A;15:iAT", "consensus", "10:G->A"])
+    assert vocabulary.encode_haplotypes(first).tolist() == [0, 1, 0]
+
+    # other mutation tables map to the same ids
+    second = parse_haplotypes(["15:iAT;20:del2", "10:C->T"])
+    assert vocabulary.encode_haplotypes(second, add=False).tolist() == [1, -1, -1]
+    assert vocabulary.encode_haplotypes(second).tolist() == [1, 2, 3]
+    assert vocabulary.encode(10, "G->A") == 0
+    assert vocabulary.decode([3, 2]) == [(10, "C->T"), (20, "del2")]
+    assert vocabulary.count(np.array([0, 0, 3])).tolist() == [2, 0, 0, 1]
+
+    path = vocabulary_path(tmp_path / "haplotypes.csv")
+    assert path.name == "haplotypes.csv.vocabulary.npz"
+    vocabulary.save(path)
+    for copy in (MutationVocabulary.load(path), pickle.loads(pickle.dumps(vocabulary))):
+        assert len(copy) == 4
+        assert copy.encode_haplotypes(second, add=False).tolist() == [1, 2, 3]
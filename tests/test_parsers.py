@@ -0,0 +1,295 @@
+"""Test parsers module."""
+
+from collections import Counter
+
+import pandas as pd
+import pysam
+import pytest
+
+from phynalysis.parsers import (
+    ErrorProfile,
+    MutationCodes,
+    changes_arrays_from_read,
+    changes_from_alignment,
+    changes_from_read,
+    count_read_strata,
+    encode_sequence,
+    iter_change_batches,
+    iter_family_change_batches,
+    pileup_from_reads,
+    sample_reads,
+)
+
+reference = "ACGTACGTACGTACGTACGT"
+header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "ref", "LN": len(reference)}]})
+
+
+def make_read(name, start, sequence, cigar, qualities=None, reverse=False):
+    """Create an aligned read against the test reference."""
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.reference_id = 0
+    read.reference_start = start
+    read.query_sequence = sequence
+    read.cigarstring = cigar
+    if qualities is not None:
+        read.query_qualities = pysam.qualitystring_to_array(qualities)
+    read.is_reverse = reverse
+    return read
+
+
+reads = [
+    # soft clip, substitution, insertion and deletion
+    make_read("r0 block_id=b0;", 2, "TTGTTCGTAAACC", "2S2=1X3=2I2=2D1X", "I" * 13),
+    # matching read
+    make_read("r1 block_id=b1;", 0, "ACGTACGT", "8=", "I" * 8),
+    # read without qualities
+    make_read("r2", 4, "AGGTA", "1=1X3="),
+]
+
+
+def test_changes_from_read():
+    """Test `changes_from_read`."""
+    assert changes_from_read(reference, reads[0]) == [
+        [4, "A->T", 40],
+        [8, "iAA", 40],
+        [10, "del2", 0],
+        [12, "A->C", 40],
+    ]
+    assert changes_from_read(reference, reads[1]) == []
+    assert changes_from_read(reference, reads[2]) == [[5, "C->G", 255]]
+
+
+def test_changes_from_read_reverse_qualities():
+    """Test that qualities follow `get_forward_qualities`."""
+    read = make_read("r", 0, "ACTTA", "2=1X1I1=", "!+5?I", reverse=True)
+    assert changes_from_read(reference, read) == [[2, "G->T", 20], [3, "iT", 10]]
+
+
+def test_changes_arrays_from_read():
+    """Test dtypes and shared codes of `changes_arrays_from_read`."""
+    codes = MutationCodes()
+    encoded = encode_sequence(reference)
+    positions, mutation_codes, qualities = changes_arrays_from_read(
+        encoded, reads[0], codes
+    )
+    assert positions.dtype == "int32"
+    assert mutation_codes.dtype == "int32"
+    assert qualities.dtype == "uint8"
+    assert codes.decode(mutation_codes) == ["A->T", "iAA", "del2", "A->C"]
+
+    read = make_read("r", 4, "TCGT", "1X3=")
+    _, mutation_codes, _ = changes_arrays_from_read(encoded, read, codes)
+    assert codes.decode(mutation_codes) == ["A->T"]
+    assert len(codes) == 4
+
+
+def test_changes_from_alignment():
+    """Test `changes_from_alignment`."""
+    changes = changes_from_alignment(reference, reads)
+    assert list(changes.seq_id) == [0, 0, 0, 0, 2]
+    assert list(changes.block_id[:4]) == ["b0"] * 4
+    assert changes.block_id.isna()[4]
+    assert list(changes.position) == [4, 8, 10, 12, 5]
+    assert list(changes.mutation) == ["A->T", "iAA", "del2", "A->C", "C->G"]
+    assert list(changes.quality) == [40, 40, 0, 40, 255]
+
+
+def test_changes_from_alignment_dtypes():
+    """Test the compact column types of the changes table."""
+    changes = changes_from_alignment(reference, reads)
+    assert changes.seq_id.dtype == "int32"
+    assert changes.position.dtype == "int32"
+    assert changes.quality.dtype == "uint8"
+    assert isinstance(changes.mutation.dtype, pd.CategoricalDtype)
+    assert isinstance(changes.block_id.dtype, pd.CategoricalDtype)
+
+    empty = changes_from_alignment(reference, [])
+    assert list(empty.columns) == list(changes.columns)
+    assert empty.position.dtype == "int32"
+
+
+def test_iter_change_batches():
+    """Test that batches split the alignment at read boundaries."""
+    batches = list(iter_change_batches(reference, iter(reads), batch_size=2))
+    assert [batch.n_reads for batch in batches] == [2, 1]
+    assert list(batches[0].changes.seq_id) == [0, 0, 0, 0]
+    assert list(batches[1].changes.seq_id) == [2]
+    assert list(batches[1].changes.mutation) == ["C->G"]
+
+
+def test_iter_change_batches_filters():
+    """Test that length and quality filters are applied during extraction."""
+    stats = Counter()
+    (batch,) = iter_change_batches(reference, reads, length_threshold=2, stats=stats)
+    assert batch.n_reads == 2
+    assert list(batch.changes.seq_id) == [1]
+    assert stats["reads"] == 3
+    assert stats["reads_rejected_length"] == 1
+
+    stats = Counter()
+    (batch,) = iter_change_batches(reference, reads, quality_threshold=41, stats=stats)
+    assert batch.n_reads == 3
+    assert list(batch.changes.mutation) == ["C->G"]
+    assert stats["changes"] == 5
+    assert stats["changes_rejected_quality"] == 4
+
+
+def test_pileup_from_reads():
+    """Test counting the aligned bases of reads."""
+    stats = Counter()
+    counts, n_reads = pileup_from_reads(len(reference), reads, stats=stats)
+    assert counts.shape == (len(reference), 5)
+    assert n_reads == 3
+    assert list(counts[4]) == [2, 0, 0, 1, 0]
+    assert list(counts[5]) == [0, 2, 1, 0, 0]
+    # deletions and insertions are not counted
+    assert counts[10:12].sum() == 0
+    assert counts.sum() == stats["bases"] == 22
+
+    stats = Counter()
+    counts, _ = pileup_from_reads(len(reference), reads, min_quality=41, stats=stats)
+    assert list(counts[5]) == [0, 0, 1, 0, 0]
+    assert counts.sum() == 5
+    assert stats["bases_rejected_quality"] == 17
+
+
+def test_pileup_from_reads_reverse_qualities():
+    """Test that bases are filtered by their own quality on the reverse strand."""
+    read = make_read("r3", 0, "ACGTACGTAC", "10=", "+" * 4 + "I" * 6, reverse=True)
+    counts, _ = pileup_from_reads(len(reference), [read], min_quality=30)
+    assert counts[:4].sum() == 0
+    assert counts[4:10].sum() == 6
+
+
+def test_unmapped_reads():
+    """Test that unmapped reads have no changes and no aligned bases."""
+    unmapped = pysam.AlignedSegment(header)
+    unmapped.query_name = "r3"
+    unmapped.query_sequence = "ACGTACGT"
+    unmapped.is_unmapped = True
+
+    (batch,) = iter_change_batches(reference, reads + [unmapped])
+    assert batch.n_reads == 4
+    assert list(batch.changes.seq_id) == [0, 0, 0, 0, 2]
+    assert changes_from_read(reference, unmapped) == []
+
+    counts, n_reads = pileup_from_reads(len(reference), [unmapped])
+    assert n_reads == 1
+    assert counts.sum() == 0
+
+
+def test_iter_change_batches_collapse_identical():
+    """Test that identical reads keep their own qualities when collapsed."""
+    duplicate = make_read(
+        "r3 block_id=b3;", 2, "TTGTTCGTAAACC", "2S2=1X3=2I2=2D1X", "I" * 4 + "!" * 9
+    )
+    duplicated_reads = reads + [duplicate, reads[0]]
+    for quality_threshold in (0, 41, 30):
+        stats, collapsed_stats = Counter(), Counter()
+        (batch,) = iter_change_batches(
+            reference,
+            duplicated_reads,
+            quality_threshold=quality_threshold,
+            stats=stats,
+        )
+        (collapsed,) = iter_change_batches(
+            reference,
+            duplicated_reads,
+            quality_threshold=quality_threshold,
+            stats=collapsed_stats,
+            collapse_identical=True,
+        )
+        assert collapsed_stats.pop("reads_collapsed") == 2
+        assert stats == collapsed_stats
+        pd.testing.assert_frame_equal(
+            batch.changes.assign(mutation=batch.changes.mutation.astype(str)),
+            collapsed.changes.assign(mutation=collapsed.changes.mutation.astype(str)),
+        )
+
+
+def test_iter_family_change_batches():
+    """Test collapsing read families by vote."""
+    family = [
+        make_read("f0 block_id=f;", 0, "ACTTACGT", "2=1X5=", "I" * 8),
+        make_read("f1 block_id=f;", 0, "ACTTACGT", "2=1X5=", "!" * 8),
+        make_read("f2 block_id=f;", 0, "ACGTACGT", "8=", "I" * 8),
+    ]
+    singleton = make_read("s0", 4, "AGGTA", "1=1X3=")
+
+    stats = Counter()
+    (batch,) = iter_family_change_batches(
+        reference, [family[0], singleton, *family[1:]], stats=stats
+    )
+    assert batch.n_reads == 2
+    assert stats["families"] == 2
+    assert list(batch.changes.seq_id) == [0, 1]
+    assert list(batch.changes.mutation) == ["G->T", "C->G"]
+    assert list(batch.changes.quality) == [20, 255]
+
+    # the low quality read does not make a majority with the quality vote
+    (batch,) = iter_family_change_batches(reference, family, vote="quality")
+    assert batch.n_reads == 1
+    assert batch.changes.empty
+
+    # consecutive families are streamed, so split families are counted twice
+    batches = list(
+        iter_family_change_batches(
+            reference, [family[0], singleton, *family[1:]], name_sorted=True
+        )
+    )
+    assert sum(batch.n_reads for batch in batches) == 3
+
+
+def test_error_profile():
+    """Test that the profile sees all changes before the quality threshold."""
+    profile = ErrorProfile(len(reference))
+    (batch,) = iter_change_batches(
+        reference, reads, quality_threshold=41, profile=profile
+    )
+    assert list(batch.changes.mutation) == ["C->G"]
+    assert list(profile.coverage[:14]) == [1, 1, 2, 2, 3, 3, 3, 3, 2, 1, 1, 1, 1, 0]
+    assert list(profile.changes.sum(axis=0)) == [3, 1, 1]
+    assert list(profile.changes[8]) == [0, 1, 0]
+    assert profile.quality_histogram[4, 40] == 1
+    assert profile.quality_histogram[10, 0] == 1
+    assert profile.quality_histogram[5, -1] == 1
+
+    frame = profile.to_frame()
+    assert list(frame.columns) == [
+        "position",
+        "coverage",
+        "mismatches",
+        "insertions",
+        "deletions",
+        "error_rate",
+    ]
+    assert frame.error_rate[4] == 1 / 3
+
+
+def test_sample_reads():
+    """Test reservoir sampling of reads."""
+    many_reads = [
+        make_read(f"r{i} block_id={'ab'[i % 4 == 0]};", i % 10, "ACGT", "4=")
+        for i in range(100)
+    ]
+
+    sample = sample_reads(many_reads, 10, random_state=1)
+    assert len(sample) == 10
+    # sampled reads keep their order
+    assert sample == sorted(sample, key=many_reads.index)
+    assert sample == sample_reads(many_reads, 10, random_state=1)
+    assert sample != sample_reads(many_reads, 10, random_state=2)
+    assert sample_reads(many_reads, 200) == many_reads
+
+    strata = count_read_strata(many_reads, "block_id")
+    assert strata == Counter(a=75, b=25)
+    stats = Counter()
+    sample = sample_reads(
+        many_reads, 8, stratify="block_id", strata=strata, stats=stats
+    )
+    assert count_read_strata(sample, "block_id") == Counter(a=6, b=2)
+    assert stats["reads_before_sampling"] == 100
+
+    with pytest.raises(ValueError):
+        sample_reads(many_reads, 8, stratify="block_id")
@@ -0,0 +1,69 @@
+"""Test reference module."""
+
+import numpy as np
+import pysam
+
+from phynalysis.parsers import iter_change_batches
+from phynalysis.reference import Reference, load_reference
+
+
+def _write_fasta(path, contigs):
+    path.write_text("".join(f">{name} description\n{seq}\n" for name, seq in contigs))
+    return path
+
+
+def test_reference(tmp_path):
+    path = _write_fasta(tmp_path / "multi.fasta", [("a", "ACGT" * 30), ("b", "TTGCA")])
+
+    reference = load_reference(path)
+    assert load_reference(path) is reference
+    assert reference.contigs == ("a", "b")
+    assert reference.lengths == {"a": 120, "b": 5}
+    assert reference.sequence() == "ACGT" * 30
+    assert reference.sequence("b") == "TTGCA"
+    assert bytes(reference.encoded("b")) == b"TTGCA"
+
+    cached = Reference(path, cache_arrays=True)
+    assert bytes(cached.encoded("b")) == b"TTGCA"
+    array_path = tmp_path / "multi.fasta.1.npy"
+    assert array_path.exists()
+    np.save(array_path, np.frombuffer(b"GGGGG", dtype=np.uint8))
+    # arrays are loaded from the cache if they are newer than the FASTA file
+    assert bytes(Reference(path, cache_arrays=True).encoded("b")) == b"GGGGG"
+
+
+def test_reference_without_index(tmp_path):
+    # lines of different lengths within a record cannot be indexed by faidx
+    path = tmp_path / "uneven.fasta"
+    path.write_text(">a description\nACGTACGT\nACG\nACGTAC\n>b\nTTGCA\n")
+
+    reference = Reference(path)
+    assert reference.contigs == ("a", "b")
+    assert reference.lengths == {"a": 17, "b": 5}
+    assert reference.sequence() == "ACGTACGTACGACGTAC"
+    assert bytes(reference.encoded("b")) == b"TTGCA"
+
+
+def test_reference_lookup(tmp_path):
+    path = _write_fasta(
+        tmp_path / "multi.fasta", [("a", "ACGTACGT"), ("b", "TTTTTTTC")]
+    )
+    reference = load_reference(path)
+
+    header = pysam.AlignmentHeader.from_dict(
+        {"SQ": [{"SN": "a", "LN": 8}, {"SN": "b", "LN": 8}]}
+    )
+    reads = []
+    for contig in (0, 1):
+        read = pysam.AlignedSegment(header)
+        read.query_name = f"r{contig}"
+        read.reference_id = contig
+        read.reference_start = 0
+        read.query_sequence = "ACGTACGA"
+        read.cigarstring = "7=1X"
+        reads.append(read)
+
+    (batch,) = iter_change_batches(reference, reads)
+    changes = batch.changes
+    # each read is compared against the contig it is aligned to
+    assert list(changes.mutation) == ["T->A", "C->A"]
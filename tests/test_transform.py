@@ -1,11 +1,23 @@
 """Test transform module."""
 
+import numpy as np
+import pandas as pd
+import pytest
+
 from phynalysis.transform import (
+    AlignmentView,
+    Haplotype,
+    HaplotypeCollection,
+    aligned_length,
+    format_haplotypes,
+    haplotypes_to_alignment,
     haplotype_to_dict,
     haplotype_to_list,
     haplotype_to_set,
     haplotype_to_string,
     haplotypes_to_sequences,
+    iter_sequences,
+    parse_haplotypes,
 )
 
 haplotype_string = "10:G->A;15:iATTA;3004:G->A"
@@ -67,3 +79,123 @@ def test_haplotypes_to_sequences():
         "AA---AG",
         "AA---GA",
     ]
+
+
+def test_haplotype_collection():
+    """Test `HaplotypeCollection` and `Haplotype`."""
+    strings = [haplotype_string, "consensus", "10:G->A;20:del3", "15:iATTA"]
+    collection = HaplotypeCollection.from_strings(strings, counts=[4, 3, 2, 1])
+    assert len(collection) == 4
+    assert collection.codes.dtype == np.uint8
+    assert collection.positions.dtype == np.int32
+    assert collection.n_changes.tolist() == [3, 0, 2, 1]
+    assert collection.to_strings() == strings
+
+    haplotype = collection[0]
+    assert haplotype == Haplotype.from_string(haplotype_string)
+    assert len({haplotype, Haplotype.from_string(haplotype_string)}) == 1
+    assert haplotype_to_list(haplotype) == haplotype_list
+    assert haplotype_to_set(haplotype) == haplotype_set
+    assert haplotype_to_dict(haplotype) == haplotype_dict
+    assert haplotype_to_string(haplotype) == haplotype_string
+    assert haplotype_to_list(collection[1]) == []
+    assert haplotype_to_string(collection[-3]) == "consensus"
+
+    # slices share the arrays of the collection
+    tail = collection[2:]
+    assert np.shares_memory(tail.offsets, collection.offsets)
+    assert tail.positions is collection.positions
+    assert tail.to_strings() == strings[2:]
+    assert tail.counts.tolist() == [2, 1]
+    assert tail[1:].to_strings() == ["15:iATTA"]
+    assert len(collection[3:1]) == 0
+
+
+def test_parse_haplotypes():
+    """Test `parse_haplotypes` and `format_haplotypes`."""
+    strings = pd.Series(
+        [
+            haplotype_string,
+            "wt",
+            None,
+            "7:del3;123456:iACGTACGTACGT;123457:G->A",
+            "consensus",
+            "0:A->T",
+        ]
+    )
+    collection = parse_haplotypes(strings, counts=range(6))
+    assert collection.offsets.tolist() == [0, 3, 3, 3, 6, 6, 7]
+    assert collection.positions.tolist() == [10, 15, 3004, 7, 123456, 123457, 0]
+    assert collection.counts.tolist() == list(range(6))
+    assert [list(haplotype) for haplotype in collection][3] == [
+        (7, "del3"),
+        (123456, "iACGTACGTACGT"),
+        (123457, "G->A"),
+    ]
+    assert haplotype_to_list(collection[0]) == haplotype_list
+
+    expected = strings.fillna("consensus").replace("wt", "consensus").tolist()
+    assert format_haplotypes(collection) == expected
+    assert format_haplotypes(collection[3:5]) == expected[3:5]
+    assert format_haplotypes(parse_haplotypes(["consensus"])) == ["consensus"]
+
+    with pytest.raises(ValueError):
+        parse_haplotypes(["10:G->A;x5:G->A"])
+    with pytest.raises(ValueError):
+        parse_haplotypes(["10G->A"])
+
+
+def test_haplotypes_to_alignment():
+    """Test `haplotypes_to_alignment`."""
+    alignment = haplotypes_to_alignment(
+        "ACGTACGT",
+        ["1:C->T;3:iGG", "consensus", "2:del3;7:iA", "5:iTTTT"],
+        count=[2, 1, 1, 0],
+    )
+    assert alignment.dtype == np.uint8
+    assert alignment.shape == (4, 11)
+    assert [row.tobytes().decode() for row in alignment] == [
+        "ATGTGGACGT-",
+        "ATGTGGACGT-",
+        "ACGT--ACGT-",
+        "AC-----CGTA",
+    ]
+
+    collection = HaplotypeCollection.from_strings(["1:C->T", "consensus", "2:del3"])
+    assert collection.take([2, 0]).to_strings() == ["2:del3", "1:C->T"]
+
+
+def test_iter_sequences():
+    """Test `iter_sequences` and `aligned_length`."""
+    haplotypes = ["1:C->T;3:iGG", "consensus", "2:del3;7:iA", "5:iTTTT"]
+    count = [2, 1, 1, 0]
+    # chunks are aligned with the insertion columns of all haplotypes
+    assert list(iter_sequences("ACGTACGT", haplotypes, count, chunk_size=1)) == [
+        (0, "ATGTGGACGT-"),
+        (1, "ACGT--ACGT-"),
+        (2, "AC-----CGTA"),
+    ]
+    assert aligned_length("ACGTACGT", haplotypes, count) == 11
+    assert aligned_length("ACGTACGT", haplotypes) == 15
+
+
+def test_alignment_view():
+    """Test `AlignmentView`."""
+    haplotypes = ["1:C->T;3:iGG", "consensus", "2:del3;7:iA", "1:C->G;1:del1"]
+    collection = HaplotypeCollection.from_strings(haplotypes, counts=[2, 1, 1, 3])
+    view = AlignmentView("ACGTACGT", collection)
+    alignment = haplotypes_to_alignment("ACGTACGT", collection)
+    assert view.shape == alignment.shape == (4, 11)
+    assert (view[:] == alignment).all()
+    assert (view[[3, -4], 1:6] == alignment[[3, 0], 1:6]).all()
+    assert view[2, 10] == ord("A")
+    assert view.reference_columns.tolist() == [0, 1, 2, 3, 6, 7, 8, 9]
+    # a deletion overrides a substitution of the same position
+    assert view[3].tobytes() == b"A-GT--ACGT-"
+
+    columns = list(view.iter_columns([1, 4]))
+    assert [column.tobytes() for column in columns] == [b"TCC-", b"G---"]
+    assert view.base_counts([1, 4]).tolist() == [[0, 2, 2, 0, 3], [0, 0, 0, 2, 5]]
+    assert view.base_counts(10, weights=np.ones(4, dtype=int)).tolist() == [
+        [1, 0, 0, 0, 3]
+    ]